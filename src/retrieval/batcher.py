@@ -0,0 +1,85 @@
+"""
+Micro-batching of query embeddings across concurrent requests.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import asyncio
+from typing import Optional
+
+import numpy as np
+
+
+class QueryBatcher:
+    """
+    Collects the queries that arrive within a short window into a single
+    call to the embedder, and hands each caller back its own vector.
+
+    The model runs on a worker thread, so the event loop keeps accepting
+    queries (for the next batch) while a batch is being embedded.
+    """
+
+    def __init__(self, embedder, window_ms: float = 2.0, max_batch_size: int = 64):
+        """
+        Initialize batcher.
+
+        Args:
+            embedder: DocumentEmbedder instance for generating vectors
+            window_ms: Milliseconds to wait for more queries after the first
+                one of a batch arrives
+            max_batch_size: Embed a batch at once when it gets this big
+        """
+        self.embedder = embedder
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks: set[asyncio.Task] = set()  # keeps running batches referenced
+
+    async def embed(self, query: str) -> np.ndarray:
+        """
+        Embed a query together with any others arriving around the same time.
+
+        Args:
+            query: Search query text
+
+        Returns:
+            The query's embedding
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        """Start embedding the pending queries as one batch."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._embed_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch: list[tuple[str, asyncio.Future]]):
+        """Embed a batch of queries and resolve each caller's future."""
+        try:
+            embeddings = await asyncio.to_thread(
+                self.embedder.embed_query, [query for query, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():  # the caller may have been cancelled
+                future.set_result(embedding)
@@ -10,3 +10,46 @@ LLM_BASE_URL = os.getenv("LLM_BASE_URL", "http://localhost:11434")
 LLM_MODEL = os.getenv("LLM_MODEL", "qwen2.5:3b")
 LLM_API_KEY = os.getenv("LLM_API_KEY")  # None if not set
 PORT = int(os.getenv("PORT", "8000"))
+
+# Keep re-indexing the documents directory as files change (polling interval in seconds)
+WATCH_DOCUMENTS = os.getenv("WATCH_DOCUMENTS", "false").lower() in ("1", "true", "yes")
+WATCH_INTERVAL = float(os.getenv("WATCH_INTERVAL", "1.0"))
+
+# Workers reading documents in parallel (1 reads them one at a time, 0 uses one per CPU core)
+LOAD_WORKERS = int(os.getenv("LOAD_WORKERS", "1")) or None
+
+# Directory to cache document embeddings in across restarts (no caching if unset)
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR")  # None if not set
+
+# Run the embedding model with "torch" or "onnx" (ONNX Runtime, optionally int8-quantized)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_QUANTIZED = os.getenv("EMBEDDING_QUANTIZED", "false").lower() in ("1", "true", "yes")
+
+# Search embeddings with ChromaDB's HNSW index ("chroma"), exactly with NumPy ("flat"),
+# or with a compressed IVF-PQ index ("ivfpq")
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
+# Search the flat backend's float32 vectors from a memory-mapped file
+MEMORY_MAP_VECTORS = os.getenv("MEMORY_MAP_VECTORS", "false").lower() in ("1", "true", "yes")
+# Keep embeddings as "float32" or compactly as "float16" or "int8" (flat backend)
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "float32")
+
+# Milliseconds to wait to embed concurrent queries together (0 embeds each on its own)
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "2"))
+
+# Directory to persist the index in, so restarts only index changed documents (in memory if unset)
+INDEX_DIR = os.getenv("INDEX_DIR")  # None if not set
+# Snapshot file to start from if it exists, and to export after indexing if it doesn't
+INDEX_SNAPSHOT = os.getenv("INDEX_SNAPSHOT")  # None if not set
+
+# ChromaDB HNSW index: distance ("cosine", "l2", "ip"), graph links, and build/search list sizes
+HNSW_SPACE = os.getenv("HNSW_SPACE", "cosine")
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "100"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "100"))
+
+# IVF-PQ index: clusters, bytes per vector (dividing the dimension), clusters searched, and
+# vectors to add before training on a sample of them
+IVF_LISTS = int(os.getenv("IVF_LISTS", "1024"))
+PQ_SUBVECTORS = int(os.getenv("PQ_SUBVECTORS", "48"))
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "16"))
+IVF_TRAIN_SIZE = int(os.getenv("IVF_TRAIN_SIZE", "65536"))
@@ -0,0 +1,216 @@
+"""
+Near-duplicate chunk elimination before embedding.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import hashlib
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+from retrieval.filters import Filters, MetadataIndex
+
+# MinHash permutations are (a * x + b) mod this Mersenne prime
+_PRIME = (1 << 31) - 1
+
+
+class ChunkDeduplicator:
+    """
+    Collapses exact and near-duplicate chunks onto one canonical chunk.
+
+    Exact duplicates (same words, ignoring case and whitespace) are found
+    by hashing. Near duplicates are found with MinHash signatures over word
+    shingles, bucketed by locality-sensitive hashing so each chunk is only
+    compared with likely matches. The first chunk seen is canonical; the
+    others are dropped, but remembered as further sources of it.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 3,
+        seed: int = 5360,
+    ):
+        """
+        Initialize deduplicator.
+
+        Args:
+            threshold: Estimated Jaccard similarity of the word shingles at
+                or above which chunks are near duplicates
+            num_perm: Number of MinHash permutations (signature length)
+            bands: Number of LSH bands (must divide num_perm); more bands
+                find more candidates at lower similarities
+            shingle_size: Number of words per shingle
+            seed: Seed for the MinHash permutations
+        """
+        if num_perm % bands:
+            raise ValueError("The number of bands must divide the number of permutations.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _PRIME, size=num_perm, dtype=np.uint64)
+        self.clear()
+
+    def clear(self) -> None:
+        """Forget every chunk."""
+        self._exact: dict[str, str] = {}  # text digest -> canonical id
+        self._buckets: defaultdict[tuple[int, bytes], list[str]] = defaultdict(list)
+        self._canonical: dict[str, dict] = {}  # canonical id -> its digest, signature, sources
+        self._duplicate_of: dict[str, str] = {}  # duplicate id -> canonical id
+        self._duplicate_ids: list[str] = []  # the duplicate in each row of the index
+        self._duplicate_rows: dict[str, int] = {}  # duplicate id -> its row
+        self._index = MetadataIndex()  # the duplicates' rows by metadata value, for filters
+
+    def _signature(self, words: list[str]) -> np.ndarray:
+        """Compute the MinHash signature of a chunk's word shingles."""
+        n = self.shingle_size
+        shingles = {" ".join(words[i : i + n]) for i in range(max(1, len(words) - n + 1))}
+        x = np.fromiter((zlib.crc32(s.encode()) % _PRIME for s in shingles), dtype=np.uint64)
+        return ((self._a[:, None] * x[None, :] + self._b[:, None]) % _PRIME).min(axis=1)
+
+    def _band_keys(self, signature: np.ndarray) -> list[tuple[int, bytes]]:
+        """Split a signature into its LSH bucket keys."""
+        rows = self.num_perm // self.bands
+        return [
+            (band, signature[band * rows : (band + 1) * rows].tobytes())
+            for band in range(self.bands)
+        ]
+
+    def deduplicate(self, chunks: list[dict]) -> tuple[list[dict], list[dict]]:
+        """
+        Split chunks into those to index and those that duplicate others.
+
+        Chunks are compared with each other and with every canonical chunk
+        from earlier calls (until forgotten).
+
+        Args:
+            chunks: Chunk dicts with 'id', 'text', and 'metadata'
+
+        Returns:
+            Tuple of the unique chunks and the duplicate chunks
+        """
+        unique, duplicates = [], []
+        for chunk in chunks:
+            words = chunk["text"].lower().split()
+            digest = hashlib.sha256(" ".join(words).encode()).hexdigest()
+            source = chunk["metadata"].get("filename", chunk["metadata"].get("doc_id"))
+
+            canonical_id = self._exact.get(digest)
+            if canonical_id is None:
+                signature = self._signature(words)
+                canonical_id = self._find_near_duplicate(signature)
+
+            if canonical_id is None:
+                self._exact[digest] = chunk["id"]
+                for key in self._band_keys(signature):
+                    self._buckets[key].append(chunk["id"])
+                self._canonical[chunk["id"]] = {
+                    "digest": digest,
+                    "signature": signature,
+                    "sources": [(chunk["id"], source)],
+                }
+                unique.append(chunk)
+            else:
+                self._canonical[canonical_id]["sources"].append((chunk["id"], source))
+                self._duplicate_of[chunk["id"]] = canonical_id
+                duplicates.append(chunk)
+
+        # Index the duplicates' metadata, replacing any they had before
+        for chunk in duplicates:
+            self._drop_duplicate(chunk["id"])
+        for chunk in duplicates:
+            self._duplicate_rows[chunk["id"]] = len(self._duplicate_ids)
+            self._duplicate_ids.append(chunk["id"])
+        self._index.append(chunk["metadata"] for chunk in duplicates)
+        return unique, duplicates
+
+    def _find_near_duplicate(self, signature: np.ndarray) -> str | None:
+        """Return the id of a canonical chunk similar enough to the signature."""
+        candidates = {
+            cid for key in self._band_keys(signature) for cid in self._buckets.get(key, [])
+        }
+        for cid in sorted(candidates):
+            if np.mean(self._canonical[cid]["signature"] == signature) >= self.threshold:
+                return cid
+        return None
+
+    def sources(self, chunk_id: str) -> list[str]:
+        """Return the sources (filenames) of a canonical chunk, its own first."""
+        entry = self._canonical.get(chunk_id)
+        return [source for _, source in entry["sources"]] if entry else []
+
+    def stand_ins(self, filters: Filters) -> list[str]:
+        """
+        Return the ids of the canonical chunks standing in for duplicates
+        whose metadata matches filters.
+
+        Args:
+            filters: Required value(s) of each metadata field
+
+        Returns:
+            The canonical chunks' ids, in order
+        """
+        rows = self._index.rows(filters, self._duplicate_rows)
+        return sorted({self._duplicate_of[self._duplicate_ids[row]] for row in rows})
+
+    def _drop_duplicate(self, duplicate_id: str):
+        """Take a duplicate out of the index, moving the last row into its place."""
+        row = self._duplicate_rows.pop(duplicate_id, None)
+        if row is None:
+            return
+        last = len(self._duplicate_ids) - 1
+        if row != last:
+            moved = self._duplicate_ids[last]
+            self._duplicate_ids[row] = moved
+            self._duplicate_rows[moved] = row
+            self._index.move(last, row)
+        self._duplicate_ids.pop()
+        self._index.truncate(last)
+
+    def forget(self, ids: list[str]) -> set[str]:
+        """
+        Forget chunks that have been removed from the index.
+
+        A forgotten canonical chunk no longer stands in for its duplicates,
+        so their sources need to be indexed again to get them back.
+
+        Args:
+            ids: Ids of the removed chunks (canonical or duplicate)
+
+        Returns:
+            Ids of the duplicates left without their canonical chunk
+        """
+        removed = set(ids)
+        orphaned = set()
+        for chunk_id in ids:
+            self._drop_duplicate(chunk_id)
+            canonical_id = self._duplicate_of.pop(chunk_id, None)
+            if canonical_id in self._canonical and canonical_id not in removed:
+                sources = self._canonical[canonical_id]["sources"]
+                sources[:] = [(sid, source) for sid, source in sources if sid != chunk_id]
+
+        for chunk_id in ids:
+            entry = self._canonical.pop(chunk_id, None)
+            if entry is None:
+                continue
+            del self._exact[entry["digest"]]
+            for key in self._band_keys(entry["signature"]):
+                self._buckets[key].remove(chunk_id)
+                if not self._buckets[key]:
+                    del self._buckets[key]
+            for duplicate_id, _ in entry["sources"][1:]:
+                self._duplicate_of.pop(duplicate_id, None)
+                self._drop_duplicate(duplicate_id)
+                if duplicate_id not in removed:
+                    orphaned.add(duplicate_id)
+        return orphaned
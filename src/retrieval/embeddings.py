@@ -8,9 +8,237 @@ Seattle University, ARIN 5360
 @version: 4.0.0+w26
 """
 
+import hashlib
+import json
+import math
+import os
+import platform
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Literal, Optional
+
 import numpy as np
+from filelock import FileLock
 from sentence_transformers import SentenceTransformer
 
+# Size in bytes of a cache key (a SHA-256 digest of the text)
+_KEY_SIZE = 32
+
+# The int8 ONNX exports published with sentence-transformers models, by the
+# CPUs they are tuned for (others need export_dynamic_quantized_onnx_model)
+_QUANTIZED_ONNX_FILES = {
+    "arm64": "onnx/model_qint8_arm64.onnx",
+    "x86_64": "onnx/model_quint8_avx2.onnx",
+}
+
+
+class EmbeddingCache:
+    """
+    Content-addressed on-disk cache of document embeddings for one model.
+
+    Embeddings are appended as raw float32 rows to one file, which is read
+    through a memory map, and the SHA-256 digest of each row's text is
+    appended to another, so the only thing held in memory is the map from
+    digest to row.
+
+    Several caches (in one process or many) can share a directory: writers
+    take an exclusive lock on a lock file in it to append, and each cache
+    picks up the keys others appended before looking a key up or adding it.
+    """
+
+    def __init__(self, cache_dir: str | Path, model_name: str):
+        """
+        Open (or create) the cache for a model.
+
+        Args:
+            cache_dir: Directory holding the caches of all models
+            model_name: Name of the model whose embeddings are cached
+        """
+        self.directory = Path(cache_dir) / model_name.replace("/", "__")
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._keys_path = self.directory / "keys.bin"
+        self._vectors_path = self.directory / "vectors.f32"
+        self._meta_path = self.directory / "meta.json"
+        self._lock = threading.Lock()
+        # Shuts out other writers, in this process or others
+        self._file_lock = FileLock(self.directory / "cache.lock")
+
+        self.dim: Optional[int] = None
+        self._rows: dict[bytes, int] = {}
+        self._keys_read = 0  # bytes of the keys file read into _rows
+        self._vectors: Optional[np.ndarray] = None
+        with self._file_lock:
+            if self._meta_path.exists():
+                self.dim = json.loads(self._meta_path.read_text())["dim"]
+                # Ignore any partial row left by an interrupted write
+                self._truncate(self._complete_rows())
+                self._refresh()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    @staticmethod
+    def key(text: str) -> bytes:
+        """Return the cache key for a text."""
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _complete_rows(self) -> int:
+        """Return the number of rows with both their key and their vector written."""
+        assert self.dim is not None
+        keys_bytes = self._keys_path.stat().st_size if self._keys_path.exists() else 0
+        vector_bytes = self._vectors_path.stat().st_size if self._vectors_path.exists() else 0
+        return min(keys_bytes // _KEY_SIZE, vector_bytes // (4 * self.dim))
+
+    def _truncate(self, num_rows: int):
+        """Cut both files back to the given number of rows (holding the file lock)."""
+        assert self.dim is not None
+        for path, row_size in ((self._keys_path, _KEY_SIZE), (self._vectors_path, 4 * self.dim)):
+            with open(path, "ab") as f:
+                f.truncate(num_rows * row_size)
+
+    def _refresh(self):
+        """Read the keys appended (by any writer) since the last read."""
+        if self.dim is None:
+            if not self._meta_path.exists():
+                return
+            self.dim = json.loads(self._meta_path.read_text())["dim"]
+        # Vectors are written before their keys, so every complete key has its row
+        num_rows = self._complete_rows()
+        first = self._keys_read // _KEY_SIZE
+        if num_rows <= first:
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._keys_read)
+            keys = f.read((num_rows - first) * _KEY_SIZE)
+        for i in range(len(keys) // _KEY_SIZE):
+            self._rows.setdefault(keys[i * _KEY_SIZE : (i + 1) * _KEY_SIZE], first + i)
+        self._keys_read += len(keys) // _KEY_SIZE * _KEY_SIZE
+
+    def get(self, keys: list[bytes]) -> tuple[list[int], Optional[np.ndarray]]:
+        """
+        Look up cached embeddings.
+
+        Returns:
+            Tuple of the positions (in keys) that were found and their
+            embeddings (None if none were found)
+        """
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._refresh()
+            found = [i for i, key in enumerate(keys) if key in self._rows]
+            if not found:
+                return [], None
+            rows = [self._rows[keys[i]] for i in found]
+            assert self.dim is not None
+            if self._vectors is None or self._vectors.shape[0] <= max(rows):
+                vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r")
+                self._vectors = vectors.reshape(-1, self.dim)
+            return found, np.array(self._vectors[rows])
+
+    def put(self, keys: list[bytes], embeddings: np.ndarray):
+        """Append embeddings (one row per key) that aren't cached yet."""
+        with self._lock, self._file_lock:
+            self._refresh()
+            if self.dim is None:
+                self.dim = int(embeddings.shape[1])
+                self._meta_path.write_text(json.dumps({"dim": self.dim}))
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(
+                    f"Got {embeddings.shape[1]}-dimensional embeddings, not {self.dim}."
+                )
+            new_rows = {}
+            for i, key in enumerate(keys):
+                if key not in self._rows and key not in new_rows:
+                    new_rows[key] = i
+            if not new_rows:
+                return
+
+            # Number the rows from the files, dropping any partial row a
+            # writer left behind, and write the vectors before the keys
+            num_rows = self._complete_rows()
+            self._truncate(num_rows)
+            vectors = np.ascontiguousarray(embeddings[list(new_rows.values())], dtype=np.float32)
+            with open(self._vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self._keys_path, "ab") as f:
+                f.write(b"".join(new_rows))
+            self._refresh()
+
+
+class QueryCache:
+    """
+    Thread-safe LRU cache of query embeddings, with an optional time to live
+    and hit/miss counters.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        """
+        Initialize cache.
+
+        Args:
+            max_size: Maximum number of queries to keep (0 disables caching)
+            ttl: Seconds an embedding stays valid (forever if None)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        """Return the cached embedding of a query, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(query)
+            if (
+                entry is not None
+                and self.ttl is not None
+                and time.monotonic() - entry[0] > self.ttl
+            ):
+                del self._entries[query]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(query)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query: str, embedding: np.ndarray):
+        """Cache a query's embedding, evicting the least recently used."""
+        if self.max_size <= 0:
+            return
+        # Shared between callers, so don't let any of them change it
+        embedding.setflags(write=False)
+        with self._lock:
+            self._entries[query] = (time.monotonic(), embedding)
+            self._entries.move_to_end(query)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def info(self) -> dict:
+        """Return the hit and miss counts and the current and maximum size."""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+            }
+
 
 class DocumentEmbedder:
     """
@@ -20,20 +248,279 @@ class DocumentEmbedder:
     speed and quality for semantic search applications.
     """
 
-    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
-        """Initialize embedder with the specified model."""
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        cache_dir: Optional[str] = None,
+        query_cache_size: int = 1024,
+        query_cache_ttl: Optional[float] = None,
+        batch_size: int = 32,
+        max_batch_tokens: int = 8192,
+        normalize: bool = False,
+        backend: str = "torch",
+        quantized: bool = False,
+    ):
+        """
+        Initialize embedder with the specified model.
+
+        Args:
+            model_name: Name of the sentence transformers model to use
+            backend: Run the model with "torch" or with ONNX Runtime ("onnx",
+                which needs the onnx extra installed)
+            cache_dir: Directory for a persistent cache of document embeddings
+                (no caching if None)
+            query_cache_size: Number of query embeddings to keep in memory
+                (0 disables the query cache)
+            query_cache_ttl: Seconds a cached query embedding stays valid
+                (forever if None)
+            batch_size: Maximum number of texts per batch
+            max_batch_tokens: Maximum tokens per batch, counting the padding
+                of each text to the longest in its batch
+            normalize: Scale embeddings to unit length
+            quantized: Use the int8-quantized ONNX model (onnx backend only)
+        """
+        if backend not in ("torch", "onnx"):
+            raise ValueError(f"Unknown backend '{backend}', expected 'torch' or 'onnx'.")
+        if quantized and backend != "onnx":
+            raise ValueError("Only the onnx backend can run a quantized model.")
+
+        # Narrowed for SentenceTransformer, which only takes its own backend names
+        model_backend: Literal["torch", "onnx"] = "onnx" if backend == "onnx" else "torch"
+        model_kwargs = None
+        if quantized:
+            machine = "arm64" if platform.machine().lower() in ("arm64", "aarch64") else "x86_64"
+            model_kwargs = {"file_name": _QUANTIZED_ONNX_FILES[machine]}
         self.model_name = model_name
-        self.model = SentenceTransformer(model_name)
+        self.backend = backend
+        self.quantized = quantized
+        self.model = SentenceTransformer(
+            model_name, backend=model_backend, model_kwargs=model_kwargs
+        )
+
+        # Other backends' embeddings differ slightly, so they're cached apart
+        self.model_id = model_name
+        if backend != "torch":
+            self.model_id += f"-{backend}" + ("-int8" if quantized else "")
+        # Normalized embeddings are cached apart from the model's raw ones
+        cache_name = self.model_id + ("-normalized" if normalize else "")
+        self.cache = EmbeddingCache(cache_dir, cache_name) if cache_dir else None
+
+        # Worker processes for bulk embedding, while in bulk mode
+        self._pool: Optional[dict] = None
+        self.pool_size = 0
+        self.query_cache = QueryCache(query_cache_size, query_cache_ttl)
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.normalize = normalize
+
+    @property
+    def tokenizer(self):
+        """Return the model's tokenizer."""
+        return self.model.tokenizer
+
+    @property
+    def max_tokens(self) -> int:
+        """Return how many tokens of a text the model sees before truncating it."""
+        num_special_tokens = len(self.tokenizer("")["input_ids"])
+        return self.model.max_seq_length - num_special_tokens
+
+    def _batches(self, texts: list[str]) -> list[list[int]]:
+        """
+        Group texts of similar token length into batches under the token budget.
+
+        Returns:
+            Indices (into texts) of each batch, longest texts first
+        """
+        max_length = self.model.max_seq_length
+        encoded = self.tokenizer(texts, truncation=True, max_length=max_length)
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        batches: list[list[int]] = []
+        batch: list[int] = []
+        for i in sorted(range(len(texts)), key=lambda i: -lengths[i]):
+            # Every text in a batch is padded to its longest (first) text
+            if batch and (
+                len(batch) == self.batch_size
+                or (len(batch) + 1) * lengths[batch[0]] > self.max_batch_tokens
+            ):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def start_pool(self, processes: Optional[int] = None):
+        """
+        Start worker processes, each with its own copy of the model, that
+        embed documents until stop_pool is called.
+
+        Args:
+            processes: Number of workers (one per CPU if None)
+        """
+        if self._pool is not None:
+            return
+        self.pool_size = processes or os.cpu_count() or 1
+        self._pool = self.model.start_multi_process_pool(["cpu"] * self.pool_size)
+
+    def stop_pool(self):
+        """Stop the worker processes."""
+        if self._pool is None:
+            return
+        self.model.stop_multi_process_pool(self._pool)
+        self._pool = None
+        self.pool_size = 0
+
+    @contextmanager
+    def bulk(self, processes: Optional[int] = None) -> Iterator[None]:
+        """
+        Embed documents with a pool of worker processes within the block.
+
+        Args:
+            processes: Number of workers (one per CPU if None)
+        """
+        started = self._pool is None
+        self.start_pool(processes)
+        try:
+            yield
+        finally:
+            if started:
+                self.stop_pool()
+
+    def _encode(self, texts: list[str], pool: Optional[dict] = None) -> np.ndarray:
+        """
+        Run the model on texts in length-bucketed batches, keeping their order.
+
+        Args:
+            texts: Texts to embed
+            pool: Worker process pool to spread the batches across
+        """
+        if not texts:
+            return self.model.encode(texts, show_progress_bar=False)
+
+        dim = self.model.get_sentence_embedding_dimension()
+        if dim is None:
+            raise ValueError(f"Model '{self.model_name}' doesn't report its embedding dimension.")
+        embeddings = np.empty((len(texts), dim), dtype=np.float32)
+        batches = self._batches(texts)
+        if pool is not None:
+            # Each worker gets a run of similar-length texts, which it batches
+            order = [i for batch in batches for i in batch]
+            embeddings[order] = self.model.encode(
+                [texts[i] for i in order],
+                pool=pool,
+                chunk_size=max(self.batch_size, math.ceil(len(texts) / self.pool_size)),
+                batch_size=self.batch_size,
+                normalize_embeddings=self.normalize,
+                show_progress_bar=False,
+            )
+            return embeddings
+
+        for batch in batches:
+            batch_embeddings = self.model.encode(
+                [texts[i] for i in batch],
+                batch_size=len(batch),
+                normalize_embeddings=self.normalize,
+                show_progress_bar=False,
+            )
+            embeddings[batch] = batch_embeddings
+        return embeddings
 
     def embed_documents(self, texts: list[str]) -> np.ndarray:
-        """Generate embeddings for multiple documents."""
-        return self.model.encode(texts, show_progress_bar=False)
+        """
+        Generate embeddings for multiple documents.
+
+        With a cache, only the texts that aren't cached are sent to the model.
+        In bulk mode, the model runs in the pool of worker processes.
+        """
+        if self.cache is None or not texts:
+            return self._encode(texts, self._pool)
+
+        keys = [self.cache.key(text) for text in texts]
+        found, cached = self.cache.get(keys)
+        if cached is not None and len(found) == len(texts):
+            return cached
+
+        # Embed each distinct missing text once
+        found_set = set(found)
+        missing = {keys[i]: texts[i] for i in range(len(texts)) if i not in found_set}
+        missing_keys = list(missing)
+        computed = self._encode(list(missing.values()), self._pool)
+        self.cache.put(missing_keys, computed)
+
+        embeddings = np.empty((len(texts), computed.shape[1]), dtype=computed.dtype)
+        if cached is not None:
+            embeddings[found] = cached
+        row_of = {key: row for row, key in enumerate(missing_keys)}
+        missed = [i for i in range(len(texts)) if i not in found_set]
+        embeddings[missed] = computed[[row_of[keys[i]] for i in missed]]
+        return embeddings
 
     def embed_query(self, queries: str | list[str]) -> np.ndarray:
-        """Generate embedding for a single query."""
+        """
+        Generate embedding for a single query (or one per query in a list).
+
+        Repeated queries are answered from the query cache without running
+        the model.
+        """
         if isinstance(queries, str):
-            queries = [queries]
-            results = self.embed_documents(queries)
-            return results[0]
-        else:
-            return self.embed_documents(queries)
+            return self.embed_query([queries])[0]
+
+        if not queries:
+            return self._encode(queries)
+
+        embeddings: dict[str, np.ndarray] = {}
+        missing = []
+        for query in dict.fromkeys(queries):
+            embedding = self.query_cache.get(query)
+            if embedding is None:
+                missing.append(query)
+            else:
+                embeddings[query] = embedding
+        if missing:
+            for query, embedding in zip(missing, self._encode(missing)):
+                self.query_cache.put(query, embedding)
+                embeddings[query] = embedding
+        return np.stack([embeddings[query] for query in queries])
+
+    def cache_info(self) -> dict:
+        """Return the query cache's hit and miss counts and size."""
+        return self.query_cache.info()
+
+
+def embedding_parity(
+    reference: DocumentEmbedder, candidate: DocumentEmbedder, texts: list[str]
+) -> dict:
+    """
+    Check that a candidate embedder (e.g. a quantized ONNX one) agrees with
+    a reference embedder (e.g. the PyTorch one) on a sample of texts.
+
+    Args:
+        reference: Embedder to compare against
+        candidate: Embedder being checked
+        texts: Sample texts (at least two), ideally chunks of the corpus
+
+    Returns:
+        Dict with the 'min_cosine' and 'mean_cosine' similarity between the
+        two embeddings of each text, and 'neighbor_agreement', the fraction
+        of texts whose most similar other text is the same under both
+    """
+    if len(texts) < 2:
+        raise ValueError("Parity needs at least two texts.")
+
+    def unit(embeddings: np.ndarray) -> np.ndarray:
+        return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    expected = unit(reference.embed_documents(texts))
+    actual = unit(candidate.embed_documents(texts))
+    cosines = np.sum(expected * actual, axis=1)
+
+    def nearest(embeddings: np.ndarray) -> np.ndarray:
+        similarities = embeddings @ embeddings.T
+        np.fill_diagonal(similarities, -np.inf)
+        return similarities.argmax(axis=1)
+
+    return {
+        "min_cosine": float(cosines.min()),
+        "mean_cosine": float(cosines.mean()),
+        "neighbor_agreement": float(np.mean(nearest(expected) == nearest(actual))),
+    }
@@ -0,0 +1,267 @@
+"""
+Metadata filters for restricting searches to some of the chunks.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+from collections.abc import Iterable, Mapping
+from typing import Optional
+
+import numpy as np
+
+# Filters map a metadata field (e.g., 'type', 'filename', or 'doc_id') to a
+# value it must equal, or to a list of values it must be one of; '$or' maps
+# to a list of filters, at least one of which must match too, and 'id' to
+# the chunk's own id (rather than to a metadata field)
+Filters = dict[str, str | int | float | bool | list]
+
+
+def validate(filters: Optional[Filters]) -> Optional[Filters]:
+    """
+    Check that filters are well formed.
+
+    Returns:
+        The filters, or None if there are none
+    """
+    if not filters:
+        return None
+    for field, value in filters.items():
+        if field == "$or":
+            if not isinstance(value, list) or not value:
+                raise ValueError("'$or' must be a list of at least one filter.")
+            for alternative in value:
+                if not isinstance(alternative, dict) or not alternative:
+                    raise ValueError("'$or' must be a list of non-empty filters.")
+                validate(alternative)
+            continue
+        values = value if isinstance(value, list) else [value]
+        if not values:
+            raise ValueError(f"Filter on '{field}' must allow at least one value.")
+        if not all(isinstance(v, (str, int, float, bool)) for v in values):
+            raise ValueError(f"Filter on '{field}' must be a value or a list of values.")
+    return filters
+
+
+def build_where(filters: Optional[Filters]) -> Optional[dict]:
+    """
+    Translate filters into a ChromaDB where clause.
+
+    Args:
+        filters: Required value(s) of each metadata field
+
+    Returns:
+        The where clause, or None if there are no filters
+    """
+    filters = validate(filters)
+    if filters is None:
+        return None
+    clauses: list[dict] = []
+    for field, value in filters.items():
+        if field == "$or" and isinstance(value, list):
+            alternatives = [build_where(alternative) or {} for alternative in value]
+            clauses.append(alternatives[0] if len(alternatives) == 1 else {"$or": alternatives})
+        elif field == "id":
+            # Where clauses only see metadata; ids are passed to ChromaDB apart
+            raise ValueError("A where clause can't filter on 'id'.")
+        else:
+            clauses.append({field: {"$in": value} if isinstance(value, list) else {"$eq": value}})
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+def matches(metadata: dict, filters: Optional[Filters], chunk_id: Optional[str] = None) -> bool:
+    """Return whether a chunk's metadata (and id) satisfies the filters."""
+    if not filters:
+        return True
+    for field, value in filters.items():
+        if field == "$or" and isinstance(value, list):
+            if not any(matches(metadata, alternative, chunk_id) for alternative in value):
+                return False
+            continue
+        if field == "id":
+            if chunk_id not in (value if isinstance(value, list) else [value]):
+                return False
+            continue
+        if field not in metadata:
+            return False
+        if isinstance(value, list):
+            if metadata[field] not in value:
+                return False
+        elif metadata[field] != value:
+            return False
+    return True
+
+
+class _Column:
+    """One metadata field's value in each row, as a code for each distinct value."""
+
+    def __init__(self, values=(), codes: Optional[np.ndarray] = None):
+        self.values = {value: code for code, value in enumerate(values)}
+        self.codes = np.empty(0, dtype=np.int32) if codes is None else codes  # -1 if missing
+        self.lists: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def reserve(self, count: int):
+        """Make room for count rows, growing geometrically (and copying read-only codes)."""
+        if count > len(self.codes) or not self.codes.flags.writeable:
+            grown = np.full(max(count, 2 * len(self.codes)), -1, dtype=np.int32)
+            grown[: len(self.codes)] = self.codes
+            self.codes = grown
+
+    def lookup(self, values: list) -> np.ndarray:
+        """Return the codes of those of the values that occur."""
+        return np.array([self.values[v] for v in values if v in self.values], dtype=np.int32)
+
+    def size(self, codes: np.ndarray, count: int) -> int:
+        """Return the number of rows with any of the codes."""
+        _, starts = self._inverted_lists(count)
+        return int((starts[codes + 1] - starts[codes]).sum())
+
+    def rows(self, codes: np.ndarray, count: int) -> np.ndarray:
+        """Return the rows with any of the codes, in order."""
+        order, starts = self._inverted_lists(count)
+        rows = [order[starts[code] : starts[code + 1]] for code in codes]
+        return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.intp)
+
+    def _inverted_lists(self, count: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows ordered by code, and where each code's rows start."""
+        if self.lists is None:
+            codes = self.codes[:count]
+            order = np.argsort(codes, kind="stable")
+            starts = np.searchsorted(codes[order], np.arange(len(self.values) + 1))
+            self.lists = (order, starts)
+        return self.lists
+
+
+class MetadataIndex:
+    """
+    The rows of a store's chunks by the value of each metadata field, for
+    finding the chunks that match filters without testing each chunk's
+    metadata in turn.
+
+    Each field's value in each row is kept as an integer code in a NumPy
+    array, updated as rows are added, moved, and removed. The rows with
+    each code are found by sorting those arrays, lazily, after a change.
+    Values that can't be hashed (e.g., lists) never match, as in matches.
+    """
+
+    def __init__(self, count: int = 0, fields: Optional[dict[str, tuple[list, np.ndarray]]] = None):
+        """
+        Initialize the index, empty or with fields returned by export_state.
+
+        Args:
+            count: Number of rows in the fields
+            fields: Each field's distinct values, and the code (index) of
+                its value in each row, or -1 if it's missing
+        """
+        self._count = count
+        self._columns = {
+            field: _Column(values, codes) for field, (values, codes) in (fields or {}).items()
+        }
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, metadatas: Iterable[dict]):
+        """Add rows with the given metadata after the others."""
+        metadatas = list(metadatas)
+        start, end = self._count, self._count + len(metadatas)
+        for column in self._columns.values():
+            column.reserve(end)
+            column.codes[start:end] = -1
+        for row, metadata in enumerate(metadatas, start):
+            for field, value in metadata.items():
+                if field not in self._columns:
+                    self._columns[field] = _Column()
+                    self._columns[field].reserve(end)
+                column = self._columns[field]
+                try:
+                    column.codes[row] = column.values.setdefault(value, len(column.values))
+                except TypeError:
+                    pass
+        self._changed(end)
+
+    def move(self, source: int, destination: int):
+        """Give a row the metadata of another."""
+        for column in self._columns.values():
+            column.reserve(self._count)
+            column.codes[destination] = column.codes[source]
+        self._changed(self._count)
+
+    def truncate(self, count: int):
+        """Remove the rows after the first count."""
+        self._changed(min(count, self._count))
+
+    def keep(self, rows: np.ndarray):
+        """Keep just the given rows, in the given order."""
+        for column in self._columns.values():
+            column.codes = column.codes[rows]
+        self._changed(len(rows))
+
+    def rows(self, filters: Filters, id_rows: Optional[Mapping[str, int]] = None) -> np.ndarray:
+        """
+        Find the rows whose metadata matches filters.
+
+        The rows of the field with the fewest matching rows are looked up,
+        and only those rows' codes in the other fields are checked.
+
+        Args:
+            filters: Required value(s) of each metadata field
+            id_rows: The row of each chunk id, for filters on 'id' (which
+                match nothing without it)
+
+        Returns:
+            The matching rows, in order
+        """
+        candidates: Optional[np.ndarray] = None
+        conditions = []
+        for field, value in filters.items():
+            if field == "$or" and isinstance(value, list):
+                found_rows = np.unique(
+                    np.concatenate([self.rows(alternative, id_rows) for alternative in value])
+                )
+            elif field == "id":
+                ids = value if isinstance(value, list) else [value]
+                found_rows = np.unique(
+                    np.array([id_rows[i] for i in ids if i in id_rows], dtype=np.intp)
+                    if id_rows is not None
+                    else np.empty(0, dtype=np.intp)
+                )
+            else:
+                found_rows = None
+            if found_rows is not None:
+                candidates = (
+                    found_rows if candidates is None else np.intersect1d(candidates, found_rows)
+                )
+                continue
+            found = self._columns.get(field)
+            if found is None:
+                return np.empty(0, dtype=np.intp)
+            codes = found.lookup(value if isinstance(value, list) else [value])
+            if not len(codes):
+                return np.empty(0, dtype=np.intp)
+            conditions.append((found.size(codes, self._count), found, codes))
+
+        conditions.sort(key=lambda condition: condition[0])
+        if candidates is None:
+            if not conditions:
+                return np.arange(self._count)
+            _, column, codes = conditions.pop(0)
+            candidates = column.rows(codes, self._count)
+        for _, column, codes in conditions:
+            candidates = candidates[np.isin(column.codes[candidates], codes)]
+        return candidates
+
+    def export_state(self) -> dict[str, tuple[list, np.ndarray]]:
+        """Return each field's distinct values and the code of its value in each row."""
+        return {
+            field: (list(column.values), column.codes[: self._count])
+            for field, column in self._columns.items()
+        }
+
+    def _changed(self, count: int):
+        """Set the number of rows, and have the rows of each code found again."""
+        self._count = count
+        for column in self._columns.values():
+            column.lists = None
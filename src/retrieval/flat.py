@@ -0,0 +1,549 @@
+"""
+Vector store keeping embeddings in flat NumPy arrays.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import shutil
+import tempfile
+import threading
+import weakref
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from retrieval.filters import Filters, MetadataIndex, validate
+from retrieval.snapshot import SnapshotDocuments
+
+# Rows scored at a time, so the compact codes are never upcast all at once
+_SCORE_BLOCK_ROWS = 65536
+
+# Rows imported from or copied out of a snapshot at a time, bounding the copy in memory
+_IMPORT_BLOCK_ROWS = 65536
+
+
+class FlatVectorStore:
+    """
+    Manages document storage and retrieval with normalized embeddings in
+    one contiguous array, searched exactly by a matrix-vector product and
+    argpartition rather than through an approximate index.
+
+    At float32 precision the vectors are searched as they are, either
+    from memory or straight from a memory map of a file on disk.
+    Embeddings can instead be held compactly in memory, as float16 or as
+    int8 with a float32 scale per vector; searches then score every
+    vector at that precision and rescore the best candidates against the
+    full-precision float32 vectors, kept in a file on disk for that. A
+    store holding float32 vectors in memory keeps no file. Distances are
+    cosine distances.
+
+    Searches only hold the lock to find the rows to score and to read the
+    results, so concurrent searches score in parallel. Adding documents
+    only writes past the rows a search is scoring; removing them moves
+    rows, so a search that overlapped a removal is scored again, and the
+    vectors file is only cut short once no search is reading it.
+    """
+
+    def __init__(
+        self,
+        embedder,
+        precision: str = "float32",
+        rescore_factor: int = 4,
+        directory: Optional[str] = None,
+        memory_map: bool = False,
+    ):
+        """
+        Initialize vector store with an embedder.
+
+        Args:
+            embedder: DocumentEmbedder instance for generating vectors
+            precision: In-memory precision of the embeddings: "float32" for
+                exact scores, or "float16" or "int8" to hold them compactly
+            rescore_factor: Rescore this many candidates per result at full
+                precision (compact precisions only)
+            directory: Directory for the full-precision vectors file, if
+                one is kept (a temporary directory, removed with the store,
+                if None)
+            memory_map: Search the float32 vectors straight from the file,
+                leaving it to the OS to page them in (float32 only)
+        """
+        if precision not in ("float32", "float16", "int8"):
+            raise ValueError(
+                f"Unknown precision '{precision}', expected 'float32', 'float16', or 'int8'."
+            )
+        if memory_map and precision != "float32":
+            raise ValueError("Only float32 vectors can be searched from a memory map.")
+        self.embedder = embedder
+        self.precision = precision
+        self.rescore_factor = rescore_factor
+        self.memory_map = memory_map
+
+        # The float32 vectors only need a file to be memory-mapped or rescored
+        # from; otherwise the in-memory codes are the vectors
+        self._vectors_path: Optional[Path] = None
+        if memory_map or precision != "float32":
+            if directory is None:
+                directory = tempfile.mkdtemp(prefix="flat-store-")
+                weakref.finalize(self, shutil.rmtree, directory, ignore_errors=True)
+            Path(directory).mkdir(parents=True, exist_ok=True)
+            self._vectors_path = Path(directory) / "vectors.f32"
+            self._vectors_path.write_bytes(b"")
+        self._vectors: Optional[np.ndarray] = None  # memory map of the file
+        self._file_rows = 0  # rows in the file, past the stored ones if not yet cut off
+        self._dim = 0
+        self._adopted: Optional[np.ndarray] = None  # a snapshot's vectors, until changed
+
+        self._lock = threading.RLock()
+        self._ids: list[str] = []
+        self._rows: dict[str, int] = {}
+        self._texts: list[str] = []
+        self._metadatas: list[dict] = []
+        self._index = MetadataIndex()  # the rows with each metadata value, for filters
+        self._codes: Optional[np.ndarray] = None  # in-memory vectors (with spare capacity)
+        self._scales = np.empty(0, dtype=np.float32)  # int8 only
+        self._removals = 0  # times rows were removed (moving others)
+        self._searches = 0  # searches scoring outside the lock
+
+    def _encode(self, embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Convert unit float32 vectors to in-memory codes (and per-vector scales)."""
+        if self.precision != "int8":
+            return embeddings.astype(self.precision), np.empty(0, dtype=np.float32)
+        scales = np.abs(embeddings).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @staticmethod
+    def _normalize(embeddings: np.ndarray) -> np.ndarray:
+        """Scale vectors to unit length, so dot products are cosines."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        return embeddings / np.where(norms == 0, 1, norms)
+
+    def _full_vectors(self) -> np.ndarray:
+        """Return the full-precision vectors (a memory map of the file, if kept in one)."""
+        if self._adopted is not None:
+            return self._adopted
+        count = len(self._ids)
+        if self._vectors_path is None:
+            if self._codes is None:
+                return np.empty((0, 0), dtype=np.float32)
+            return self._codes[:count]
+        if self._vectors is None or self._vectors.shape[0] != count:
+            self._vectors = np.memmap(
+                self._vectors_path, dtype=np.float32, mode="r+", shape=(count, self._dim)
+            )
+        return self._vectors
+
+    def _own_vectors(self) -> np.ndarray:
+        """
+        Copy the vectors adopted from a snapshot to the store's file, and
+        its texts and metadata to the store's lists, to change them.
+        """
+        adopted, self._adopted = self._adopted, None
+        if adopted is not None:
+            assert self._vectors_path is not None
+            # Overwrite rather than truncate, in case a search still reads the file
+            with open(self._vectors_path, "r+b") as f:
+                for start in range(0, len(adopted), _IMPORT_BLOCK_ROWS):
+                    f.write(
+                        np.ascontiguousarray(adopted[start : start + _IMPORT_BLOCK_ROWS]).tobytes()
+                    )
+            self._vectors = None
+            self._file_rows = max(self._file_rows, len(adopted))
+            self._texts = self._own_texts(self._texts)
+            self._metadatas = list(self._metadatas)
+        return self._full_vectors()
+
+    def _own_texts(self, texts) -> list[str]:
+        """Copy texts adopted from a snapshot to where the store keeps its texts."""
+        return list(texts)
+
+    def add_documents(self, documents, embeddings: Optional[np.ndarray] = None):
+        """
+        Add documents to the vector store.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+            embeddings: Their embeddings, one row per document, if already
+                computed (otherwise the embedder is run on their texts)
+
+        Raises:
+            ValueError: If an id is already stored, or repeated in documents
+                (upsert_documents replaces documents)
+        """
+        if not documents:
+            return
+        ids = [d["id"] for d in documents]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Expected the documents' ids to be unique.")
+
+        if embeddings is None:
+            embeddings = self.embedder.embed_documents([d["text"] for d in documents])
+        elif len(embeddings) != len(documents):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(documents)} documents.")
+        embeddings = self._normalize(embeddings)
+        codes, scales = self._encode(embeddings)
+        if self.memory_map:
+            codes = codes[:, :0]  # nothing to hold in memory
+        with self._lock:
+            stored = [i for i in ids if i in self._rows]
+            if stored:
+                raise ValueError(f"Documents already stored: {', '.join(stored[:5])}.")
+
+            start = len(self._ids)
+            end = start + len(documents)
+            if self._codes is None:
+                self._codes = np.empty((0, codes.shape[1]), dtype=codes.dtype)
+            if end > len(self._codes):
+                # Grow geometrically so adding in batches stays linear
+                grown = np.empty((max(end, 2 * len(self._codes)), codes.shape[1]), codes.dtype)
+                grown[:start] = self._codes[:start]
+                self._codes = grown
+                if self.precision == "int8":
+                    self._scales = np.resize(self._scales, len(grown))
+            self._codes[start:end] = codes
+            if self.precision == "int8":
+                self._scales[start:end] = scales
+
+            if self._adopted is not None:
+                self._own_vectors()
+            self._dim = embeddings.shape[1]
+            if self._vectors_path is not None:
+                # Overwrite any rows not cut off yet, which no search reads anymore
+                with open(self._vectors_path, "r+b") as f:
+                    f.seek(start * self._dim * 4)
+                    f.write(embeddings.tobytes())
+                self._file_rows = max(self._file_rows, end)
+            for i, doc in enumerate(documents):
+                self._rows[doc["id"]] = start + i
+                self._ids.append(doc["id"])
+                self._texts.append(doc["text"])
+                self._metadatas.append(doc["metadata"])
+            self._index.append(doc["metadata"] for doc in documents)
+
+    def delete_documents(self, ids: list[str]):
+        """
+        Remove documents from the vector store.
+
+        Args:
+            ids: Ids of the documents to remove (unknown ids are ignored)
+        """
+        with self._lock:
+            rows = [self._rows.pop(i) for i in ids if i in self._rows]
+            if not rows:
+                return
+            self._removals += 1
+            assert self._codes is not None
+            vectors = self._full_vectors()
+
+            # Fill each hole with the last row, so the arrays stay contiguous
+            last = len(self._ids) - 1
+            for row in sorted(rows, reverse=True):
+                if row != last:
+                    if self._adopted is not None:
+                        vectors = self._own_vectors()
+                    moved = self._ids[last]
+                    self._rows[moved] = row
+                    self._ids[row] = moved
+                    self._texts[row] = self._texts[last]
+                    self._metadatas[row] = self._metadatas[last]
+                    self._index.move(last, row)
+                    self._codes[row] = self._codes[last]
+                    if self.precision == "int8":
+                        self._scales[row] = self._scales[last]
+                    if self._vectors_path is not None:
+                        vectors[row] = vectors[last]
+                last -= 1
+
+            count = last + 1
+            del self._ids[count:]
+            self._index.truncate(count)
+            if self._adopted is not None:
+                # Only the last rows were removed, so the snapshot's still serve
+                self._adopted = self._adopted[:count]
+                self._texts, self._metadatas = self._texts[:count], self._metadatas[:count]
+                if not count:
+                    self._own_vectors()
+                return
+            del self._texts[count:], self._metadatas[count:]
+
+            del vectors
+            self._vectors = None
+            self._cut_off_file()
+
+    def _cut_off_file(self):
+        """Cut the rows that were moved off the vectors file, unless a search may read them."""
+        count = len(self._ids)
+        if self._searches or self._adopted is not None or self._file_rows <= count:
+            return
+        assert self._vectors_path is not None
+        with open(self._vectors_path, "r+b") as f:
+            f.truncate(count * self._dim * 4)
+        self._file_rows = count
+
+    def upsert_documents(self, documents, embeddings: Optional[np.ndarray] = None):
+        """
+        Add documents, replacing every chunk already stored for their doc_ids.
+
+        The documents must be all of the chunks of each doc_id in them, so
+        chunks left over from an earlier, longer version are removed.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+            embeddings: Their embeddings, one row per document, if already
+                computed (otherwise the embedder is run on their texts)
+        """
+        if not documents:
+            return
+        doc_ids = {doc["metadata"]["doc_id"] for doc in documents}
+        with self._lock:
+            rows = self._index.rows({"doc_id": list(doc_ids)})
+            replaced = [self._ids[row] for row in rows] + [doc["id"] for doc in documents]
+            self.delete_documents(replaced)
+            self.add_documents(documents, embeddings)
+
+    def delete_document(self, doc_id: str):
+        """
+        Remove every chunk of a document from the vector store.
+
+        Args:
+            doc_id: The document's doc_id metadata (unknown ones are ignored)
+        """
+        with self._lock:
+            self.delete_documents([self._ids[row] for row in self._index.rows({"doc_id": doc_id})])
+
+    def export_state(self) -> tuple[list[dict], dict[str, np.ndarray]]:
+        """
+        Return every document with its embedding, for a snapshot.
+
+        Returns:
+            List of dicts with 'id', 'text', and 'metadata', and a dict with
+            their 'unit_embeddings' (normalized, and a memory map if kept in
+            a file), one row per document
+        """
+        with self._lock:
+            documents = [
+                {"id": id_, "text": text, "metadata": metadata}
+                for id_, text, metadata in zip(self._ids, self._texts, self._metadatas)
+            ]
+            if not documents:
+                return documents, {"unit_embeddings": np.empty((0, 0), dtype=np.float32)}
+            return documents, {"unit_embeddings": self._full_vectors()}
+
+    def import_state(self, documents: Sequence[dict], arrays: dict[str, np.ndarray]):
+        """
+        Replace the contents of the store with a snapshot's, without embedding.
+
+        A store searching its vectors from a memory map adopts a snapshot's
+        normalized embeddings as they are, so it's ready once it has read
+        the ids: it searches the vectors straight from the snapshot's memory
+        map, reads the texts and metadata of the results from there too,
+        and only copies them to its own file and lists when they first
+        change. Otherwise the embeddings are normalized and copied in, and
+        encoded at the store's precision.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata', or a
+                snapshot's SnapshotDocuments
+            arrays: Dict with their 'embeddings', or 'unit_embeddings' if
+                normalized, one row per document
+        """
+        unit = arrays.get("unit_embeddings")
+        embeddings = arrays["embeddings"] if unit is None else unit
+        with self._lock:
+            self.clear()
+            if self.memory_map and unit is not None and len(documents):
+                if isinstance(documents, SnapshotDocuments):
+                    self._ids = list(documents.ids)
+                    self._texts = documents.texts  # type: ignore[assignment]
+                    self._metadatas = documents.metadatas  # type: ignore[assignment]
+                    self._index = documents.metadata_index()
+                else:
+                    self._ids = [doc["id"] for doc in documents]
+                    self._texts = [doc["text"] for doc in documents]
+                    self._metadatas = [doc["metadata"] for doc in documents]
+                    self._index.append(self._metadatas)
+                self._rows = {id_: row for row, id_ in enumerate(self._ids)}
+                self._codes = np.empty((len(documents), 0), dtype=np.float32)
+                self._adopted = unit
+                self._dim = unit.shape[1]
+                self._removals += 1
+                return
+
+            for start in range(0, len(documents), _IMPORT_BLOCK_ROWS):
+                end = start + _IMPORT_BLOCK_ROWS
+                # Just the rows, even in subclasses that index them as they're added
+                FlatVectorStore.add_documents(self, documents[start:end], embeddings[start:end])
+
+    def clear(self):
+        """Remove every document."""
+        with self._lock:
+            self.delete_documents(list(self._ids))
+
+    def search(
+        self,
+        query: str,
+        n_results: int = 5,
+        query_embedding=None,
+        filters: Optional[Filters] = None,
+    ):
+        """
+        Search for documents similar to the query.
+
+        Args:
+            query: Search query text
+            n_results: Number of results to return
+            query_embedding: The query's embedding, if already computed
+            filters: Only search documents whose metadata matches these
+
+        Returns:
+            List of result dicts with 'id', 'text', 'distance', and 'metadata'
+        """
+        embeddings = None if query_embedding is None else [query_embedding]
+        return self.search_many([query], n_results, embeddings, filters)[0]
+
+    def search_many(
+        self,
+        queries: list[str],
+        n_results: int = 5,
+        query_embeddings=None,
+        filters: Optional[Filters] = None,
+    ):
+        """
+        Search for documents similar to each of several queries, embedding
+        them in one pass and scoring them all with one matrix product.
+
+        Args:
+            queries: Search query texts
+            n_results: Number of results to return per query
+            query_embeddings: The queries' embeddings, if already computed
+            filters: Only search documents whose metadata matches these
+
+        Returns:
+            List with a list of result dicts per query, each with 'id',
+            'text', 'distance', and 'metadata'
+        """
+        if not queries:
+            return []
+        filters = validate(filters)
+        if query_embeddings is None:
+            query_embeddings = self.embedder.embed_query(queries)
+        query_embeddings = self._normalize(np.asarray(query_embeddings).reshape(len(queries), -1))
+        while True:
+            with self._lock:
+                count = len(self._ids)
+
+                # Only score the documents that pass the filters
+                rows = None
+                if filters:
+                    rows = self._index.rows(filters, self._rows)
+                    count = len(rows)
+                if count == 0 or n_results <= 0:
+                    return [[] for _ in queries]
+                assert self._codes is not None
+
+                # Score what the store holds now once the lock is released
+                removals = self._removals
+                codes = self._codes[: len(self._ids)]
+                scales = self._scales[: len(self._ids)]
+                vectors = self._full_vectors()
+                self._searches += 1
+
+            try:
+                if self.precision == "float32":
+                    # One matrix product gives the exact scores
+                    scores = query_embeddings @ (vectors if rows is None else vectors[rows]).T
+                else:
+                    # Approximate scores from the compact vectors
+                    scores = np.empty((len(queries), count), dtype=np.float32)
+                    for start in range(0, count, _SCORE_BLOCK_ROWS):
+                        end = min(start + _SCORE_BLOCK_ROWS, count)
+                        block = slice(start, end) if rows is None else rows[start:end]
+                        scores[:, start:end] = query_embeddings @ codes[block].astype(np.float32).T
+                        if self.precision == "int8":
+                            scores[:, start:end] *= scales[block]
+                best = [
+                    self._best(query_scores, query_embedding, n_results, vectors, rows)
+                    for query_scores, query_embedding in zip(scores, query_embeddings)
+                ]
+            finally:
+                with self._lock:
+                    self._searches -= 1
+                    self._cut_off_file()
+
+            with self._lock:
+                # Rows removed meanwhile moved others, so score again
+                if self._removals == removals:
+                    return [self._results(*query_best) for query_best in best]
+
+    def _best(
+        self,
+        scores: np.ndarray,
+        query_embedding: np.ndarray,
+        n_results: int,
+        vectors: np.ndarray,
+        rows: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Find the best-scoring documents for one query, rescoring compact scores.
+
+        Args:
+            scores: Score of each document searched
+            query_embedding: The query's normalized embedding
+            n_results: Number of results to return
+            vectors: The full-precision vectors, to rescore from
+            rows: Row of each document searched (all rows, in order, if None)
+
+        Returns:
+            The rows of the best documents, best first, and their exact scores
+        """
+        if self.precision == "float32":
+            candidates = self._top(scores, n_results)
+            exact = scores[candidates]
+        else:
+            # Exact scores for the best candidates
+            candidates = self._top(scores, n_results * self.rescore_factor)
+            candidates.sort()  # read the memory map in file order
+            candidate_rows = candidates if rows is None else rows[candidates]
+            exact = vectors[candidate_rows] @ query_embedding
+        if rows is not None:
+            candidates = rows[candidates]
+        best = np.argsort(-exact, kind="stable")[:n_results]
+        return candidates[best], exact[best]
+
+    def _results(self, rows: np.ndarray, exact: np.ndarray):
+        """Format documents found with their exact scores as result dicts."""
+        return [
+            {
+                "id": self._ids[row],
+                "text": self._texts[row],
+                "distance": float(distance),
+                "metadata": self._metadatas[row],
+            }
+            for row, distance in zip(rows.tolist(), 1 - exact)
+        ]
+
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        """Return the rows of the k highest scores (in no particular order)."""
+        if k >= len(scores):
+            return np.arange(len(scores))
+        return np.argpartition(-scores, k - 1)[:k]
+
+    def count(self) -> int:
+        """Return the number of documents in the store."""
+        return len(self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Return the bytes of memory the embeddings take (excluding the file)."""
+        count = len(self._ids)
+        if self._codes is None:
+            return 0
+        return self._codes[:count].nbytes + self._scales[:count].nbytes
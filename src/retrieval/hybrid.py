@@ -6,20 +6,156 @@ Seattle University, ARIN 5360
 @version: 4.0.0+w26
 """
 
-from collections import defaultdict
+import threading
+from collections import Counter, defaultdict
+from collections.abc import Sequence
 from typing import Optional
 
-from rank_bm25 import BM25Okapi
+import numpy as np
+
+from retrieval.filters import Filters, MetadataIndex
+from retrieval.snapshot import PackedStrings, SnapshotDocuments
+
+# BM25 parameters (Okapi BM25, with rank_bm25's defaults): term frequency
+# saturation, document length normalization, and the floor of negative idfs
+# as a fraction of the average idf
+_K1 = 1.5
+_B = 0.75
+_EPSILON = 0.25
+
+
+class _GrowingArray:
+    """A NumPy array appended to in place, its buffer growing geometrically."""
+
+    def __init__(self, dtype, values=()):
+        """Initialize the array with the given values (used as they are, if an array)."""
+        self._buffer = np.asarray(values, dtype=dtype)
+        self._size = len(self._buffer)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def values(self) -> np.ndarray:
+        """Return the values, as a view that later appends leave unchanged."""
+        return self._buffer[: self._size]
+
+    def extend(self, values):
+        """Append values, copying the buffer only when it's full."""
+        values = np.asarray(values, dtype=self._buffer.dtype)
+        end = self._size + len(values)
+        if end > len(self._buffer):
+            grown = np.empty(max(end, 2 * len(self._buffer)), dtype=self._buffer.dtype)
+            grown[: self._size] = self._buffer[: self._size]
+            self._buffer = grown
+        self._buffer[self._size : end] = values
+        self._size = end
+
+
+class _BM25Index:
+    """
+    BM25 (Okapi) scores of a corpus as it was when the index was built.
+
+    The term counts are in compressed sparse row form: document i's terms
+    are term_ids[indptr[i]:indptr[i + 1]], occurring counts[...] times.
+    For searching, they're also grouped by term (on the first search), so
+    looking a term up only reads the entries of the documents it's in.
+    """
+
+    def __init__(
+        self,
+        indptr: np.ndarray,
+        term_ids: np.ndarray,
+        counts: np.ndarray,
+        doc_len: np.ndarray,
+        doc_freq: np.ndarray,
+        vocabulary: dict[str, int],
+    ):
+        self.corpus_size = len(doc_len)
+        self.indptr, self.term_ids, self.counts = indptr, term_ids, counts
+        self.doc_len = doc_len
+        self.avgdl = float(doc_len.sum()) / self.corpus_size
+        self.vocabulary = vocabulary
+
+        # Like rank_bm25, floor the idf of terms in over half of the
+        # documents at a fraction of the average idf of the corpus's terms
+        present = doc_freq > 0
+        idf = np.log(self.corpus_size - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        if present.any():
+            idf[idf < 0] = _EPSILON * idf[present].mean()
+        idf[~present] = 0
+        self._idf, self._present = idf, present
+        self._postings: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def _term_postings(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return the entries ordered by term, and where each term's entries start."""
+        if self._postings is None:
+            order = np.argsort(self.term_ids, kind="stable")
+            starts = np.zeros(len(self._idf) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(self.term_ids, minlength=len(self._idf)), out=starts[1:])
+            self._postings = (order, starts)
+        return self._postings
+
+    @property
+    def idf(self) -> dict[str, float]:
+        """Return the idf of every term in the corpus."""
+        return {
+            term: float(self._idf[i])
+            for term, i in self.vocabulary.items()
+            if i < len(self._idf) and self._present[i]
+        }
+
+    def get_scores(self, query_tokens: list[str]) -> np.ndarray:
+        """Return every document's score for a tokenized query."""
+        scores = np.zeros(self.corpus_size)
+        norms = _K1 * (1 - _B + _B * self.doc_len / (self.avgdl or 1))
+        order, starts = self._term_postings()
+        for token in query_tokens:
+            term = self.vocabulary.get(token)
+            if term is None or term >= len(self._idf) or self._idf[term] == 0:
+                continue
+            entries = order[starts[term] : starts[term + 1]]
+            rows = np.searchsorted(self.indptr, entries, side="right") - 1
+            freqs = self.counts[entries]
+            scores[rows] += self._idf[term] * freqs * (_K1 + 1) / (freqs + norms[rows])
+        return scores
 
 
 class BM25Searcher:
-    """Keyword-based search using BM25 algorithm."""
-
-    def __init__(self):
+    """
+    Keyword-based search using BM25 algorithm.
+
+    Safe to update from one thread while searching from others: updates
+    only ever append to or replace the document lists, and a search works
+    on the index and documents as they were when it started.
+
+    Each document's term counts are kept in arrays that grow in place, so
+    an update only tokenizes and counts the documents it changes, and
+    adding documents never copies the ones already indexed. What can't be
+    updated per document is the idf of each term, which depends on the
+    size of the corpus: it's recomputed lazily, once per batch of updates,
+    in time proportional to the vocabulary (not to the text of the corpus).
+    """
+
+    def __init__(self) -> None:
         """Initialize BM25 searcher."""
-        self.bm25 = None
-        self.documents = []
-        self.doc_ids = []
+        self.bm25: Optional[_BM25Index] = None
+        self.documents: Sequence[dict] = []
+        self.doc_ids: list[str] = []
+        self._rows: dict[str, int] = {}  # the row of each doc_id, for lookups
+        self._index = MetadataIndex()  # the rows with each metadata value, for filters
+        self._reset_counts()
+        self._stale = False
+        self._lock = threading.RLock()
+
+    def _reset_counts(self):
+        """Forget every document's term counts."""
+        self._vocabulary = {}  # term -> term id
+        self._doc_freq = np.zeros(0, dtype=np.int64)  # number of documents with each term
+        self._indptr = _GrowingArray(np.int64, [0])  # where each document's terms start
+        self._term_ids = _GrowingArray(np.int32)
+        self._counts = _GrowingArray(np.int32)
+        self._doc_len = _GrowingArray(np.int32)  # each document's number of terms
 
     def index_documents(self, documents: list[dict]):
         """
@@ -28,44 +164,244 @@ class BM25Searcher:
         Args:
             documents: List of document dicts with 'id' and 'text'
         """
-        self.documents = documents
-        self.doc_ids = [doc["id"] for doc in documents]
+        with self._lock:
+            self.documents, self.doc_ids, self._rows = [], [], {}
+            self._index = MetadataIndex()
+            self._reset_counts()
+            self.add_documents(documents)
+            self.rebuild()
+
+    def add_documents(self, documents: list[dict]):
+        """
+        Add documents to the existing index, skipping any whose id is
+        already indexed.
 
+        Only the new documents are counted; the idf of each term is
+        recomputed lazily (on the next search or call to rebuild) rather
+        than per batch.
+
+        Args:
+            documents: List of document dicts with 'id' and 'text'
+        """
         # Tokenize documents (simple whitespace tokenization)
-        tokenized_docs = [doc["text"].lower().split() for doc in documents]
-        self.bm25 = BM25Okapi(tokenized_docs) if tokenized_docs else None
+        doc_freqs = [Counter(doc["text"].lower().split()) for doc in documents]
+        with self._lock:
+            new: list[dict] = []
+            term_ids, counts, unique, lengths = [], [], [], []
+            for doc, freqs in zip(documents, doc_freqs):
+                if doc["id"] in self._rows:
+                    continue
+                self._rows[doc["id"]] = len(self.doc_ids) + len(new)
+                new.append(doc)
+                for term, count in freqs.items():
+                    term_ids.append(self._vocabulary.setdefault(term, len(self._vocabulary)))
+                    counts.append(count)
+                unique.append(len(freqs))
+                lengths.append(sum(freqs.values()))
+            if not new:
+                return
+
+            if len(self._vocabulary) > len(self._doc_freq):
+                grown = np.zeros(2 * len(self._vocabulary), dtype=np.int64)
+                grown[: len(self._doc_freq)] = self._doc_freq
+                self._doc_freq = grown
+            np.add.at(self._doc_freq, term_ids, 1)
+            self._indptr.extend(self._indptr.values[-1] + np.cumsum(unique))
+            self._term_ids.extend(term_ids)
+            self._counts.extend(counts)
+            self._doc_len.extend(lengths)
+            # Searches only look at the documents indexed when they started
+            if not isinstance(self.documents, list):
+                self.documents = list(self.documents)  # adopted from a snapshot
+            self.documents.extend(new)
+            self.doc_ids.extend(doc["id"] for doc in new)
+            self._index.append(doc.get("metadata", {}) for doc in new)
+            self._stale = True
+
+    def remove_documents(self, ids: list[str]):
+        """
+        Remove documents from the index, uncounting just their terms.
+
+        Args:
+            ids: Ids of the documents to remove (unknown ids are ignored)
+        """
+        removed = set(ids)
+        with self._lock:
+            keep = np.array([doc_id not in removed for doc_id in self.doc_ids], dtype=bool)
+            if keep.all():
+                return
+
+            # New arrays rather than in place, as searches may be reading them
+            lengths = np.diff(self._indptr.values)
+            entries = np.repeat(keep, lengths)
+            term_ids = self._term_ids.values
+            self._doc_freq -= np.bincount(term_ids[~entries], minlength=len(self._doc_freq))
+            self._indptr = _GrowingArray(np.int64, np.concatenate([[0], np.cumsum(lengths[keep])]))
+            self._term_ids = _GrowingArray(np.int32, term_ids[entries])
+            self._counts = _GrowingArray(np.int32, self._counts.values[entries])
+            self._doc_len = _GrowingArray(np.int32, self._doc_len.values[keep])
+            self._index.keep(np.flatnonzero(keep))
+            rows = np.flatnonzero(keep).tolist()
+            self.documents = [self.documents[i] for i in rows]
+            self.doc_ids = [self.doc_ids[i] for i in rows]
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+            self._stale = True
+
+    def upsert_documents(self, documents: list[dict]):
+        """
+        Add documents, replacing every chunk already indexed for their doc_ids.
+
+        The documents must be all of the chunks of each doc_id in them, so
+        chunks left over from an earlier, longer version are removed.
 
-    def search(self, query: str, n_results: int = 10) -> list[dict]:
+        Args:
+            documents: List of document dicts with 'id', 'text', and 'metadata'
+        """
+        if not documents:
+            return
+        doc_ids = {doc["metadata"]["doc_id"] for doc in documents}
+        with self._lock:
+            rows = self._index.rows({"doc_id": list(doc_ids)})
+            self.remove_documents([self.doc_ids[row] for row in rows])
+            self.add_documents(documents)
+
+    def delete_document(self, doc_id: str):
+        """
+        Remove every chunk of a document from the index.
+
+        Args:
+            doc_id: The document's doc_id metadata (unknown ones are ignored)
+        """
+        with self._lock:
+            rows = self._index.rows({"doc_id": doc_id})
+            self.remove_documents([self.doc_ids[row] for row in rows])
+
+    def rebuild(self):
+        """Recompute the idf of each term, and the BM25 index, from the term counts."""
+        with self._lock:
+            self._stale = False
+            if not self.documents:
+                self.bm25 = None
+                return
+            self.bm25 = _BM25Index(
+                self._indptr.values,
+                self._term_ids.values,
+                self._counts.values,
+                self._doc_len.values,
+                self._doc_freq[: len(self._vocabulary)],
+                self._vocabulary,
+            )
+
+    def export_state(self, ids: Sequence[str]) -> Optional[dict[str, np.ndarray]]:
+        """
+        Return the term counts of the index as arrays, for a snapshot.
+
+        Args:
+            ids: Ids of the snapshot's documents, in the order it stores them
+
+        Returns:
+            The vocabulary ('bm25_terms', as PackedStrings) and, one row per
+            document in the order of ids, each one's length ('bm25_doc_len')
+            and term ids and counts in compressed sparse row form
+            ('bm25_indptr', 'bm25_term_ids', and 'bm25_counts'), along with
+            each term's document frequency ('bm25_doc_freq'); or None if the
+            index doesn't have exactly those documents
+        """
+        with self._lock:
+            rows = self._rows
+            if len(ids) != len(rows) or any(doc_id not in rows for doc_id in ids):
+                return None
+            order = np.fromiter((rows[doc_id] for doc_id in ids), dtype=np.int64, count=len(ids))
+
+            # Gather each document's entries in the snapshot's order
+            indptr = self._indptr.values
+            lengths = np.diff(indptr)[order]
+            new_indptr = np.zeros(len(order) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=new_indptr[1:])
+            entries = np.repeat(indptr[:-1][order] - new_indptr[:-1], lengths)
+            entries += np.arange(new_indptr[-1])
+            return {
+                **PackedStrings.pack("bm25_terms", self._vocabulary),
+                "bm25_doc_len": self._doc_len.values[order],
+                "bm25_indptr": new_indptr,
+                "bm25_term_ids": self._term_ids.values[entries],
+                "bm25_counts": self._counts.values[entries],
+                "bm25_doc_freq": self._doc_freq[: len(self._vocabulary)],
+            }
+
+    def import_state(self, documents: SnapshotDocuments, arrays: dict[str, np.ndarray]):
+        """
+        Replace the index with a snapshot's, without tokenizing the documents.
+
+        The term counts are searched straight from the snapshot's memory
+        maps, and the documents only read for the results, until they're
+        first changed.
+
+        Args:
+            documents: The snapshot's documents
+            arrays: The snapshot's arrays, including those returned by
+                export_state for these documents, in this order
+        """
+        with self._lock:
+            self.documents = documents
+            self.doc_ids = list(documents.ids)
+            self._index = documents.metadata_index()
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+            terms = PackedStrings.unpack("bm25_terms", arrays)
+            self._vocabulary = {term: i for i, term in enumerate(terms)}
+            self._doc_freq = np.array(arrays["bm25_doc_freq"], dtype=np.int64)
+            self._indptr = _GrowingArray(np.int64, arrays["bm25_indptr"])
+            self._term_ids = _GrowingArray(np.int32, arrays["bm25_term_ids"])
+            self._counts = _GrowingArray(np.int32, arrays["bm25_counts"])
+            self._doc_len = _GrowingArray(np.int32, arrays["bm25_doc_len"])
+            self.rebuild()
+
+    def search(
+        self, query: str, n_results: int = 10, filters: Optional[Filters] = None
+    ) -> list[dict]:
         """
         Search using BM25 keyword matching.
 
         Args:
             query: Search query
             n_results: Number of results to return
+            filters: Only search documents whose metadata matches these
 
         Returns:
             List of results with BM25 scores
         """
-        if self.bm25 is None:
+        with self._lock:
+            if self._stale:
+                self.rebuild()
+            bm25, documents = self.bm25, self.documents
+            eligible = self._index.rows(filters, self._rows) if filters else None
+        if bm25 is None:
             return []
 
         # Tokenize query
         query_tokens = query.lower().split()
 
-        # Get BM25 scores
-        scores = self.bm25.get_scores(query_tokens)
+        # Get BM25 scores (of just the eligible documents, if filtered); the
+        # documents list may have grown since, but only past corpus_size
+        scores = bm25.get_scores(query_tokens)
+        if eligible is not None:
+            scores = scores[eligible]
+        if n_results <= 0 or not len(scores):
+            return []
 
-        # Get top results
-        top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
-        top_indices = top_indices[:n_results]
+        # Get top results, ties in document order
+        top = np.arange(len(scores))
+        if n_results < len(scores):
+            top = np.argpartition(-scores, n_results - 1)[:n_results]
+        top = top[np.lexsort((top, -scores[top]))]
+        rows = top if eligible is None else eligible[top]
 
         results = []
-        for idx in top_indices:
-            if scores[idx] > 0:  # Only include documents with non-zero scores
-                doc = self.documents[idx].copy()
-                score = float(scores[idx])
+        for row, score in zip(rows.tolist(), scores[top].tolist()):
+            if score > 0:  # Only include documents with non-zero scores
+                doc = documents[row].copy()
                 doc["score"] = score
-                doc["bm25_score"] = float(scores[idx])
+                doc["bm25_score"] = score
                 results.append(doc)
 
         return results
@@ -116,7 +452,13 @@ class HybridSearcher:
 
         return results
 
-    def search(self, query: str, semantic_results: list[dict], n_results: int = 5):
+    def search(
+        self,
+        query: str,
+        semantic_results: list[dict],
+        n_results: int = 5,
+        filters: Optional[Filters] = None,
+    ):
         """
         Perform hybrid search combining semantic and keyword results.
 
@@ -124,6 +466,8 @@ class HybridSearcher:
             query: Search query
             semantic_results: Results from semantic search
             n_results: Number of final results to return
+            filters: Only search documents whose metadata matches these
+                (the semantic results are assumed to be filtered already)
 
         Returns:
             Fused results
@@ -133,7 +477,7 @@ class HybridSearcher:
             return semantic_results[:n_results]
 
         # Get BM25 results
-        keyword_results = self.bm25_searcher.search(query, n_results=20)
+        keyword_results = self.bm25_searcher.search(query, n_results=20, filters=filters)
 
         # Fuse results
         fused = self.reciprocal_rank_fusion(semantic_results, keyword_results)
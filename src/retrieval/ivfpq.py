@@ -0,0 +1,713 @@
+"""
+Vector store compressing embeddings with an IVF-PQ index.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import logging
+import threading
+import time
+from array import array
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from retrieval.filters import Filters, validate
+from retrieval.flat import FlatVectorStore
+
+logger = logging.getLogger(__name__)
+
+# Centroids per product quantizer subspace, so each code fits in a byte
+_PQ_CENTROIDS = 256
+
+# Rows compared against the centroids at a time, bounding the distance matrix
+_ASSIGN_BLOCK_ROWS = 16384
+
+# Bytes of replaced and removed texts a text file keeps before being compacted
+# (once they also outnumber the bytes of the texts still in it)
+_COMPACT_MIN_BYTES = 1 << 20
+
+
+def _nearest(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Return the index of the nearest (L2) centroid to each row of data."""
+    squared_norms = (centroids**2).sum(axis=1)
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), _ASSIGN_BLOCK_ROWS):
+        block = data[start : start + _ASSIGN_BLOCK_ROWS]
+        distances = squared_norms - 2 * (block @ centroids.T)  # minus the constant |x|^2
+        labels[start : start + len(block)] = distances.argmin(axis=1)
+    return labels
+
+
+def _kmeans(
+    data: np.ndarray,
+    k: int,
+    iterations: int,
+    rng: np.random.Generator,
+    spherical: bool = False,
+) -> np.ndarray:
+    """
+    Cluster data with Lloyd's k-means, starting from k random rows.
+
+    Args:
+        data: Training vectors, one per row
+        k: Number of centroids
+        iterations: Number of assignment and update rounds
+        rng: Random number generator for the initial centroids
+        spherical: Keep the centroids at unit length (for unit vectors)
+
+    Returns:
+        The centroids, one per row
+    """
+    centroids = data[rng.choice(len(data), k, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        labels = _nearest(data, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        filled = counts > 0  # empty clusters keep their old centroid
+        centroids[filled] = sums[filled] / counts[filled, None]
+        if spherical:
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+class _TextFile:
+    """
+    A list of strings kept in a file, with only the offset and length of
+    each in memory.
+
+    Strings are appended to the file: a replaced or removed string's bytes
+    stay until they outnumber those of the strings in the list (and pass
+    _COMPACT_MIN_BYTES), when the file is compacted in place. Like the
+    store's other lists, it's only used under the store's lock.
+    """
+
+    def __init__(self, path: Path):
+        """
+        Initialize an empty list.
+
+        Args:
+            path: File to keep the strings in (created, or emptied)
+        """
+        self._file = open(path, "w+b")
+        self._offsets = array("q")
+        self._lengths = array("q")
+        self._end = 0
+        self._live = 0  # bytes of the strings in the list
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, index: int) -> str:
+        self._file.seek(self._offsets[index])
+        return self._file.read(self._lengths[index]).decode("utf-8")
+
+    def __setitem__(self, index: int, text: str):
+        self._live -= self._lengths[index]
+        self._offsets[index], self._lengths[index] = self._write(text)
+        self._compact_if_due()
+
+    def __delitem__(self, index: slice):
+        self._live -= sum(self._lengths[index])
+        del self._offsets[index], self._lengths[index]
+        if not self._offsets:
+            self._file.truncate(0)
+            self._end = 0
+        self._compact_if_due()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def append(self, text: str):
+        offset, length = self._write(text)
+        self._offsets.append(offset)
+        self._lengths.append(length)
+
+    def _write(self, text: str) -> tuple[int, int]:
+        """Append a string to the file, returning its offset and length in bytes."""
+        data = text.encode("utf-8")
+        self._file.seek(self._end)
+        self._file.write(data)
+        offset, self._end = self._end, self._end + len(data)
+        self._live += len(data)
+        return offset, len(data)
+
+    def _compact_if_due(self):
+        """Compact the file once most of it is the bytes of replaced and removed strings."""
+        dead = self._end - self._live
+        if dead > _COMPACT_MIN_BYTES and dead > self._live:
+            self.compact()
+
+    def compact(self):
+        """
+        Move the strings to the start of the file, in the order they're in
+        it, and cut off the rest.
+
+        Each string moves to an offset no later than its own, so rewriting
+        them in order never overwrites one not yet moved.
+        """
+        end = 0
+        for i in sorted(range(len(self._offsets)), key=self._offsets.__getitem__):
+            offset, length = self._offsets[i], self._lengths[i]
+            if offset != end:
+                self._file.seek(offset)
+                data = self._file.read(length)
+                self._file.seek(end)
+                self._file.write(data)
+                self._offsets[i] = end
+            end += length
+        self._file.truncate(end)
+        self._end = end
+
+
+class IVFPQVectorStore(FlatVectorStore):
+    """
+    Manages document storage and retrieval with embeddings compressed by
+    an inverted file (IVF) of coarse clusters and product quantization
+    (PQ) of each vector's residual from its cluster's centroid.
+
+    A search scores only the vectors in the nprobe clusters nearest the
+    query, approximately from their codes, then rescores a shortlist of
+    the best against the full-precision float32 vectors, which stay in a
+    memory-mapped file on disk like FlatVectorStore's. The chunks' texts
+    are kept in a file too, and only read for the results.
+
+    In memory, a vector takes n_subvectors bytes of codes plus 8 bytes for
+    its cluster and its place in the cluster's list (nbytes): 56 bytes with
+    the defaults, against 1536 bytes for a 384-dimensional float32 vector.
+    Each chunk also keeps its id, its metadata, a 4-byte code per metadata
+    field (which filters and upserts look up), and where its text is in the
+    file: about 420 bytes for the loader's chunks, so about 475 bytes a
+    chunk in all, or 2.4 GB for five million chunks (plus under 2 MB of
+    centroids). That's the store alone: with hybrid search on
+    (DocumentRetriever's enable_hybrid, the default), the BM25 index also
+    keeps every chunk's text and term counts in memory, about 6 KB more
+    for a 300-word chunk, or 30 GB for five million.
+
+    The index is trained with k-means on a sample of the vectors once
+    train_size of them have been added; until then searches are exact.
+    Training doesn't hold up searches or updates: the quantizers are fit on
+    a copy of the sample, and replace the old ones once every vector is
+    encoded.
+    """
+
+    def __init__(
+        self,
+        embedder,
+        n_lists: int = 1024,
+        n_subvectors: int = 48,
+        nprobe: int = 16,
+        rescore_factor: int = 10,
+        train_size: int = 65536,
+        kmeans_iterations: int = 10,
+        directory: Optional[str] = None,
+        seed: int = 0,
+    ):
+        """
+        Initialize vector store with an embedder.
+
+        Args:
+            embedder: DocumentEmbedder instance for generating vectors
+            n_lists: Number of coarse clusters (inverted lists)
+            n_subvectors: Number of subvectors each vector is split into and
+                quantized to a byte (must divide the embedding dimension,
+                which is checked when documents are first added)
+            nprobe: Number of clusters nearest the query to search
+            rescore_factor: Rescore this many candidates per result at full
+                precision
+            train_size: Train once this many vectors have been added, on a
+                sample of at most this many (search is exact until then);
+                at least n_lists and 256, the centroids to train
+            kmeans_iterations: Number of k-means rounds when training
+            directory: Directory for the full-precision vectors and texts
+                files (a temporary directory, removed with the store, if None)
+            seed: Seed of the training sample and initial centroids
+        """
+        if n_lists < 1 or n_subvectors < 1:
+            raise ValueError("n_lists and n_subvectors must be positive.")
+        if train_size < max(n_lists, _PQ_CENTROIDS):
+            raise ValueError(
+                f"train_size must be at least {max(n_lists, _PQ_CENTROIDS)} "
+                f"(n_lists and {_PQ_CENTROIDS}, the centroids to train), got {train_size}."
+            )
+        super().__init__(
+            embedder,
+            precision="float32",
+            rescore_factor=rescore_factor,
+            directory=directory,
+            memory_map=True,
+        )
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        assert self._vectors_path is not None  # memory-mapped, so kept in a file
+        self._text_file = _TextFile(self._vectors_path.with_name("texts.utf8"))
+        self._texts = self._text_file  # type: ignore[assignment]
+
+        self._centroids: Optional[np.ndarray] = None  # coarse cluster centroids
+        self._codebooks: Optional[np.ndarray] = None  # (n_subvectors, 256, subvector dim)
+        self._assignments = np.empty(0, dtype=np.int32)  # each row's cluster
+        self._pq_codes = np.empty((0, n_subvectors), dtype=np.uint8)
+        # Rows ordered by cluster, and where each cluster's rows start (rebuilt lazily)
+        self._lists: Optional[tuple[np.ndarray, np.ndarray]] = None
+        self._train_lock = threading.Lock()  # one training at a time
+        self._defer_training = False  # set while an upsert holds the lock
+
+    @property
+    def trained(self) -> bool:
+        """Return whether the index has been trained."""
+        return self._centroids is not None
+
+    def set_search_params(self, nprobe: int):
+        """
+        Change how many clusters are searched, trading recall against speed.
+
+        Args:
+            nprobe: Number of clusters nearest the query to search
+        """
+        self.nprobe = nprobe
+
+    def train(self):
+        """
+        Train the coarse clusters and the product quantizer on a sample of
+        the stored vectors, then encode every vector.
+
+        Searches and updates go on meanwhile against the index as it was.
+        """
+        with self._train_lock:
+            self._train()
+
+    def _train_if_due(self):
+        """Train once train_size vectors are stored, unless trained or training already."""
+        if not self._train_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                due = not self.trained and len(self._ids) >= self.train_size
+            if due:
+                self._train()
+        finally:
+            self._train_lock.release()
+
+    def _train(self):
+        """Train the index (holding the training lock, but not the store's)."""
+        with self._lock:
+            count = len(self._ids)
+            if count < max(self.n_lists, _PQ_CENTROIDS):
+                raise ValueError(
+                    f"Need at least {max(self.n_lists, _PQ_CENTROIDS)} vectors to train, "
+                    f"got {count}."
+                )
+            vectors = self._full_vectors()
+            self._check_dimension(vectors.shape[1])
+
+            start = time.perf_counter()
+            rng = np.random.default_rng(self.seed)
+            sample_rows = np.sort(rng.choice(count, min(count, self.train_size), replace=False))
+            sample = np.array(vectors[sample_rows])
+            del vectors
+
+        # Fit the quantizers to the copied sample without holding the lock
+        centroids = _kmeans(sample, self.n_lists, self.kmeans_iterations, rng, spherical=True)
+        residuals = sample - centroids[_nearest(sample, centroids)]
+        codebooks = np.stack(
+            [
+                _kmeans(subvectors, _PQ_CENTROIDS, self.kmeans_iterations, rng)
+                for subvectors in np.split(residuals, self.n_subvectors, axis=1)
+            ]
+        )
+        while not self._install(centroids, codebooks):
+            pass
+        logger.info(
+            f"Trained IVF-PQ index on {len(sample)} of {count} vectors "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+
+    def _install(self, centroids: np.ndarray, codebooks: np.ndarray) -> bool:
+        """
+        Encode every vector with new quantizers and switch to them.
+
+        The vectors are encoded a block at a time, taking the lock only to
+        read each block, and the rows added meanwhile at the switch.
+
+        Returns:
+            Whether they were installed, rather than rows being removed (and
+            others moved) meanwhile, which means starting over
+        """
+        with self._lock:
+            removals, count = self._removals, len(self._ids)
+        assignments = np.empty(count, dtype=np.int32)
+        codes = np.empty((count, self.n_subvectors), dtype=np.uint8)
+        for first in range(0, count, _ASSIGN_BLOCK_ROWS):
+            last = min(first + _ASSIGN_BLOCK_ROWS, count)
+            with self._lock:
+                if self._removals != removals:
+                    return False
+                block = np.array(self._full_vectors()[first:last])
+            assignments[first:last], codes[first:last] = self._quantize(block, centroids, codebooks)
+
+        with self._lock:
+            if self._removals != removals:
+                return False
+            self._centroids, self._codebooks = centroids, codebooks
+            self._assignments, self._pq_codes = assignments, codes
+            total = len(self._ids)
+            if total > count:
+                self._reserve(total)
+                self._assignments[count:total], self._pq_codes[count:total] = self._quantize(
+                    np.array(self._full_vectors()[count:total])
+                )
+            self._lists = None
+            return True
+
+    def _quantize(
+        self,
+        embeddings: np.ndarray,
+        centroids: Optional[np.ndarray] = None,
+        codebooks: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return the cluster and PQ codes of unit float32 vectors (by default, the index's)."""
+        centroids = self._centroids if centroids is None else centroids
+        codebooks = self._codebooks if codebooks is None else codebooks
+        assert centroids is not None and codebooks is not None
+        assignments = _nearest(embeddings, centroids)
+        residuals = embeddings - centroids[assignments]
+        codes = np.stack(
+            [
+                _nearest(subvectors, codebook)
+                for subvectors, codebook in zip(
+                    np.split(residuals, self.n_subvectors, axis=1), codebooks
+                )
+            ],
+            axis=1,
+        )
+        return assignments.astype(np.int32), codes.astype(np.uint8)
+
+    def _check_dimension(self, dim: int):
+        """Raise a ValueError if vectors of this dimension can't be split into the subvectors."""
+        if dim % self.n_subvectors:
+            raise ValueError(f"{self.n_subvectors} subvectors don't divide dimension {dim}.")
+
+    def _reserve(self, count: int):
+        """Make room for the codes of count rows, growing geometrically."""
+        if count > len(self._assignments):
+            size = max(count, 2 * len(self._assignments))
+            self._assignments = np.resize(self._assignments, size)
+            codes = np.empty((size, self.n_subvectors), dtype=np.uint8)
+            codes[: len(self._pq_codes)] = self._pq_codes
+            self._pq_codes = codes
+
+    def add_documents(self, documents, embeddings: Optional[np.ndarray] = None):
+        """
+        Add documents to the vector store, encoding them if it's trained and
+        training it once it holds train_size vectors.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+            embeddings: Their embeddings, one row per document, if already
+                computed (otherwise the embedder is run on their texts)
+        """
+        if not documents:
+            return
+
+        if embeddings is None:
+            embeddings = self.embedder.embed_documents([d["text"] for d in documents])
+        elif len(embeddings) != len(documents):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(documents)} documents.")
+        embeddings = self._normalize(embeddings)
+        self._check_dimension(embeddings.shape[1])
+        with self._lock:
+            super().add_documents(documents, embeddings)
+
+            # The documents were added as the last rows
+            count = len(self._ids)
+            if self.trained:
+                self._reserve(count)
+                start = count - len(documents)
+                self._assignments[start:count], self._pq_codes[start:count] = self._quantize(
+                    embeddings
+                )
+                self._lists = None
+            defer = self._defer_training
+        if not defer:
+            self._train_if_due()
+
+    def upsert_documents(self, documents, embeddings: Optional[np.ndarray] = None):
+        """
+        Add documents, replacing every chunk already stored for their doc_ids.
+
+        The documents must be all of the chunks of each doc_id in them, so
+        chunks left over from an earlier, longer version are removed.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+            embeddings: Their embeddings, one row per document, if already
+                computed (otherwise the embedder is run on their texts)
+        """
+        with self._lock:
+            # Train after releasing the lock, not in add_documents under it
+            self._defer_training = True
+            try:
+                super().upsert_documents(documents, embeddings)
+            finally:
+                self._defer_training = False
+        self._train_if_due()
+
+    def delete_documents(self, ids: list[str]):
+        """
+        Remove documents from the vector store.
+
+        Args:
+            ids: Ids of the documents to remove (unknown ids are ignored)
+        """
+        with self._lock:
+            if self.trained:
+                # Move the codes the way FlatVectorStore moves the rows
+                last = len(self._ids) - 1
+                for row in sorted({self._rows[i] for i in ids if i in self._rows}, reverse=True):
+                    if row != last:
+                        self._assignments[row] = self._assignments[last]
+                        self._pq_codes[row] = self._pq_codes[last]
+                    last -= 1
+                self._lists = None
+            super().delete_documents(ids)
+
+    def _own_texts(self, texts) -> _TextFile:  # type: ignore[override]
+        """Copy texts adopted from a snapshot to the store's file."""
+        del self._text_file[:]
+        for text in texts:
+            self._text_file.append(text)
+        return self._text_file
+
+    def export_state(self) -> tuple[list[dict], dict[str, np.ndarray]]:
+        """
+        Return every document with its embedding, plus the trained index, for
+        a snapshot.
+
+        Returns:
+            List of dicts with 'id', 'text', and 'metadata', and a dict with
+            their 'unit_embeddings' and, once trained, the 'centroids',
+            'codebooks', 'assignments', and 'codes'
+        """
+        with self._lock:
+            documents, arrays = super().export_state()
+            if self.trained:
+                assert self._centroids is not None and self._codebooks is not None
+                count = len(self._ids)
+                arrays["centroids"] = self._centroids
+                arrays["codebooks"] = self._codebooks
+                arrays["assignments"] = self._assignments[:count]
+                arrays["codes"] = self._pq_codes[:count]
+            return documents, arrays
+
+    def import_state(self, documents: Sequence[dict], arrays: dict[str, np.ndarray]):
+        """
+        Replace the contents of the store with a snapshot's, reusing its
+        trained index if it has the same shape as this one's.
+
+        Normalized embeddings, texts, and metadata are read from the
+        snapshot's memory map, as FlatVectorStore does (the texts being
+        copied to the store's file once they change), and the codes are
+        read into memory.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata', or a
+                snapshot's SnapshotDocuments
+            arrays: Dict with their 'embeddings' (or 'unit_embeddings'), and
+                optionally the trained 'centroids', 'codebooks',
+                'assignments', and 'codes'
+        """
+        embeddings = (
+            arrays["unit_embeddings"] if "unit_embeddings" in arrays else arrays["embeddings"]
+        )
+        if len(documents):
+            self._check_dimension(embeddings.shape[1])
+        with self._lock:
+            self.clear()
+            self._centroids = self._codebooks = None
+            super().import_state(documents, arrays)
+
+            count = len(self._ids)
+            if (
+                "codes" in arrays
+                and arrays["centroids"].shape[0] == self.n_lists
+                and arrays["codes"].shape == (count, self.n_subvectors)
+            ):
+                self._centroids = np.array(arrays["centroids"])
+                self._codebooks = np.array(arrays["codebooks"])
+                self._reserve(count)
+                self._assignments[:count] = arrays["assignments"]
+                self._pq_codes[:count] = arrays["codes"]
+                self._lists = None
+        self._train_if_due()
+
+    def _inverted_lists(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return the rows ordered by cluster, and where each cluster's rows start."""
+        if self._lists is None:
+            assignments = self._assignments[: len(self._ids)]
+            order = np.argsort(assignments, kind="stable").astype(np.int32)
+            starts = np.searchsorted(assignments[order], np.arange(self.n_lists + 1))
+            self._lists = (order, starts)
+        return self._lists
+
+    def search_many(
+        self,
+        queries: list[str],
+        n_results: int = 5,
+        query_embeddings=None,
+        filters: Optional[Filters] = None,
+    ):
+        """
+        Search for documents similar to each of several queries, embedding
+        them in one pass.
+
+        Like FlatVectorStore's, searches only hold the lock to find the rows
+        to score and to read the results, and score again if rows were
+        removed meanwhile.
+
+        Args:
+            queries: Search query texts
+            n_results: Number of results to return per query
+            query_embeddings: The queries' embeddings, if already computed
+            filters: Only search documents whose metadata matches these (probing
+                more than nprobe clusters if those have too few of them)
+
+        Returns:
+            List with a list of result dicts per query, each with 'id',
+            'text', 'distance', and 'metadata'
+        """
+        if not self.trained:
+            return super().search_many(queries, n_results, query_embeddings, filters)
+        if not queries:
+            return []
+        filters = validate(filters)
+        if query_embeddings is None:
+            query_embeddings = self.embedder.embed_query(queries)
+        query_embeddings = self._normalize(np.asarray(query_embeddings).reshape(len(queries), -1))
+        while True:
+            with self._lock:
+                count = len(self._ids)
+                if count == 0 or n_results <= 0:
+                    return [[] for _ in queries]
+                assert self._centroids is not None and self._codebooks is not None
+
+                # Score what the index holds now once the lock is released
+                removals = self._removals
+                centroids, codebooks = self._centroids, self._codebooks
+                order, starts = self._inverted_lists()
+                assignments, pq_codes = self._assignments, self._pq_codes
+                eligible = self._index.rows(filters, self._rows) if filters else None
+                vectors = self._full_vectors()
+                self._searches += 1
+
+            try:
+                best = self._probe(
+                    query_embeddings,
+                    n_results,
+                    centroids,
+                    codebooks,
+                    (order, starts),
+                    assignments,
+                    pq_codes,
+                    eligible,
+                    vectors,
+                )
+            finally:
+                with self._lock:
+                    self._searches -= 1
+                    self._cut_off_file()
+
+            with self._lock:
+                # Rows removed meanwhile moved others, so score again
+                if self._removals == removals:
+                    return [self._results(*query_best) for query_best in best]
+
+    def _probe(
+        self,
+        query_embeddings: np.ndarray,
+        n_results: int,
+        centroids: np.ndarray,
+        codebooks: np.ndarray,
+        lists: tuple[np.ndarray, np.ndarray],
+        assignments: np.ndarray,
+        pq_codes: np.ndarray,
+        eligible: Optional[np.ndarray],
+        vectors: np.ndarray,
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Find each query's best documents in the clusters nearest it.
+
+        Args:
+            query_embeddings: The queries' normalized embeddings
+            n_results: Number of results to return per query
+            centroids: The coarse cluster centroids
+            codebooks: The product quantizer's centroids
+            lists: The rows ordered by cluster, and where each cluster's rows start
+            assignments: Each row's cluster
+            pq_codes: Each row's PQ codes
+            eligible: The rows that pass the filters (all rows if None)
+            vectors: The full-precision vectors, to rescore from
+
+        Returns:
+            For each query, the rows of the best documents, best first, and
+            their exact scores
+        """
+        order, starts = lists
+        if eligible is not None:
+            # How many of each cluster's rows pass the filters
+            eligible_counts = np.bincount(assignments[eligible], minlength=self.n_lists)
+
+        # A vector's score is the query's with its centroid plus with its
+        # residual, which sums the query subvectors' scores with its codes
+        coarse = query_embeddings @ centroids.T
+        tables = np.einsum(
+            "qmd,mkd->qmk",
+            query_embeddings.reshape(len(query_embeddings), self.n_subvectors, -1),
+            codebooks,
+        )
+        subspaces = np.arange(self.n_subvectors)
+
+        best = []
+        for query_embedding, query_coarse, table in zip(query_embeddings, coarse, tables):
+            if eligible is None:
+                probed = self._top(query_coarse, self.nprobe)
+                rows = np.concatenate([order[starts[c] : starts[c + 1]] for c in probed])
+            else:
+                # Probe past nprobe clusters until enough rows pass the filters
+                ranked = np.argsort(-query_coarse, kind="stable")
+                found = np.cumsum(eligible_counts[ranked])
+                needed = min(n_results, int(found[-1]))
+                nprobe = max(self.nprobe, int(np.searchsorted(found, needed)) + 1)
+                probed_mask = np.zeros(self.n_lists, dtype=bool)
+                probed_mask[ranked[:nprobe]] = True
+                rows = eligible[probed_mask[assignments[eligible]]]
+            if not len(rows):
+                best.append((rows, np.empty(0, dtype=np.float32)))
+                continue
+            scores = query_coarse[assignments[rows]] + table[subspaces, pq_codes[rows]].sum(axis=1)
+
+            # Exact scores for the best candidates
+            candidates = rows[self._top(scores, n_results * self.rescore_factor)]
+            candidates.sort()  # read the memory map in file order
+            exact = vectors[candidates] @ query_embedding
+            top = np.argsort(-exact, kind="stable")[:n_results]
+            best.append((candidates[top], exact[top]))
+        return best
+
+    @property
+    def nbytes(self) -> int:
+        """Return the bytes of memory the index takes (excluding the file)."""
+        if not self.trained:
+            return 0
+        assert self._centroids is not None and self._codebooks is not None
+        per_vector = self.n_subvectors + 8  # codes, cluster, and place in its list
+        return len(self._ids) * per_vector + self._centroids.nbytes + self._codebooks.nbytes
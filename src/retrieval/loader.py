@@ -8,30 +8,130 @@ Seattle University, ARIN 5360
 @version: 2.0.0+w26
 """
 
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
+import os
+import re
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional
 
 import pypdf
 
+from retrieval.manifest import file_digest
+
 logger = logging.getLogger(__name__)
 
+# A word is any run of non-whitespace, just like str.split() finds
+_WORD = re.compile(r"\S+")
+
+# Number of characters read at a time from a text file being streamed
+_STREAM_BLOCK_CHARS = 1024 * 1024
+
+# Bump to invalidate the PDF page cache when the extraction changes
+_PDF_CACHE_VERSION = 1
+
 
 class DocumentChunker:
     """Chunk documents into smaller pieces for better retrieval."""
 
-    def __init__(self, chunk_size: int = 300, overlap: int = 30):
+    def __init__(self, chunk_size: int = 300, overlap: int = 30, tokenizer=None):
         """
         Initialize chunker with size and overlap parameters.
 
         Args:
-            chunk_size: Maximum words per chunk
-            overlap: Number of words to overlap between chunks
+            chunk_size: Maximum words per chunk (tokens if given a tokenizer)
+            overlap: Number of words (or tokens) to overlap between chunks
+            tokenizer: Optional Hugging Face (fast) tokenizer to measure the
+                chunks with, e.g., the embedding model's own
         """
         if not 0 <= overlap <= chunk_size / 2:
             raise ValueError("Overlap must be between 0 and half the chunk size.")
         self.chunk_size = chunk_size
         self.overlap = overlap
+        self.tokenizer = tokenizer
+
+    def chunk_spans(self, text: str) -> list[tuple[int, int]]:
+        """
+        Find the overlapping chunks of the given text as character spans.
+
+        This makes a single pass over the words of the text without copying
+        any of them, remembering only where each chunk starts and ends.
+
+        Args:
+            text: Text to chunk
+
+        Returns:
+            List of (start, end) character offsets, one per chunk
+        """
+        if self.tokenizer is not None:
+            return self._token_spans(text)
+
+        step = self.chunk_size - self.overlap
+        starts: list[int] = []  # where chunk k's first word (word k * step) starts
+        ends: list[int] = []  # where chunk k's last word (word k * step + chunk_size - 1) ends
+        num_words, last_end = 0, 0
+        for match in _WORD.finditer(text):
+            if num_words % step == 0:
+                starts.append(match.start())
+            if num_words >= self.chunk_size - 1 and (num_words - self.chunk_size + 1) % step == 0:
+                ends.append(match.end())
+            num_words += 1
+            last_end = match.end()
+
+        if num_words <= self.chunk_size:
+            return [(0, len(text))]
+
+        # The chunks that run past the last word end with it
+        ends += [last_end] * (len(starts) - len(ends))
+        return list(zip(starts, ends))
+
+    def _token_spans(self, text: str) -> list[tuple[int, int]]:
+        """
+        Pack whole words into chunks of at most chunk_size tokens.
+
+        Chunks only break between words (runs of tokens with no whitespace
+        between them), so a chunk tokenizes to the tokens counted for it
+        here. A word longer than chunk_size tokens (e.g., a URL, or text
+        without spaces) is split into pieces of chunk_size tokens at token
+        boundaries. The next chunk starts with as many of the previous
+        chunk's trailing words as fit in the overlap.
+        """
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        words: list[list[int]] = []  # [start, end, number of tokens]
+        for start, end in encoding["offset_mapping"]:
+            if words and start <= words[-1][1] and words[-1][2] < self.chunk_size:
+                words[-1][1] = max(words[-1][1], end)
+                words[-1][2] += 1
+            else:
+                words.append([start, end, 1])
+
+        if sum(num_tokens for _, _, num_tokens in words) <= self.chunk_size:
+            return [(0, len(text))]
+
+        spans = []
+        first = 0
+        while True:
+            last, tokens = first, words[first][2]
+            while last + 1 < len(words) and tokens + words[last + 1][2] <= self.chunk_size:
+                last += 1
+                tokens += words[last][2]
+            spans.append((words[first][0], words[last][1]))
+            if last + 1 == len(words):
+                return spans
+
+            # Back up over the trailing words that fit in the overlap
+            next_first, tokens = last + 1, 0
+            while next_first - 1 > first and tokens + words[next_first - 1][2] <= self.overlap:
+                next_first -= 1
+                tokens += words[next_first][2]
+            first = next_first
 
     def chunk_text(self, text: str, doc_id: str) -> list[dict]:
         """
@@ -42,36 +142,223 @@ class DocumentChunker:
             doc_id: Document identifier
 
         Returns:
-            List of chunk dicts with id, text, and metadata
-        """
-        words = text.split()  # pull out words from text
-        if len(words) <= self.chunk_size:
-            return [{"id": f"{doc_id}_0", "text": text, "metadata": {"chunk": 0, "doc_id": doc_id}}]
-
-        chunks, start, chunk_num = [], 0, 0
-        while start < len(words):
-            end = start + self.chunk_size
-            chunk_text = " ".join(words[start:end])
-
-            chunks.append(
-                {
-                    "id": f"{doc_id}_{chunk_num}",
-                    "text": chunk_text,
-                    "metadata": {"chunk": chunk_num, "doc_id": doc_id},
-                }
-            )
-
-            start = end - self.overlap
-            chunk_num += 1
-        return chunks
+            List of chunk dicts with id, text, metadata, and the (start, end)
+            span of the chunk within the text
+        """
+        return [
+            {
+                "id": f"{doc_id}_{chunk_num}",
+                "text": text[start:end],
+                "metadata": {"chunk": chunk_num, "doc_id": doc_id},
+                "span": (start, end),
+            }
+            for chunk_num, (start, end) in enumerate(self.chunk_spans(text))
+        ]
+
+    def iter_chunks(self, blocks: Iterable[str], doc_id: str) -> Iterator[list[dict]]:
+        """
+        Chunk a text that arrives in blocks, without ever holding all of it.
+
+        The chunks (and their spans) are the same as chunk_text would give
+        for the whole text with its surrounding whitespace stripped, but only
+        the text of the chunk in progress is kept between blocks. Only word
+        chunking is supported (not token chunking).
+
+        Args:
+            blocks: Consecutive pieces of the text, e.g., reads from a file
+            doc_id: Document identifier
+
+        Yields:
+            List of the chunk dicts completed by each block
+        """
+        if self.tokenizer is not None:
+            raise ValueError("Streamed chunking only supports word chunking.")
+
+        step = self.chunk_size - self.overlap
+        buffer, buffer_start = "", 0  # buffer holds the text from offset buffer_start on
+        scan_from = 0  # offset the next word can start at
+        starts: deque[int] = deque()  # starts of the chunks not yet yielded
+        ends: deque[int] = deque()  # ends of the chunks not yet yielded
+        num_words, chunk_num, first_start, last_end = 0, 0, 0, 0
+
+        def make_chunk(start: int, end: int) -> dict:
+            text = buffer[start - buffer_start : end - buffer_start]
+            span = (start - first_start, end - first_start)
+            metadata = {"chunk": chunk_num, "doc_id": doc_id}
+            return {"id": f"{doc_id}_{chunk_num}", "text": text, "metadata": metadata, "span": span}
+
+        for block in itertools.chain(blocks, [None]):
+            at_end = block is None
+            if block:
+                buffer += block
+
+            # Same single pass as chunk_spans, except that a word running
+            # into the end of the buffer may continue in the next block
+            for match in _WORD.finditer(buffer, scan_from - buffer_start):
+                if not at_end and match.end() == len(buffer):
+                    break
+                start, end = buffer_start + match.start(), buffer_start + match.end()
+                if num_words == 0:
+                    first_start = start
+                if num_words % step == 0:
+                    starts.append(start)
+                if (
+                    num_words >= self.chunk_size - 1
+                    and (num_words - self.chunk_size + 1) % step == 0
+                ):
+                    ends.append(end)
+                num_words += 1
+                last_end = scan_from = end
+
+            chunks = []
+            if at_end and 0 < num_words <= self.chunk_size:
+                chunks.append(make_chunk(first_start, last_end))
+            elif num_words > self.chunk_size:
+                if at_end:
+                    # The chunks that run past the last word end with it
+                    ends += [last_end] * (len(starts) - len(ends))
+                while ends:
+                    chunks.append(make_chunk(starts.popleft(), ends.popleft()))
+                    chunk_num += 1
+            if chunks:
+                yield chunks
+
+            # Drop the text no unfinished chunk (or partial word) needs
+            keep_from = starts[0] if starts else scan_from
+            buffer = buffer[keep_from - buffer_start :]
+            buffer_start = keep_from
+
+
+def _read_text_file(filepath: Path) -> str:
+    """Read the stripped contents of a text file."""
+    with open(filepath, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def _read_pdf_file(filepath: Path, cache_dir: Optional[Path] = None) -> tuple[str, int]:
+    """
+    Extract the text of every page of a PDF file.
+
+    Kept at module level so it can be shipped to a process pool worker.
+
+    Args:
+        filepath: PDF file to read
+        cache_dir: Directory of extracted page text to reuse (and update)
+
+    Returns:
+        Tuple of the stripped text and the number of pages
+    """
+    if cache_dir is None:
+        reader = pypdf.PdfReader(filepath)
+        text_parts = [page.extract_text() for page in reader.pages]
+    else:
+        text_parts = _read_pdf_pages_cached(filepath, cache_dir)
+    return "\n\n".join(text_parts).strip(), len(text_parts)
+
+
+def _read_pdf_pages_cached(filepath: Path, cache_dir: Path) -> list[str]:
+    """
+    Extract the text of each page of a PDF file, reusing what we can.
+
+    The cache keeps, per file, the hash of the file and the text and digest
+    of each of its pages. An unchanged file isn't even parsed. For a changed
+    one, only the pages whose digest isn't in the cache are extracted.
+    """
+    cache_file = cache_dir / f"{hashlib.sha1(str(filepath.resolve()).encode()).hexdigest()}.json"
+    digest = file_digest(filepath)
+    cached: dict = {}
+    try:
+        cached = json.loads(cache_file.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        pass
+    if cached.get("version") == _PDF_CACHE_VERSION and cached.get("sha256") == digest:
+        return [page["text"] for page in cached["pages"]]
+
+    known = {page["digest"]: page["text"] for page in cached.get("pages", [])}
+    pages = []
+    for page in pypdf.PdfReader(filepath).pages:
+        page_digest = _page_digest(page)
+        text = known[page_digest] if page_digest in known else page.extract_text()
+        pages.append({"digest": page_digest, "text": text})
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    entry = {"version": _PDF_CACHE_VERSION, "sha256": digest, "pages": pages}
+    tmp_file.write_text(json.dumps(entry), encoding="utf-8")
+    tmp_file.replace(cache_file)
+    return [page["text"] for page in pages]
+
+
+def _page_digest(page: pypdf.PageObject) -> str:
+    """
+    Hash what a page's extracted text depends on: its content, its fonts,
+    and the content and fonts of the forms (Form XObjects) it draws.
+    """
+    h = hashlib.sha256()
+    contents = page.get_contents()
+    if contents is not None:
+        h.update(contents.get_data())
+    _hash_resources(h, page.get("/Resources"), set())
+    return h.hexdigest()
+
+
+def _hash_resources(h, resources, seen: set[int]):
+    """Hash the fonts in a resource dictionary and, recursively, its forms."""
+    resources = resources.get_object() if resources else None
+    if not resources:
+        return
+
+    fonts = resources.get("/Font")
+    for name, font_ref in sorted(fonts.get_object().items()) if fonts else []:
+        font = font_ref.get_object()
+        h.update(f"{name}{font.get('/BaseFont')}".encode())
+        to_unicode = font.get("/ToUnicode")
+        if to_unicode is not None:
+            h.update(to_unicode.get_object().get_data())
+        encoding = font.get("/Encoding")
+        if encoding is not None:
+            encoding = encoding.get_object()
+            differences = encoding.get("/Differences") if hasattr(encoding, "get") else encoding
+            h.update(str(differences).encode())
+
+    # Forms can be shared, and even (invalidly) draw themselves, so each is
+    # hashed once, where it's first drawn
+    xobjects = resources.get("/XObject")
+    for name, xobject_ref in sorted(xobjects.get_object().items()) if xobjects else []:
+        xobject = xobject_ref.get_object()
+        if xobject.get("/Subtype") != "/Form" or id(xobject) in seen:
+            continue
+        seen.add(id(xobject))
+        h.update(f"{name}".encode())
+        h.update(xobject.get_data())
+        _hash_resources(h, xobject.get("/Resources"), seen)
 
 
 class DocumentLoader:
     """Load and parse documents from the file system."""
 
-    def __init__(self, chunker: Optional[DocumentChunker] = None):
-        """Initialize loader with optional chunker."""
+    def __init__(
+        self,
+        chunker: Optional[DocumentChunker] = None,
+        max_workers: Optional[int] = 1,
+        stream_threshold: int = 64 * 1024 * 1024,
+        pdf_cache_dir: Optional[str] = None,
+    ):
+        """
+        Initialize loader with optional chunker.
+
+        Args:
+            chunker: Chunker to split each document with (no chunking if None)
+            max_workers: Number of workers used to read files; 1 reads them
+                one after another and None uses one worker per CPU core
+            stream_threshold: Size in bytes above which text files are read
+                and chunked a block at a time (when chunking by words)
+            pdf_cache_dir: Directory to cache the extracted text of PDF pages in
+        """
         self.chunker = chunker
+        self.max_workers = max_workers
+        self.stream_threshold = stream_threshold
+        self.pdf_cache_dir = Path(pdf_cache_dir) if pdf_cache_dir else None
 
     def load_documents(self, directory: str) -> list[dict]:
         """
@@ -83,77 +370,182 @@ class DocumentLoader:
         Returns:
             List of documents, each with 'id', 'text', and 'metadata'
         """
-        documents = []
+        return [doc for docs in self.iter_documents(directory) for doc in docs]
+
+    def list_files(self, directory: str) -> list[Path]:
+        """
+        List the loadable files in a directory.
+
+        Args:
+            directory: Path to a directory containing documents
+
+        Returns:
+            Sorted text files followed by sorted PDF files
+        """
         path = Path(directory)
         if not path.is_dir() or not path.exists():
             raise ValueError(f"Directory '{directory}' does not exist.")
+        return sorted(path.glob("*.txt")) + sorted(path.glob("*.pdf"))
 
-        # Load text files
-        for filepath in path.glob("*.txt"):
-            logger.info(f"Loading document: {filepath}")
-            docs = self._load_text_file(filepath)
-            documents.extend(docs)
+    def iter_documents(self, directory: str) -> Iterator[list[dict]]:
+        """
+        Lazily load the documents in a directory, one file at a time.
 
-        # Load PDF files
-        for filepath in path.glob("*.pdf"):
-            logger.info(f"Loading document: {filepath}")
-            docs = self._load_pdf_file(filepath)
-            documents.extend(docs)
+        Files are processed in sorted order (text files first, then PDFs), so
+        the result is the same whether or not a worker pool is used.
 
-        return documents
+        Args:
+            directory: Path to a directory containing documents
+
+        Yields:
+            List of documents (chunks) for each file
+        """
+        yield from self.iter_files(self.list_files(directory))
+
+    def iter_files(self, filepaths: list[Path]) -> Iterator[list[dict]]:
+        """
+        Lazily load the given files, in order, one file at a time.
+
+        With a worker pool, only a few files per worker are read ahead of
+        the consumer.
+
+        Args:
+            filepaths: Text (.txt) and PDF (.pdf) files to load
+
+        Yields:
+            List of documents (chunks) for each file, or for each block of
+            a text file large enough to be streamed
+        """
+        text_files = [fp for fp in filepaths if fp.suffix == ".txt"]
+        pdf_files = [fp for fp in filepaths if fp.suffix == ".pdf"]
+
+        if self.max_workers == 1:
+            for filepath in text_files:
+                logger.info(f"Loading document: {filepath}")
+                if self._should_stream(filepath):
+                    yield from self._stream_text_file(filepath)
+                else:
+                    yield self._load_text_file(filepath)
+            for filepath in pdf_files:
+                logger.info(f"Loading document: {filepath}")
+                yield self._load_pdf_file(filepath)
+            return
+
+        # Text files are I/O bound, so threads will do, but PDF text
+        # extraction is CPU bound and needs processes to use all the cores
+        # (the process pool only spawns its workers once a PDF is submitted).
+        # The workers are spawned rather than forked, as forking a process
+        # with threads running (torch's, ChromaDB's, the retriever's
+        # prefetching) can deadlock the child
+        spawn = multiprocessing.get_context("spawn")
+        with (
+            ThreadPoolExecutor(self.max_workers) as threads,
+            ProcessPoolExecutor(self.max_workers, mp_context=spawn) as processes,
+        ):
+            jobs: list[tuple[Path, Executor, Callable, Callable]] = [
+                (fp, threads, _read_text_file, self._load_text_file) for fp in text_files
+            ]
+            read_pdf = functools.partial(_read_pdf_file, cache_dir=self.pdf_cache_dir)
+            jobs += [(fp, processes, read_pdf, self._load_pdf_file) for fp in pdf_files]
+            read_ahead = 2 * (self.max_workers or os.cpu_count() or 1)
+
+            # Collect the results in submission order to stay deterministic
+            # (files to be streamed are read here when their turn comes)
+            in_flight: deque = deque()
+            for filepath, executor, read, load in jobs:
+                if filepath.suffix == ".txt" and self._should_stream(filepath):
+                    in_flight.append((filepath, load, None))
+                else:
+                    in_flight.append((filepath, load, executor.submit(read, filepath)))
+                if len(in_flight) > read_ahead:
+                    yield from self._collect(*in_flight.popleft())
+            while in_flight:
+                yield from self._collect(*in_flight.popleft())
+
+    def _collect(
+        self, filepath: Path, load: Callable, pending: Optional[Future]
+    ) -> Iterator[list[dict]]:
+        """Finish loading a file submitted to a pool, or stream it if it wasn't."""
+        logger.info(f"Loading document: {filepath}")
+        if pending is None:
+            yield from self._stream_text_file(filepath)
+        else:
+            yield load(filepath, pending)
+
+    def _should_stream(self, filepath: Path) -> bool:
+        """
+        Return whether a text file is large enough to be streamed.
 
-    def _load_text_file(self, filepath: Path) -> list[dict]:
-        """Load a single text file."""
+        A file that can't be stat'ed isn't, so it's loaded whole, which
+        warns about it and skips it like any file that can't be read.
+        """
+        if self.chunker is None or self.chunker.tokenizer is not None:
+            return False
+        try:
+            return filepath.stat().st_size > self.stream_threshold
+        except OSError:
+            return False
+
+    def _stream_text_file(self, filepath: Path) -> Iterator[list[dict]]:
+        """Load a large text file a block at a time, in bounded memory."""
+        assert self.chunker is not None
+        metadata = {"filename": filepath.name, "type": "txt"}
         try:
             with open(filepath, "r", encoding="utf-8") as f:
-                text = f.read().strip()
+                blocks = iter(lambda: f.read(_STREAM_BLOCK_CHARS), "")
+                for chunks in self.chunker.iter_chunks(blocks, filepath.stem):
+                    yield self._attach_metadata(chunks, metadata)
+
+        except Exception as e:
+            logger.warning(f"Warning: Failed to load {filepath}: {e}")
+
+    def _load_text_file(self, filepath: Path, pending: Optional[Future] = None) -> list[dict]:
+        """Load a single text file, optionally from a read already submitted to a pool."""
+        try:
+            text = pending.result() if pending else _read_text_file(filepath)
 
             if not text:
                 return []
 
             doc_id = filepath.stem
             metadata = {"filename": filepath.name, "type": "txt"}
-
-            if self.chunker:
-                chunks = self.chunker.chunk_text(text, doc_id)
-                # Add filename to each chunk's metadata
-                for chunk in chunks:
-                    chunk["metadata"].update(metadata)
-                return chunks
-            else:
-                return [{"id": doc_id, "text": text, "metadata": metadata}]
+            return self._make_documents(text, doc_id, metadata)
 
         except Exception as e:
             logger.warning(f"Warning: Failed to load {filepath}: {e}")
             return []
 
-    def _load_pdf_file(self, filepath: Path) -> list[dict]:
-        """Load a single PDF file."""
+    def _load_pdf_file(self, filepath: Path, pending: Optional[Future] = None) -> list[dict]:
+        """Load a single PDF file, optionally from a read already submitted to a pool."""
         try:
-            reader = pypdf.PdfReader(filepath)
-
-            # Extract text from all pages
-            text_parts = []
-            for page in reader.pages:
-                text_parts.append(page.extract_text())
-
-            text = "\n\n".join(text_parts).strip()
+            if pending:
+                text, num_pages = pending.result()
+            else:
+                text, num_pages = _read_pdf_file(filepath, self.pdf_cache_dir)
 
             if not text:
                 return []
 
             doc_id = filepath.stem
-            metadata = {"filename": filepath.name, "type": "pdf", "num_pages": len(reader.pages)}
-
-            if self.chunker:
-                chunks = self.chunker.chunk_text(text, doc_id)
-                # Add PDF metadata to each chunk
-                for chunk in chunks:
-                    chunk["metadata"].update(metadata)
-                return chunks
-            else:
-                return [{"id": doc_id, "text": text, "metadata": metadata}]
+            metadata = {"filename": filepath.name, "type": "pdf", "num_pages": num_pages}
+            return self._make_documents(text, doc_id, metadata)
 
         except Exception as e:
-            print(f"Warning: Failed to load {filepath}: {e}")
+            logger.warning(f"Warning: Failed to load {filepath}: {e}")
             return []
+
+    def _make_documents(self, text: str, doc_id: str, metadata: dict) -> list[dict]:
+        """Chunk the text (if we have a chunker) and attach the file metadata."""
+        if self.chunker:
+            return self._attach_metadata(self.chunker.chunk_text(text, doc_id), metadata)
+        else:
+            return [{"id": metadata["filename"], "text": text, "metadata": metadata}]
+
+    @staticmethod
+    def _attach_metadata(chunks: list[dict], metadata: dict) -> list[dict]:
+        """Add the file metadata to each chunk, and id it by the file's name."""
+        for chunk in chunks:
+            chunk["metadata"].update(metadata)
+            # By filename rather than doc_id, so that a.txt and a.pdf don't share chunk ids
+            chunk["id"] = f"{metadata['filename']}_{chunk['metadata']['chunk']}"
+        return chunks
@@ -10,14 +10,19 @@ Seattle University, ARIN 5360
 import logging
 import os
 from contextlib import asynccontextmanager
+from typing import Optional
 
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
 from starlette.staticfiles import StaticFiles
 
+from retrieval import config, filters
+from retrieval.batcher import QueryBatcher
 from retrieval.retriever import DocumentRetriever
+from retrieval.watcher import DirectoryWatcher
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -25,6 +30,8 @@ logger = logging.getLogger(__name__)
 
 # Global retriever instance
 retriever = None
+# Global batcher of concurrent queries' embeddings
+query_batcher = None
 
 
 class HealthResponse(BaseModel):
@@ -42,6 +49,9 @@ class SearchRequest(BaseModel):
     n_results: int = 5
     use_hybrid: bool = True
     use_reranking: bool = True
+    # Only search chunks whose metadata matches, e.g. {"type": "pdf"} or
+    # {"filename": ["a.txt", "b.txt"]}
+    filters: Optional[dict[str, str | int | float | bool | list]] = None
 
 
 class SearchResponse(BaseModel):
@@ -56,15 +66,58 @@ class SearchResponse(BaseModel):
 @asynccontextmanager
 async def lifespan(_app: FastAPI):
     # Code before the 'yield' is executed during application startup
+    watcher = None
     try:
         logger.info("Loading models...")
 
         # Index documents from the documents/ directory
         global retriever
-        retriever = DocumentRetriever()
+        retriever = DocumentRetriever(
+            load_workers=config.LOAD_WORKERS,
+            embedding_cache_dir=config.EMBEDDING_CACHE_DIR,
+            embedding_backend=config.EMBEDDING_BACKEND,
+            quantized_embeddings=config.EMBEDDING_QUANTIZED,
+            embedding_storage=config.EMBEDDING_STORAGE,
+            index_dir=config.INDEX_DIR,
+            vector_backend=config.VECTOR_BACKEND,
+            memory_map_vectors=config.MEMORY_MAP_VECTORS,
+            hnsw_options={
+                "space": config.HNSW_SPACE,
+                "hnsw_m": config.HNSW_M,
+                "ef_construction": config.HNSW_EF_CONSTRUCTION,
+                "ef_search": config.HNSW_EF_SEARCH,
+            },
+            ivfpq_options={
+                "n_lists": config.IVF_LISTS,
+                "n_subvectors": config.PQ_SUBVECTORS,
+                "nprobe": config.IVF_NPROBE,
+                "train_size": config.IVF_TRAIN_SIZE,
+            },
+        )
         docs_dir = "tests/data" if "PYTEST_CURRENT_TEST" in os.environ else "documents"
+        snapshot = config.INDEX_SNAPSHOT
+        snapshot_files = None  # the contents of the files in the imported snapshot
+        if snapshot and os.path.exists(snapshot):
+            try:
+                retriever.import_snapshot(snapshot, docs_dir)
+                snapshot_files = retriever.manifest.digests()
+            except ValueError as e:
+                logger.warning(f"Warning: Ignoring snapshot {snapshot}: {e}")
         num_docs = retriever.index_documents(docs_dir)
         logger.info(f"Indexed {num_docs} chunks successfully!")
+        # Write the snapshot if it was missing or rejected, or the documents changed since
+        if snapshot and snapshot_files != retriever.manifest.digests():
+            retriever.export_snapshot(snapshot)
+
+        global query_batcher
+        if config.QUERY_BATCH_WINDOW_MS > 0:
+            query_batcher = QueryBatcher(retriever.embedder, config.QUERY_BATCH_WINDOW_MS)
+
+        # Keep indexing changes to the documents while serving queries
+        if config.WATCH_DOCUMENTS:
+            watcher = DirectoryWatcher(retriever, docs_dir, interval=config.WATCH_INTERVAL)
+            watcher.start()
+            logger.info(f"Watching {docs_dir} for changes")
     except Exception as e:
         # Don't crash the server, but log the error
         logger.error(f"Failed to load model: {str(e)}")
@@ -73,6 +126,8 @@ async def lifespan(_app: FastAPI):
 
     # Code after the 'yield' is executed during application shutdown
     logger.info("Application shutting down (lifespan)...")
+    if watcher is not None:
+        watcher.stop()
 
 
 # Initialize FastAPI app
@@ -116,11 +171,25 @@ async def search(request: SearchRequest):
         raise HTTPException(status_code=400, detail="n_results must be between 1 and 20")
 
     try:
-        results = retriever.search(
+        filters.validate(request.filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    try:
+        # Embed the query along with any others arriving at the same time
+        query_embedding = None
+        if query_batcher is not None:
+            query_embedding = await query_batcher.embed(request.query)
+
+        # Search off the event loop, so other requests keep coming in
+        results = await run_in_threadpool(
+            retriever.search,
             request.query,
             request.n_results,
             use_hybrid=request.use_hybrid,
             use_reranking=request.use_reranking,
+            query_embedding=query_embedding,
+            filters=request.filters,
         )
 
         return SearchResponse(query=request.query, results=results, count=len(results))
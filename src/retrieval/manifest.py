@@ -0,0 +1,201 @@
+"""
+Manifest of indexed files for incremental re-indexing.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def file_digest(filepath: Path) -> str:
+    """Return the SHA-256 hex digest of a file's contents."""
+    with open(filepath, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+@dataclass
+class ManifestChanges:
+    """Files that differ between a directory and the manifest."""
+
+    added: list[Path] = field(default_factory=list)
+    modified: list[Path] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+    stats: dict[str, dict] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.modified or self.removed)
+
+
+class IndexManifest:
+    """
+    Records the content hash, size, mtime, and chunk ids of every indexed
+    file, so re-indexing only has to touch the files that changed.
+
+    Files are keyed by their resolved path. The size and mtime are a cheap
+    first check; a file is only hashed when one of them differs, and only
+    counts as modified when its hash does too.
+    """
+
+    def __init__(self, path: Optional[str | Path] = None):
+        """
+        Initialize the manifest, loading it from disk if it exists.
+
+        Args:
+            path: JSON file to persist the manifest to (in-memory only if None)
+        """
+        self.path = Path(path) if path else None
+        self.files: dict[str, dict] = {}
+        if self.path and self.path.exists():
+            try:
+                data = json.loads(self.path.read_text(encoding="utf-8"))
+                if data.get("version") == MANIFEST_VERSION:
+                    self.files = data["files"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Warning: Ignoring unreadable manifest {self.path}: {e}")
+
+    def scan(self, directory: str, filepaths: list[Path]) -> ManifestChanges:
+        """
+        Compare the files currently in a directory against the manifest.
+
+        Args:
+            directory: Directory the files were listed from
+            filepaths: Files currently in the directory
+
+        Returns:
+            The added, modified, and removed files, plus the new stats of
+            the added and modified ones (to pass on to record); a file that
+            can't be read (e.g., deleted since it was listed) counts as removed
+        """
+        changes = ManifestChanges()
+        present = set()
+        for filepath in filepaths:
+            key = str(filepath.resolve())
+            entry = self.files.get(key)
+            try:
+                st = filepath.stat()
+                if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+                    present.add(key)
+                    continue
+                digest = file_digest(filepath)
+            except OSError as e:
+                logger.warning(f"Warning: Skipping {filepath}: {e}")
+                continue
+            present.add(key)
+
+            if entry and entry["sha256"] == digest:
+                # Touched but not changed, so just remember the new mtime
+                entry["mtime"] = st.st_mtime
+                continue
+
+            changes.stats[key] = {"sha256": digest, "size": st.st_size, "mtime": st.st_mtime}
+            (changes.modified if entry else changes.added).append(filepath)
+
+        root = Path(directory).resolve()
+        changes.removed = [
+            key for key in self.files if Path(key).parent == root and key not in present
+        ]
+        return changes
+
+    def record(
+        self,
+        filepath: Path,
+        stats: dict,
+        chunk_ids: list[str],
+        duplicate_ids: Optional[list[str]] = None,
+    ):
+        """
+        Record that a file has been indexed.
+
+        Args:
+            filepath: The indexed file
+            stats: Its stats, as returned by scan
+            chunk_ids: Ids of its chunks that were indexed
+            duplicate_ids: Ids of its chunks left out as duplicates of others
+        """
+        entry = {**stats, "chunk_ids": chunk_ids}
+        if duplicate_ids:
+            entry["duplicate_ids"] = duplicate_ids
+        self.files[str(filepath.resolve())] = entry
+
+    def forget(self, key: str) -> list[str]:
+        """
+        Remove a file from the manifest.
+
+        Returns:
+            The ids of the chunks the file had been indexed as, including
+            any left out as duplicates
+        """
+        entry = self.files.pop(key, None)
+        return entry["chunk_ids"] + entry.get("duplicate_ids", []) if entry else []
+
+    def stats(self, key: str) -> dict:
+        """Return the recorded stats of a file (without its chunk ids)."""
+        entry = self.files[key]
+        return {k: v for k, v in entry.items() if k not in ("chunk_ids", "duplicate_ids")}
+
+    def find(self, chunk_ids: set[str]) -> list[str]:
+        """Return the keys of the files any of the given chunks came from."""
+        return [
+            key
+            for key, entry in self.files.items()
+            if not chunk_ids.isdisjoint(entry["chunk_ids"] + entry.get("duplicate_ids", []))
+        ]
+
+    def digests(self) -> dict[str, str]:
+        """Return the content hash of every file, by key."""
+        return {key: entry["sha256"] for key, entry in self.files.items()}
+
+    def export_state(self) -> dict[str, dict]:
+        """
+        Return the files keyed by their paths relative to the directory
+        they're in (their common parent, if in several), for a snapshot
+        that can be used where the files are somewhere else.
+        """
+        if not self.files:
+            return {}
+        root = os.path.commonpath([str(Path(key).parent) for key in self.files])
+        return {Path(key).relative_to(root).as_posix(): entry for key, entry in self.files.items()}
+
+    def import_state(self, directory: str, files: dict[str, dict]):
+        """
+        Replace the files with a snapshot's.
+
+        Args:
+            directory: Directory the files are in here
+            files: Files keyed by relative path, as returned by export_state
+        """
+        root = Path(directory).resolve()
+        self.files = {str(root / key): entry for key, entry in files.items()}
+
+    def clear(self):
+        """Forget every file."""
+        self.files = {}
+
+    @property
+    def chunk_count(self) -> int:
+        """Return the number of chunks recorded across all files."""
+        return sum(len(entry["chunk_ids"]) for entry in self.files.values())
+
+    def save(self):
+        """Write the manifest to disk (if it has a path)."""
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        tmp_path.write_text(
+            json.dumps({"version": MANIFEST_VERSION, "files": self.files}), encoding="utf-8"
+        )
+        tmp_path.replace(self.path)
@@ -7,37 +7,206 @@ Seattle University, ARIN 5360
 @version: 3.1.0+w26
 """
 
-from typing import Optional
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from collections.abc import Iterable, Iterator, Sequence
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Optional, TypeVar
 
+import numpy as np
+
+from retrieval.dedup import ChunkDeduplicator
 from retrieval.embeddings import DocumentEmbedder
+from retrieval.filters import Filters, validate
+from retrieval.flat import FlatVectorStore
 from retrieval.hybrid import BM25Searcher, HybridSearcher
+from retrieval.ivfpq import IVFPQVectorStore
 from retrieval.loader import DocumentChunker, DocumentLoader
+from retrieval.manifest import IndexManifest
 from retrieval.reranker import CrossEncoderReranker
+from retrieval.snapshot import SnapshotDocuments, read_snapshot, write_snapshot
 from retrieval.store import VectorStore
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def _batched(chunk_lists: Iterable[list[dict]], batch_size: int) -> Iterator[list[dict]]:
+    """Regroup per-file chunk lists into batches of at most batch_size chunks."""
+    batch: list[dict] = []
+    for chunks in chunk_lists:
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _prefetch(items: Iterable[T], depth: int = 2) -> Iterator[T]:
+    """
+    Produce the items on a background thread, at most depth items ahead.
+
+    This lets loading and chunking (mostly I/O and pure Python) overlap with
+    embedding and insertion of the previous batch, while the bounded queue
+    keeps memory flat.
+    """
+    buffer: queue.Queue = queue.Queue(maxsize=depth)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        # Give up if the consumer stopped early, rather than block forever
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(done)
+        except BaseException as e:
+            put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while (item := buffer.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
+
 
 class DocumentRetriever:
     """
     Initialize retriever with optional advanced features.
 
     Args:
-        chunk_size: Maximum characters per chunk
+        chunk_size: Maximum words per chunk
         overlap: Overlap between chunks
+        chunk_by_tokens: Measure chunks (and overlap) in the embedding
+            model's tokens and make them as long as the model accepts,
+            ignoring chunk_size
         enable_reranking: Enable cross-encoder reranking
         enable_hybrid: Enable hybrid search (BM25 + semantic)
+        manifest_path: JSON file to keep the manifest of indexed files in
+        load_workers: Number of workers reading files in parallel; 1 reads
+            them one after another and None uses one per CPU core
+        deduplicate: Index only one copy of (near-)duplicate chunks, listing
+            the files of all copies in each result's 'sources'
+        embedding_cache_dir: Directory to cache document embeddings in, so
+            unchanged chunks aren't embedded again after a restart
+        embedding_backend: Run the embedding model with "torch" or "onnx"
+        quantized_embeddings: Use the int8-quantized ONNX embedding model
+        bulk_threshold_bytes: Size of the files to (re-)index at or above
+            which chunks are embedded by a pool of worker processes
+        embedding_processes: Number of worker processes (one per CPU if None)
+        embedding_storage: Keep embeddings as "float32", or compactly as
+            "float16" or "int8" (flat backend only), rescoring the top
+            candidates at full precision
+        index_dir: Directory to persist the index in (the ChromaDB
+            collection, manifest, and PDF text cache), so a restart with the
+            same model and chunking settings only indexes what changed
+            (ChromaDB backend only)
+        vector_backend: Search embeddings with ChromaDB's HNSW index
+            ("chroma"), exactly with NumPy ("flat", faster for up to a few
+            hundred thousand chunks), or with a compressed IVF-PQ index
+            ("ivfpq", for millions of chunks)
+        memory_map_vectors: Search the flat backend's float32 vectors
+            straight from a memory-mapped file
+        hnsw_options: Settings of ChromaDB's HNSW index (VectorStore's
+            space, hnsw_m, ef_construction, and ef_search)
+        ivfpq_options: Settings of the IVF-PQ index (IVFPQVectorStore's
+            n_lists, n_subvectors, nprobe, and train_size)
     """
 
     def __init__(
         self,
         chunk_size: int = 300,
         overlap: int = 30,
+        chunk_by_tokens: bool = False,
         enable_reranking: bool = True,
         enable_hybrid: bool = True,
+        manifest_path: Optional[str] = None,
+        load_workers: Optional[int] = 1,
+        deduplicate: bool = False,
+        embedding_cache_dir: Optional[str] = None,
+        embedding_backend: str = "torch",
+        quantized_embeddings: bool = False,
+        bulk_threshold_bytes: int = 64 * 1024 * 1024,
+        embedding_processes: Optional[int] = None,
+        embedding_storage: str = "float32",
+        index_dir: Optional[str] = None,
+        vector_backend: str = "chroma",
+        memory_map_vectors: bool = False,
+        hnsw_options: Optional[dict] = None,
+        ivfpq_options: Optional[dict] = None,
     ):
         """Initialize retriever with default components."""
-        chunker = DocumentChunker(chunk_size=chunk_size, overlap=overlap)
-        self.loader = DocumentLoader(chunker=chunker)
-        self.store = VectorStore(DocumentEmbedder())
+        self.embedder = DocumentEmbedder(
+            cache_dir=embedding_cache_dir,
+            backend=embedding_backend,
+            quantized=quantized_embeddings,
+        )
+        if chunk_by_tokens:
+            # Don't pay to embed and store text the model would truncate
+            chunker = DocumentChunker(
+                chunk_size=self.embedder.max_tokens,
+                overlap=overlap,
+                tokenizer=self.embedder.tokenizer,
+            )
+        else:
+            chunker = DocumentChunker(chunk_size=chunk_size, overlap=overlap)
+        index_path = Path(index_dir) if index_dir else None
+        self.loader = DocumentLoader(
+            chunker=chunker,
+            max_workers=load_workers,
+            pdf_cache_dir=str(index_path / "pdf_cache") if index_path else None,
+        )
+        # Embeddings can only be reused with the same model and chunks
+        self.fingerprint = {
+            "model": self.embedder.model_id,
+            "normalize": self.embedder.normalize,
+            "chunk_size": chunker.chunk_size,
+            "overlap": chunker.overlap,
+            "chunk_by_tokens": chunk_by_tokens,
+            "deduplicate": deduplicate,
+        }
+        self.store: VectorStore | FlatVectorStore
+        if vector_backend not in ("chroma", "flat", "ivfpq"):
+            raise ValueError(f"Unknown vector backend '{vector_backend}'.")
+        if vector_backend != "flat" and embedding_storage != "float32":
+            raise ValueError(
+                f"Embedding storage '{embedding_storage}' needs the flat vector backend."
+            )
+        if vector_backend == "chroma":
+            self.store = VectorStore(
+                self.embedder,
+                persist_directory=str(index_path / "chroma") if index_path else None,
+                fingerprint=self.fingerprint,
+                **(hnsw_options or {}),
+            )
+        elif vector_backend == "ivfpq":
+            self.store = IVFPQVectorStore(self.embedder, **(ivfpq_options or {}))
+        else:
+            self.store = FlatVectorStore(
+                self.embedder, precision=embedding_storage, memory_map=memory_map_vectors
+            )
 
         # Optional component reranker
         self.reranker: Optional[CrossEncoderReranker] = None
@@ -52,28 +221,250 @@ class DocumentRetriever:
             self.bm25_searcher = BM25Searcher()
             self.hybrid_searcher = HybridSearcher(bm25_searcher=self.bm25_searcher)
 
+        # Remembers what has been indexed so re-indexing only handles changes
+        if manifest_path is None and index_path:
+            manifest_path = str(index_path / "manifest.json")
+        self.manifest = IndexManifest(manifest_path)
+        self._index_lock = threading.Lock()
+
+        # Optional component to drop duplicate chunks before embedding them
+        self.deduplicator: Optional[ChunkDeduplicator] = None
+        if deduplicate:
+            self.deduplicator = ChunkDeduplicator()
+
+        self.bulk_threshold_bytes = bulk_threshold_bytes
+        self.embedding_processes = embedding_processes
+
         self._indexed = False
+        if self.document_count:
+            self._warm_start()
 
-    def index_documents(self, directory: str):
+    def _warm_start(self):
+        """Pick up a persisted index, rebuilding the in-memory parts from the store."""
+        documents = self.store.get_documents()
+        if self.use_hybrid and self.bm25_searcher:
+            self.bm25_searcher.index_documents(documents)
+        self._resume(documents)
+        logger.info(f"Reopened index of {self.document_count} chunks")
+
+    def _resume(self, documents: Sequence[dict]):
+        """Get ready to search and incrementally re-index restored documents."""
+        if self.deduplicator and self.manifest.chunk_count == len(documents):
+            # Only the canonical chunks were persisted, so drop the files that
+            # had duplicates to have them deduplicated again when re-indexed
+            self.deduplicator.deduplicate(list(documents))
+            keys = [key for key, entry in self.manifest.files.items() if "duplicate_ids" in entry]
+            self._remove_files(keys)
+            if self.use_hybrid and self.bm25_searcher:
+                self.bm25_searcher.rebuild()
+            self.manifest.save()
+
+        self._indexed = True
+
+    def export_snapshot(self, path: str):
+        """
+        Write the whole index to a single snapshot file: the chunks, their
+        embeddings, the BM25 term counts, the manifest, and the fingerprint
+        of the model and chunking settings they were made with.
+
+        Args:
+            path: Snapshot file to write (replaced atomically)
+        """
+        with self._index_lock:
+            documents, arrays = self.store.export_state()
+            arrays = {**arrays, **SnapshotDocuments.pack(documents)}
+            if self.bm25_searcher:
+                bm25 = self.bm25_searcher.export_state([doc["id"] for doc in documents])
+                arrays.update(bm25 or {})
+            header = {"fingerprint": self.fingerprint, "manifest": self.manifest.export_state()}
+            write_snapshot(path, header, arrays)
+        logger.info(f"Exported snapshot of {len(documents)} chunks to {path}")
+
+    def import_snapshot(self, path: str, directory: str) -> int:
+        """
+        Replace the index with a snapshot's instead of loading, embedding,
+        and tokenizing the documents again. Indexing a directory afterwards
+        only handles files changed since the snapshot.
+
+        Only the manifest is read from the snapshot's JSON header. The
+        documents' texts and metadata, their embeddings, and the BM25 term
+        counts are arrays that are memory-mapped rather than parsed: the
+        flat and IVF-PQ stores and the BM25 index search them straight from
+        there, while the other stores copy them in, ChromaDB rebuilding its
+        HNSW index from them.
+
+        Args:
+            path: Snapshot file written by export_snapshot
+            directory: Directory the snapshot's documents are in here (which
+                needn't be where they were when it was written)
+
+        Returns:
+            Number of documents restored
+        """
+        header, arrays = read_snapshot(path)
+        if header["fingerprint"] != self.fingerprint:
+            raise ValueError(
+                f"Snapshot {path} was made with {header['fingerprint']}, not {self.fingerprint}."
+            )
+        documents = SnapshotDocuments.unpack(arrays)
+        with self._index_lock:
+            self.store.import_state(documents, arrays)
+            if self.bm25_searcher:
+                if "bm25_indptr" in arrays:
+                    self.bm25_searcher.import_state(documents, arrays)
+                else:
+                    self.bm25_searcher.index_documents(list(documents))
+            self.manifest.import_state(directory, header["manifest"])
+            self.manifest.save()
+            if self.deduplicator:
+                self.deduplicator.clear()
+            self._resume(documents)
+        logger.info(f"Imported snapshot of {self.document_count} chunks from {path}")
+        return self.document_count
+
+    def index_documents(self, directory: str, batch_size: int = 256):
         """
         Load and index documents from a directory.
 
+        Only files that are new or modified since the last call are loaded
+        and embedded, and the chunks of modified and removed files are
+        deleted first, so the cost scales with the size of the change.
+        Concurrent calls are serialized, but searches can run meanwhile.
+
+        Loading, chunking, embedding, and insertion are streamed in batches,
+        with the next batch being loaded while the current one is embedded,
+        so only a couple of batches of chunks are in memory at any time.
+        When the files to load add up to bulk_threshold_bytes or more, the
+        chunks are embedded by a pool of worker processes.
+
         Args:
             directory: Path to the directory containing documents
+            batch_size: Number of chunks to embed and insert at a time
 
         Returns:
             Number of documents indexed
         """
-        before = self.document_count
-        documents = self.loader.load_documents(directory)
-        self.store.add_documents(documents)
+        with self._index_lock:
+            before = self.document_count
+            if self.manifest.chunk_count != before:
+                # The manifest doesn't describe this store (e.g., it was saved by
+                # an earlier process with its own in-memory store), so start over
+                if self.manifest.files or before:
+                    logger.info("Manifest is out of sync with the store; re-indexing everything")
+                self.manifest.clear()
+                if self.deduplicator:
+                    self.deduplicator.clear()
+                if before:
+                    # Chunks already in a persisted store would not be replaced
+                    self.store.clear()
+                    if self.bm25_searcher:
+                        self.bm25_searcher.index_documents([])
+                    before = 0
 
-        # Store documents for BM25 if hybrid search is enabled
-        if self.use_hybrid and self.bm25_searcher:
-            self.bm25_searcher.index_documents(documents)
+            filepaths = self.loader.list_files(directory)
+            changes = self.manifest.scan(directory, filepaths)
 
-        self._indexed = True
-        return self.document_count - before
+            # Drop the old chunks of the modified and removed files (and reload
+            # any file whose duplicate chunks lose their canonical chunk)
+            stale_keys = changes.removed + [str(fp.resolve()) for fp in changes.modified]
+            reload = self._remove_files(stale_keys)
+            changes.stats.update(reload)
+
+            # Stream in the chunks of the new and modified files
+            to_load = [fp for fp in filepaths if str(fp.resolve()) in changes.stats]
+            to_load += [Path(key) for key in reload if Path(key) not in to_load]
+
+            # Spread the embedding across worker processes for big jobs
+            load_bytes = sum(changes.stats[str(fp.resolve())]["size"] for fp in to_load)
+            bulk = load_bytes >= self.bulk_threshold_bytes
+            start = time.perf_counter()
+            with self.embedder.bulk(self.embedding_processes) if bulk else nullcontext():
+                if bulk:
+                    # Give every worker a full batch each time
+                    batch_size *= self.embedder.pool_size
+                chunk_ids, duplicate_ids = self._index_files(to_load, batch_size)
+            if to_load:
+                elapsed = time.perf_counter() - start
+                num_chunks = sum(len(ids) for ids in chunk_ids.values())
+                logger.info(
+                    f"Loaded, embedded, and stored {num_chunks} chunks in {elapsed:.1f}s "
+                    f"({num_chunks / max(elapsed, 1e-9):.0f} chunks/s)"
+                )
+
+            for filepath in to_load:
+                key = str(filepath.resolve())
+                self.manifest.record(
+                    filepath,
+                    changes.stats[key],
+                    chunk_ids[filepath.name],
+                    duplicate_ids[filepath.name],
+                )
+
+            if changes:
+                if self.use_hybrid and self.bm25_searcher:
+                    self.bm25_searcher.rebuild()
+                self.manifest.save()
+                logger.info(
+                    f"Indexed {len(changes.added)} new and {len(changes.modified)} modified "
+                    f"files; removed {len(changes.removed)} files"
+                )
+
+            self._indexed = True
+            return self.document_count - before
+
+    def _index_files(
+        self, filepaths: list[Path], batch_size: int
+    ) -> tuple[dict[str, list[str]], dict[str, list[str]]]:
+        """
+        Load, chunk, embed, and insert files, a batch of chunks at a time.
+
+        Returns:
+            Tuple of the ids of each file's indexed chunks and of its chunks
+            left out as duplicates, by filename
+        """
+        chunk_ids: defaultdict[str, list[str]] = defaultdict(list)
+        duplicate_ids: defaultdict[str, list[str]] = defaultdict(list)
+        batches = _batched(self.loader.iter_files(filepaths), batch_size)
+        for batch in _prefetch(batches):
+            if self.deduplicator:
+                batch, duplicates = self.deduplicator.deduplicate(batch)
+                for chunk in duplicates:
+                    duplicate_ids[chunk["metadata"]["filename"]].append(chunk["id"])
+
+            self.store.add_documents(batch)
+
+            # Store documents for BM25 if hybrid search is enabled
+            if self.use_hybrid and self.bm25_searcher:
+                self.bm25_searcher.add_documents(batch)
+
+            for chunk in batch:
+                chunk_ids[chunk["metadata"]["filename"]].append(chunk["id"])
+        return chunk_ids, duplicate_ids
+
+    def _remove_files(self, keys: list[str]) -> dict[str, dict]:
+        """
+        Remove the chunks of files from the indexes and the manifest.
+
+        Returns:
+            Stats of other files to reload, because their duplicate chunks
+            were only represented by the removed chunks
+        """
+        reload: dict[str, dict] = {}
+        while keys:
+            ids = [chunk_id for key in keys for chunk_id in self.manifest.forget(key)]
+            self._remove_chunks(ids)
+            orphans = self.deduplicator.forget(ids) if self.deduplicator else set()
+            keys = self.manifest.find(orphans)
+            reload.update((key, self.manifest.stats(key)) for key in keys)
+        return reload
+
+    def _remove_chunks(self, ids: list[str]):
+        """Remove chunks from the vector store and the BM25 index."""
+        if not ids:
+            return
+        self.store.delete_documents(ids)
+        if self.use_hybrid and self.bm25_searcher:
+            self.bm25_searcher.remove_documents(ids)
 
     def search(
         self,
@@ -81,6 +472,8 @@ class DocumentRetriever:
         n_results: int = 5,
         use_reranking: Optional[bool] = None,
         use_hybrid: Optional[bool] = None,
+        query_embedding: Optional[np.ndarray] = None,
+        filters: Optional[Filters] = None,
     ) -> list[dict]:
         """
         Search for documents relevant to the query.
@@ -90,11 +483,55 @@ class DocumentRetriever:
             n_results: Number of results to return
             use_reranking: Disable cross-encoder reranking by setting to False
             use_hybrid: Disable hybrid search by setting to False
+            query_embedding: The query's embedding, if already computed
+                (e.g., batched with other queries)
+            filters: Only search chunks whose metadata matches these, e.g.
+                {"type": "pdf"} or {"filename": ["a.txt", "b.txt"]} (or
+                whose duplicates' metadata does, when deduplicating)
         Returns:
             List of result dicts with document information
         """
+        embeddings = None if query_embedding is None else [query_embedding]
+        return self.search_many(
+            [query],
+            n_results,
+            use_reranking=use_reranking,
+            use_hybrid=use_hybrid,
+            query_embeddings=embeddings,
+            filters=filters,
+        )[0]
+
+    def search_many(
+        self,
+        queries: list[str],
+        n_results: int = 5,
+        use_reranking: Optional[bool] = None,
+        use_hybrid: Optional[bool] = None,
+        query_embeddings=None,
+        filters: Optional[Filters] = None,
+    ) -> list[list[dict]]:
+        """
+        Search for documents relevant to each of several queries, embedding
+        them and looking them up in the vector store as one batch.
+
+        Args:
+            queries: Search query texts
+            n_results: Number of results to return per query
+            use_reranking: Disable cross-encoder reranking by setting to False
+            use_hybrid: Disable hybrid search by setting to False
+            query_embeddings: The queries' embeddings, if already computed
+            filters: Only search chunks whose metadata matches these
+        Returns:
+            List with a list of result dicts per query
+        """
         if not self._indexed:
             raise ValueError("No documents indexed. Call index_documents() first.")
+        filters = validate(filters)
+        if filters and self.deduplicator:
+            # A deduplicated chunk also matches filters on the duplicates it stands in for
+            stand_ins = self.deduplicator.stand_ins(filters)
+            if stand_ins:
+                filters = {"$or": [filters, {"id": stand_ins}]}
 
         # Determine which features to use
         apply_reranking = use_reranking is not False and self.reranker is not None
@@ -103,21 +540,31 @@ class DocumentRetriever:
         # Get initial semantic search results
         # Retrieve more initially if we're reranking or using hybrid
         initial_k = max(20, n_results) if apply_reranking else n_results
-        semantic_results = self.store.search(query, n_results=initial_k)
+        semantic_results = self.store.search_many(
+            queries, n_results=initial_k, query_embeddings=query_embeddings, filters=filters
+        )
 
-        # Apply fast hybrid search if enabled
-        if apply_hybrid and self.hybrid_searcher:
-            results = self.hybrid_searcher.search(query, semantic_results, n_results=n_results)
-        else:
-            results = semantic_results
+        all_results = []
+        for query, results in zip(queries, semantic_results):
+            # Apply fast hybrid search if enabled
+            if apply_hybrid and self.hybrid_searcher:
+                results = self.hybrid_searcher.search(
+                    query, results, n_results=n_results, filters=filters
+                )
 
-        # Apply slower reranking if enabled once we have the best candidates
-        if apply_reranking and self.reranker:
-            results = self.reranker.rerank(query, results, top_k=n_results)
-        else:
-            results = results[:n_results]
+            # Apply slower reranking if enabled once we have the best candidates
+            if apply_reranking and self.reranker:
+                results = self.reranker.rerank(query, results, top_k=n_results)
+            else:
+                results = results[:n_results]
+
+            # List every file a deduplicated chunk appears in
+            if self.deduplicator:
+                for result in results:
+                    result["sources"] = self.deduplicator.sources(result["id"])
+            all_results.append(results)
 
-        return results
+        return all_results
 
     @property
     def document_count(self) -> int:
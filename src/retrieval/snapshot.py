@@ -0,0 +1,270 @@
+"""
+Single-file snapshots of an index, for starting replicas without re-indexing.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import json
+import os
+import struct
+from collections.abc import Iterable, Sequence
+from pathlib import Path
+from typing import Optional, Self
+
+import numpy as np
+
+from retrieval.filters import MetadataIndex
+
+SNAPSHOT_VERSION = 2
+
+# File layout: magic, format version (uint32), header length (uint64), the
+# JSON header, then each array's raw bytes starting on an aligned offset
+_MAGIC = b"RETRSNAP"
+_PREAMBLE = struct.Struct("<8sIQ")
+_ALIGNMENT = 64
+
+# Bytes of an array copied into memory at a time when writing it out
+_WRITE_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+def _aligned(offset: int) -> int:
+    """Round an offset up to the array alignment."""
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def write_snapshot(path: str | Path, header: dict, arrays: dict[str, np.ndarray]):
+    """
+    Write a header and arrays to a snapshot file.
+
+    The file is written next to its destination and then renamed over it,
+    so a reader never sees a partial snapshot.
+
+    Args:
+        path: Snapshot file to write
+        header: JSON-serializable contents (documents, statistics, etc.)
+        arrays: Named arrays (of at least one dimension) to store in binary form
+    """
+    layout: dict[str, dict] = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps({**header, "arrays": layout}).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header_bytes))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(_PREAMBLE.pack(_MAGIC, SNAPSHOT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]["offset"])
+            # Write big arrays (possibly memory maps) a block of rows at a time
+            rows = max(1, _WRITE_BLOCK_BYTES // max(array[:1].nbytes, 1))
+            for start in range(0, len(array), rows):
+                f.write(np.ascontiguousarray(array[start : start + rows]).tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def read_snapshot(path: str | Path) -> tuple[dict, dict[str, np.ndarray]]:
+    """
+    Read a snapshot file, memory-mapping its arrays rather than loading them.
+
+    Args:
+        path: Snapshot file to read
+
+    Returns:
+        The header, and the arrays by name (read-only memory maps)
+    """
+    with open(path, "rb") as f:
+        preamble = f.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            raise ValueError(f"{path} is not an index snapshot.")
+        magic, version, header_length = _PREAMBLE.unpack(preamble)
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not an index snapshot.")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(
+                f"Snapshot {path} has format version {version}, expected {SNAPSHOT_VERSION}."
+            )
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _aligned(_PREAMBLE.size + header_length)
+
+    arrays = {}
+    for name, entry in header.pop("arrays").items():
+        shape = tuple(entry["shape"])
+        if 0 in shape:
+            arrays[name] = np.empty(shape, dtype=entry["dtype"])  # can't map zero bytes
+        else:
+            arrays[name] = np.memmap(
+                path,
+                dtype=entry["dtype"],
+                mode="r",
+                offset=data_start + entry["offset"],
+                shape=shape,
+            )
+    return header, arrays
+
+
+class PackedStrings(Sequence):
+    """
+    Strings packed end to end into one UTF-8 byte array, so a snapshot can
+    hold any number of them as two arrays, and only the ones read are
+    decoded (straight from the snapshot's memory map).
+    """
+
+    def __init__(self, offsets: np.ndarray, data: np.ndarray):
+        """
+        Initialize the strings.
+
+        Args:
+            offsets: Where each string starts in data, then where the last ends
+            data: The encoded strings, as a byte (uint8) array
+        """
+        self.offsets = offsets
+        self.data = data
+
+    @classmethod
+    def pack(cls, name: str, values: Iterable) -> dict[str, np.ndarray]:
+        """
+        Pack values into arrays for a snapshot.
+
+        Args:
+            name: Name to give the arrays (with '_offsets' and '_data' appended)
+            values: The values to pack
+
+        Returns:
+            The named offsets and data arrays
+        """
+        encoded = [cls._encode(value) for value in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(data) for data in encoded], out=offsets[1:])
+        data = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return {f"{name}_offsets": offsets, f"{name}_data": data}
+
+    @classmethod
+    def unpack(cls, name: str, arrays: dict[str, np.ndarray]) -> Self:
+        """Return the values packed into arrays under the given name."""
+        return cls(arrays[f"{name}_offsets"], arrays[f"{name}_data"])
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return value.encode("utf-8")
+
+    @staticmethod
+    def _decode(data: bytes):
+        return data.decode("utf-8")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return type(self)(self.offsets[start : max(start, stop) + 1], self.data)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("index out of range")
+        return self._decode(self.data[self.offsets[index] : self.offsets[index + 1]].tobytes())
+
+
+class PackedJSON(PackedStrings):
+    """JSON values (e.g., metadata dicts) packed like PackedStrings, parsed when read."""
+
+    @staticmethod
+    def _encode(value) -> bytes:
+        return json.dumps(value).encode("utf-8")
+
+    @staticmethod
+    def _decode(data: bytes):
+        return json.loads(data)
+
+
+class SnapshotDocuments(Sequence):
+    """
+    A snapshot's documents, with their ids, texts, and metadata packed in
+    separate arrays, each document's dict only being put together when read.
+    The metadata is also packed as a MetadataIndex, to filter the documents
+    without reading it.
+    """
+
+    def __init__(
+        self,
+        ids: PackedStrings,
+        texts: PackedStrings,
+        metadatas: PackedJSON,
+        index_fields: Optional[dict[str, tuple[list, np.ndarray]]] = None,
+    ):
+        """Initialize the documents from their packed ids, texts, metadata, and index."""
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self._index_fields = index_fields
+
+    @staticmethod
+    def pack(documents: Sequence[dict]) -> dict[str, np.ndarray]:
+        """
+        Pack documents into arrays for a snapshot.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+
+        Returns:
+            The named arrays of their ids, texts, metadata, and metadata index
+        """
+        index = MetadataIndex()
+        index.append(doc["metadata"] for doc in documents)
+        fields = index.export_state()
+        arrays = {
+            **PackedStrings.pack("ids", (doc["id"] for doc in documents)),
+            **PackedStrings.pack("texts", (doc["text"] for doc in documents)),
+            **PackedJSON.pack("metadatas", (doc["metadata"] for doc in documents)),
+            **PackedStrings.pack("index_fields", fields),
+        }
+        for i, (values, codes) in enumerate(fields.values()):
+            arrays.update(PackedJSON.pack(f"index_values{i}", values))
+            arrays[f"index_codes{i}"] = codes
+        return arrays
+
+    @classmethod
+    def unpack(cls, arrays: dict[str, np.ndarray]) -> "SnapshotDocuments":
+        """Return the documents packed into arrays by pack."""
+        fields = PackedStrings.unpack("index_fields", arrays)
+        return cls(
+            PackedStrings.unpack("ids", arrays),
+            PackedStrings.unpack("texts", arrays),
+            PackedJSON.unpack("metadatas", arrays),
+            {
+                field: (
+                    list(PackedJSON.unpack(f"index_values{i}", arrays)),
+                    arrays[f"index_codes{i}"],
+                )
+                for i, field in enumerate(fields)
+            },
+        )
+
+    def metadata_index(self) -> MetadataIndex:
+        """Return an index of the documents' metadata (read from the snapshot if it's there)."""
+        if self._index_fields is not None:
+            return MetadataIndex(len(self), self._index_fields)
+        index = MetadataIndex()
+        index.append(self.metadatas)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                return [self[i] for i in range(*index.indices(len(self)))]
+            return SnapshotDocuments(self.ids[index], self.texts[index], self.metadatas[index])
+        return {"id": self.ids[index], "text": self.texts[index], "metadata": self.metadatas[index]}
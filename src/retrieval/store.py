@@ -8,10 +8,62 @@ Seattle University, ARIN 5360
 @version: 4.0.0+w26
 """
 
+import json
+import logging
+import time
+from collections.abc import Sequence
+from typing import Optional
+
 import chromadb
+import numpy as np
 from chromadb.api.types import EmbeddingFunction
 from chromadb.config import Settings
 
+from retrieval.filters import Filters, build_where, validate
+
+logger = logging.getLogger(__name__)
+
+# Documents fetched from the collection at a time when reading them all back
+_GET_PAGE_SIZE = 10000
+
+
+def _id_queries(filters: Optional[Filters]) -> list[tuple[Optional[list[str]], Optional[Filters]]]:
+    """
+    Split filters into ChromaDB queries whose results together match them:
+    the ids each query is limited to (by ids rather than where, which only
+    sees metadata) and its metadata filters.
+
+    'id' can be filtered on at the top level, and in '$or' alternatives.
+    """
+    filters = validate(filters)
+    if filters is None or not ("id" in filters or "$or" in filters):
+        return [(None, filters)]
+
+    def ids_of(value) -> list[str]:
+        return value if isinstance(value, list) else [value]
+
+    rest = {field: value for field, value in filters.items() if field not in ("id", "$or")}
+    ids = ids_of(filters["id"]) if "id" in filters else None
+    alternatives = filters.get("$or")
+    if not isinstance(alternatives, list) or not any("id" in alt for alt in alternatives):
+        if alternatives is not None:
+            rest["$or"] = alternatives
+        return [(ids, rest or None)]
+
+    # Alternatives on metadata go in one query, and those on ids in others
+    queries: list[tuple[Optional[list[str]], Optional[Filters]]] = []
+    on_metadata = [alt for alt in alternatives if "id" not in alt]
+    if on_metadata:
+        queries.append((ids, {**rest, "$or": on_metadata}))
+    for alt in alternatives:
+        if "id" in alt:
+            alt_ids = ids_of(alt["id"])
+            if ids is not None:
+                alt_ids = [i for i in alt_ids if i in set(ids)]
+            others = {field: value for field, value in alt.items() if field != "id"}
+            queries.append((alt_ids, {**rest, **others} or None))
+    return queries
+
 
 class EmbedderAdaptor(EmbeddingFunction):
     """
@@ -26,27 +78,85 @@ class EmbedderAdaptor(EmbeddingFunction):
         """Return True since we don't support build from config, etc."""
         return True
 
-    def __call__(self, input) -> list[list[float]]:  # type: ignore[override]
+    def __call__(self, input) -> np.ndarray:  # type: ignore[override]
         """
-        Make embedder callable for ChromaDB compatibility and convert to a
-        list from the numpy array returned by our embedder.
+        Make embedder callable for ChromaDB compatibility, handing over our
+        embedder's float32 array as is (no per-element conversion to lists).
         """
-        return self.embedder.embed_documents(input).tolist()
+        return np.asarray(self.embedder.embed_documents(input), dtype=np.float32)
 
 
 class VectorStore:
     """Manages document storage and retrieval using ChromaDB."""
 
-    def __init__(self, embedder, collection_name: str = "documents"):
+    def __init__(
+        self,
+        embedder,
+        collection_name: str = "documents",
+        persist_directory: Optional[str] = None,
+        fingerprint: Optional[dict] = None,
+        space: str = "cosine",
+        hnsw_m: int = 16,
+        ef_construction: int = 100,
+        ef_search: int = 100,
+    ):
         """
         Initialize vector store with an embedder.
 
         Args:
             embedder: DocumentEmbedder instance for generating vectors
             collection_name: Name for the ChromaDB collection
+            persist_directory: Directory to keep the collection in across
+                restarts (in memory only if None)
+            fingerprint: Settings the stored embeddings depend on (e.g., the
+                model and chunking); a persisted collection is only reopened
+                if it was built with the same ones
+            space: Distance of the HNSW index, "cosine", "l2", or "ip"
+            hnsw_m: Links per node in the HNSW graph (more raises recall,
+                memory, and build time)
+            ef_construction: Candidate list size while building the graph
+                (more raises recall and build time)
+            ef_search: Candidate list size while searching (more raises
+                recall and latency); can be changed with set_search_params
         """
         self.embedder = EmbedderAdaptor(embedder)
-        self.client = chromadb.Client(Settings(anonymized_telemetry=False))
+        settings = Settings(anonymized_telemetry=False)
+        if persist_directory:
+            self.client = chromadb.PersistentClient(path=persist_directory, settings=settings)
+        else:
+            self.client = chromadb.Client(settings)
+        # Changing how the graph is built means rebuilding it
+        fingerprint = {
+            **(fingerprint or {}),
+            "space": space,
+            "hnsw_m": hnsw_m,
+            "ef_construction": ef_construction,
+        }
+        metadata = {"fingerprint": json.dumps(fingerprint, sort_keys=True)}
+        configuration = {
+            "hnsw": {
+                "space": space,
+                "max_neighbors": hnsw_m,
+                "ef_construction": ef_construction,
+                "ef_search": ef_search,
+            }
+        }
+
+        # Reopen a persisted collection built the same way
+        self.reopened = False
+        if persist_directory:
+            try:
+                collection = self.client.get_collection(
+                    collection_name, embedding_function=self.embedder
+                )
+                if (collection.metadata or {}).get("fingerprint") == metadata["fingerprint"]:
+                    self.collection = collection
+                    self.reopened = True
+                    self.set_search_params(ef_search)
+                    return
+                logger.info(f"Collection '{collection_name}' was built differently; rebuilding")
+            except Exception:
+                pass  # nothing persisted yet
 
         # Delete any existing collection if present
         try:
@@ -57,15 +167,58 @@ class VectorStore:
         self.collection = self.client.create_collection(
             name=collection_name,
             embedding_function=self.embedder,  # Should use self.embedder
+            metadata=metadata,
+            configuration=configuration,  # type: ignore[arg-type]
         )
 
-    def add_documents(self, documents):
+    def set_search_params(self, ef_search: int):
+        """
+        Change the HNSW search parameters without rebuilding the index.
+
+        Args:
+            ef_search: Candidate list size while searching
+        """
+        self.collection.modify(configuration={"hnsw": {"ef_search": ef_search}})
+
+    def add_documents(self, documents, embeddings: Optional[np.ndarray] = None):
         """
         Add documents to the vector store.
 
+        The documents are inserted in as many calls as ChromaDB's maximum
+        batch size requires.
+
         Args:
             documents: List of dicts with 'id', 'text', and 'metadata'
+            embeddings: Their embeddings, one row per document, if already
+                computed (otherwise the embedder is run on their texts)
         """
+        self._write(documents, embeddings, self.collection.add)
+
+    def upsert_documents(self, documents, embeddings: Optional[np.ndarray] = None):
+        """
+        Add documents, replacing every chunk already stored for their doc_ids.
+
+        The documents must be all of the chunks of each doc_id in them:
+        chunks left over from an earlier, longer version are removed, so a
+        document that shrinks leaves nothing stale behind. Only the changed
+        documents are touched.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+            embeddings: Their embeddings, one row per document, if already
+                computed (otherwise the embedder is run on their texts)
+        """
+        if not documents:
+            return
+
+        doc_ids = list({doc["metadata"]["doc_id"] for doc in documents})
+        stored = self.collection.get(where=build_where({"doc_id": doc_ids}), include=[])["ids"]
+        kept = {doc["id"] for doc in documents}
+        self.delete_documents([id_ for id_ in stored if id_ not in kept])
+        self._write(documents, embeddings, self.collection.upsert)
+
+    def _write(self, documents, embeddings: Optional[np.ndarray], write):
+        """Embed documents if needed, and write them with add or upsert in batches."""
         if not documents:
             return
 
@@ -73,41 +226,224 @@ class VectorStore:
         texts = [doc["text"] for doc in documents]
         metadatas = [doc["metadata"] for doc in documents]
 
-        self.collection.add(ids=ids, documents=texts, metadatas=metadatas)
+        start = time.perf_counter()
+        if embeddings is None:
+            embeddings = self.embedder.embedder.embed_documents(texts)
+        elif len(embeddings) != len(documents):
+            raise ValueError(f"Got {len(embeddings)} embeddings for {len(documents)} documents.")
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        embedded = time.perf_counter()
+
+        max_batch_size = self.client.get_max_batch_size()
+        for i in range(0, len(documents), max_batch_size):
+            j = i + max_batch_size
+            write(
+                ids=ids[i:j],
+                embeddings=embeddings[i:j],
+                documents=texts[i:j],
+                metadatas=metadatas[i:j],
+            )
+
+        inserted = time.perf_counter()
+        logger.debug(
+            f"Wrote {len(documents)} documents: embedded in {embedded - start:.2f}s, "
+            f"inserted in {inserted - embedded:.2f}s "
+            f"({len(documents) / max(inserted - start, 1e-9):.0f} documents/s)"
+        )
+
+    def delete_documents(self, ids: list[str]):
+        """
+        Remove documents from the vector store.
+
+        Args:
+            ids: Ids of the documents to remove (unknown ids are ignored)
+        """
+        if not ids:
+            return
+
+        self.collection.delete(ids=ids)
+
+    def delete_document(self, doc_id: str):
+        """
+        Remove every chunk of a document from the vector store.
+
+        Args:
+            doc_id: The document's doc_id metadata (unknown ones are ignored)
+        """
+        self.collection.delete(where={"doc_id": doc_id})
 
-    def search(self, query: str, n_results: int = 5):
+    def search(
+        self,
+        query: str,
+        n_results: int = 5,
+        query_embedding=None,
+        filters: Optional[Filters] = None,
+    ):
         """
         Search for documents similar to the query.
 
         Args:
             query: Search query text
             n_results: Number of results to return
+            query_embedding: The query's embedding, if already computed
+            filters: Only search documents whose metadata matches these
 
         Returns:
             List of result dicts with 'id', 'text', 'distance', and 'metadata'
         """
-        results = self.collection.query(query_texts=[query], n_results=n_results)
+        embeddings = None if query_embedding is None else [query_embedding]
+        return self.search_many([query], n_results, embeddings, filters)[0]
+
+    def search_many(
+        self,
+        queries: list[str],
+        n_results: int = 5,
+        query_embeddings=None,
+        filters: Optional[Filters] = None,
+    ):
+        """
+        Search for documents similar to each of several queries, embedding
+        them in one pass and looking them all up in one call.
+
+        Args:
+            queries: Search query texts
+            n_results: Number of results to return per query
+            query_embeddings: The queries' embeddings, if already computed
+            filters: Only search documents whose metadata matches these
+                (applied inside the index, through its where clause)
 
-        # Add type checking before indexing
-        # (then we feel safe with the type-ignores below)
-        if not results or not results["ids"] or not results["ids"][0]:
+        Returns:
+            List with a list of result dicts per query, each with 'id',
+            'text', 'distance', and 'metadata'
+        """
+        if not queries:
             return []
+        id_queries = _id_queries(filters)
+
+        # Embed through the embedder's query cache rather than query_texts
+        if query_embeddings is None:
+            query_embeddings = self.embedder.embedder.embed_query(queries)
+        formatted: list[list[dict]] = [[] for _ in queries]
+        for ids, id_filters in id_queries:
+            if ids is not None and not ids:
+                continue
+            results = self.collection.query(
+                query_embeddings=np.asarray(query_embeddings, dtype=np.float32),
+                ids=ids,
+                n_results=n_results,
+                where=build_where(id_filters),
+            )
 
-        # Format results
-        formatted = []
-        if len(results["ids"]) > 0:
-            for i in range(len(results["ids"][0])):  # type: ignore[override]
-                formatted.append(
+            # Add type checking before indexing
+            # (then we feel safe with the type-ignores below)
+            if not results or not results["ids"]:
+                continue
+
+            # Format results
+            for q in range(len(queries)):
+                formatted[q].extend(
                     {
-                        "id": results["ids"][0][i],  # type: ignore[index]
-                        "text": results["documents"][0][i],  # type: ignore[index]
-                        "distance": results["distances"][0][i],  # type: ignore[index]
-                        "metadata": results["metadatas"][0][i],  # type: ignore[index]
+                        "id": results["ids"][q][i],
+                        "text": results["documents"][q][i],  # type: ignore[index]
+                        "distance": results["distances"][q][i],  # type: ignore[index]
+                        "metadata": results["metadatas"][q][i],  # type: ignore[index]
                     }
+                    for i in range(len(results["ids"][q]))
                 )
 
+        if len(id_queries) > 1:
+            # Merge the queries' results, nearest first, each document once
+            for q, merged in enumerate(formatted):
+                unique = {result["id"]: result for result in merged}
+                formatted[q] = sorted(unique.values(), key=lambda r: r["distance"])[:n_results]
         return formatted
 
+    def clear(self):
+        """Remove every document (keeping the collection's settings)."""
+        name, metadata = self.collection.name, self.collection.metadata
+        hnsw = self.collection.configuration["hnsw"] or {}
+        configuration = {
+            "hnsw": {
+                key: hnsw[key]
+                for key in ("space", "max_neighbors", "ef_construction", "ef_search")
+                if key in hnsw
+            }
+        }
+        self.client.delete_collection(name)
+        self.collection = self.client.create_collection(
+            name=name,
+            embedding_function=self.embedder,
+            metadata=metadata,
+            configuration=configuration,
+        )
+
+    def get_documents(self) -> list[dict]:
+        """
+        Read back every document in the store.
+
+        Returns:
+            List of dicts with 'id', 'text', and 'metadata'
+        """
+        documents = []
+        for offset in range(0, self.count(), _GET_PAGE_SIZE):
+            page = self.collection.get(
+                include=["documents", "metadatas"], limit=_GET_PAGE_SIZE, offset=offset
+            )
+            for i, doc_id in enumerate(page["ids"]):
+                documents.append(
+                    {
+                        "id": doc_id,
+                        "text": page["documents"][i],  # type: ignore[index]
+                        "metadata": page["metadatas"][i],  # type: ignore[index]
+                    }
+                )
+        return documents
+
+    def export_state(self) -> tuple[list[dict], dict[str, np.ndarray]]:
+        """
+        Read back every document with its embedding, for a snapshot.
+
+        Returns:
+            List of dicts with 'id', 'text', and 'metadata', and a dict with
+            their 'embeddings', one row per document
+        """
+        documents = []
+        embeddings = []
+        for offset in range(0, self.count(), _GET_PAGE_SIZE):
+            page = self.collection.get(
+                include=["documents", "metadatas", "embeddings"],
+                limit=_GET_PAGE_SIZE,
+                offset=offset,
+            )
+            for i, doc_id in enumerate(page["ids"]):
+                documents.append(
+                    {
+                        "id": doc_id,
+                        "text": page["documents"][i],  # type: ignore[index]
+                        "metadata": page["metadatas"][i],  # type: ignore[index]
+                    }
+                )
+            embeddings.append(np.asarray(page["embeddings"], dtype=np.float32))
+        if not embeddings:
+            return documents, {"embeddings": np.empty((0, 0), dtype=np.float32)}
+        return documents, {"embeddings": np.concatenate(embeddings)}
+
+    def import_state(self, documents: Sequence[dict], arrays: dict[str, np.ndarray]):
+        """
+        Replace the contents of the store with a snapshot's, without embedding.
+
+        The embeddings are still inserted into the collection one batch at a
+        time, with ChromaDB building its HNSW index from them.
+
+        Args:
+            documents: List of dicts with 'id', 'text', and 'metadata'
+            arrays: Dict with their 'embeddings', or 'unit_embeddings' if
+                normalized, one row per document
+        """
+        self.clear()
+        embeddings = arrays["embeddings"] if "embeddings" in arrays else arrays["unit_embeddings"]
+        self.add_documents(documents, embeddings)
+
     def count(self) -> int:
         """Return the number of documents in the store."""
         return self.collection.count()
@@ -0,0 +1,110 @@
+"""
+Watch a directory and keep the retriever's index up to date.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import logging
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryWatcher:
+    """
+    Polls a directory for created, modified, and deleted documents and
+    feeds them to the retriever as incremental updates.
+
+    Each poll only stats the files. Once a change has held still for the
+    debounce period (so half-written files aren't indexed), the retriever
+    re-indexes the directory, which only loads the files that changed.
+    Searches keep being answered while that happens.
+    """
+
+    def __init__(self, retriever, directory: str, interval: float = 1.0, debounce: float = 0.5):
+        """
+        Initialize watcher for a directory the retriever has already indexed.
+
+        Args:
+            retriever: DocumentRetriever to keep up to date
+            directory: Path to the directory to watch
+            interval: Seconds between polls
+            debounce: Seconds a change must hold still before it's indexed
+        """
+        self.retriever = retriever
+        self.directory = directory
+        self.interval = interval
+        self.debounce = debounce
+
+        self._indexed_snapshot = self._snapshot()
+        self._pending_snapshot: Optional[dict] = None
+        self._pending_since = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _snapshot(self) -> dict:
+        """Return the size and mtime of each document in the directory."""
+        snapshot = {}
+        for filepath in self.retriever.loader.list_files(self.directory):
+            try:
+                st = filepath.stat()
+            except FileNotFoundError:
+                continue  # deleted since it was listed
+            snapshot[str(filepath)] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def poll(self) -> bool:
+        """
+        Check the directory once, indexing any change that has settled.
+
+        Returns:
+            True if the retriever was updated
+        """
+        snapshot = self._snapshot()
+        if snapshot == self._indexed_snapshot:
+            self._pending_snapshot = None
+            return False
+
+        # Wait for the files to stop changing before indexing them
+        now = time.monotonic()
+        if snapshot != self._pending_snapshot:
+            self._pending_snapshot = snapshot
+            self._pending_since = now
+            return False
+        if now - self._pending_since < self.debounce:
+            return False
+
+        changed = self.retriever.index_documents(self.directory)
+        logger.info(f"Re-indexed {self.directory} (document count changed by {changed})")
+        self._indexed_snapshot = snapshot
+        self._pending_snapshot = None
+        return True
+
+    def start(self):
+        """Start polling on a background thread."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="directory-watcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop polling and wait for any update in progress to finish."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        """Poll until stopped, logging (and retrying) failed updates."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logger.error(f"Failed to update index from {self.directory}: {e}")
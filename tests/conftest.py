@@ -0,0 +1,19 @@
+"""
+Shared fixtures for the tests.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import pytest
+
+from retrieval.loader import DocumentChunker
+
+
+@pytest.fixture
+def make_chunks():
+    """Chunk a document into one chunk per word, with the chunker's ids and metadata."""
+    chunker = DocumentChunker(chunk_size=1, overlap=0)
+    return lambda doc_id, text: chunker.chunk_text(text, doc_id)
@@ -0,0 +1,71 @@
+"""
+Unit tests of the query embedding micro-batcher.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from retrieval.batcher import QueryBatcher
+from retrieval.embeddings import DocumentEmbedder
+
+
+class RecordingEmbedder:
+    """Wraps an embedder, recording the batches of queries it's given."""
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.batches = []
+
+    def embed_query(self, queries):
+        self.batches.append(queries)
+        return self.embedder.embed_query(queries)
+
+
+@pytest.fixture
+def embedder():
+    """Create a recording DocumentEmbedder for testing."""
+    return RecordingEmbedder(DocumentEmbedder(query_cache_size=0))
+
+
+async def embed_all(batcher, queries):
+    return await asyncio.gather(*(batcher.embed(query) for query in queries))
+
+
+def test_concurrent_queries_share_a_batch(embedder):
+    """Test that concurrent queries are embedded together, each getting its own vector."""
+    batcher = QueryBatcher(embedder, window_ms=20)
+    queries = ["Python programming", "eating pizza", "vector databases"]
+
+    embeddings = asyncio.run(embed_all(batcher, queries))
+
+    assert embedder.batches == [queries]
+    for query, embedding in zip(queries, embeddings):
+        np.testing.assert_allclose(embedding, embedder.embedder.embed_query(query), rtol=1e-5)
+
+
+def test_full_batch_is_embedded_at_once(embedder):
+    """Test that a batch is embedded without waiting once it's full."""
+    batcher = QueryBatcher(embedder, window_ms=60_000, max_batch_size=2)
+
+    asyncio.run(asyncio.wait_for(embed_all(batcher, ["a", "b", "c", "d"]), timeout=10))
+
+    assert embedder.batches == [["a", "b"], ["c", "d"]]
+
+
+def test_errors_reach_every_caller(monkeypatch, embedder):
+    """Test that a failed batch raises in each of its callers."""
+    monkeypatch.setattr(embedder.embedder, "embed_query", lambda queries: 1 / 0)
+    batcher = QueryBatcher(embedder)
+
+    async def embed_both():
+        return await asyncio.gather(batcher.embed("a"), batcher.embed("b"), return_exceptions=True)
+
+    results = asyncio.run(embed_both())
+    assert all(isinstance(result, ZeroDivisionError) for result in results)
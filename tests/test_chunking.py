@@ -8,6 +8,7 @@ Seattle University, ARIN 5360
 @version: 2.0.0+w26
 """
 
+import re
 from pathlib import Path
 
 import pytest
@@ -76,3 +77,128 @@ def test_sample():
     assert chunks[500]["text"][:24] == "thin mist began to creep"
     assert chunks[500]["id"] == "dracula_by_bram_stoker_500"
     assert chunks[500]["metadata"] == {"chunk": 500, "doc_id": "dracula_by_bram_stoker"}
+
+
+def test_chunk_spans_slice_the_text():
+    """Test that each chunk's text is its span sliced out of the original text."""
+    chunker = DocumentChunker(chunk_size=4, overlap=1)
+    text = "One two\nthree  four five\tsix seven eight nine"
+
+    chunks = chunker.chunk_text(text, "doc1")
+
+    assert [chunk["text"] for chunk in chunks] == [
+        "One two\nthree  four",
+        "four five\tsix seven",
+        "seven eight nine",
+    ]
+    for chunk in chunks:
+        start, end = chunk["span"]
+        assert text[start:end] == chunk["text"]
+
+
+def test_chunk_spans_small_text():
+    """Test that a text which fits in one chunk spans the whole text."""
+    chunker = DocumentChunker(chunk_size=100, overlap=10)
+    assert chunker.chunk_spans("Short document") == [(0, 14)]
+    assert chunker.chunk_spans("") == [(0, 0)]
+
+
+class PieceTokenizer:
+    """
+    Stand-in for a word-piece tokenizer: words are split into pieces of at
+    most three characters and punctuation marks are tokens of their own.
+    """
+
+    def __call__(self, text, add_special_tokens=True, return_offsets_mapping=False):
+        offsets = []
+        for match in re.finditer(r"\w+|[^\w\s]", text):
+            for start in range(match.start(), match.end(), 3):
+                offsets.append((start, min(start + 3, match.end())))
+        return {"input_ids": list(range(len(offsets))), "offset_mapping": offsets}
+
+
+def count_tokens(text):
+    """Count the tokens PieceTokenizer makes of the text."""
+    return len(PieceTokenizer()(text)["offset_mapping"])
+
+
+def test_token_chunker_small_text():
+    """Test that text within the token limit isn't chunked."""
+    chunker = DocumentChunker(chunk_size=10, overlap=2, tokenizer=PieceTokenizer())
+    chunks = chunker.chunk_text("Short document", "doc1")
+    assert [chunk["text"] for chunk in chunks] == ["Short document"]
+
+
+def test_token_chunker_packs_whole_words():
+    """Test that chunks are packed up to the token limit without splitting words."""
+    chunker = DocumentChunker(chunk_size=6, overlap=2, tokenizer=PieceTokenizer())
+    text = "Tokenization matters, a lot! Every chunk fits the model exactly."
+
+    chunks = chunker.chunk_text(text, "doc1")
+
+    assert [chunk["text"] for chunk in chunks] == [
+        "Tokenization",
+        "matters, a",
+        "a lot! Every",
+        "Every chunk fits",
+        "fits the model",
+        "model exactly.",
+    ]
+    assert all(count_tokens(chunk["text"]) <= 6 for chunk in chunks)
+
+
+def test_token_chunker_splits_long_words():
+    """Test that a word longer than the token limit is split at token boundaries."""
+    chunker = DocumentChunker(chunk_size=6, overlap=2, tokenizer=PieceTokenizer())
+    word = "x" * 60
+    text = f"See {word} here"
+
+    chunks = chunker.chunk_text(text, "doc1")
+
+    assert [chunk["text"] for chunk in chunks] == [
+        "See",
+        word[:18],
+        word[18:36],
+        word[36:54],
+        word[54:] + " here",
+    ]
+    assert all(count_tokens(chunk["text"]) <= 6 for chunk in chunks)
+
+
+def test_token_chunker_covers_the_text():
+    """Test that token chunks cover every word of a long text within the limit."""
+    chunker = DocumentChunker(chunk_size=50, overlap=10, tokenizer=PieceTokenizer())
+    test_dir = Path(__file__).parent
+    with open(test_dir / "data" / "dracula_by_bram_stoker.txt", encoding="utf-8-sig") as f:
+        text = f.read()[:20000]
+
+    chunks = chunker.chunk_text(text, "dracula")
+
+    assert all(count_tokens(chunk["text"]) <= 50 for chunk in chunks)
+    assert chunks[0]["span"][0] == 0
+    assert chunks[-1]["span"][1] == len(text.rstrip())
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # Each chunk starts within (or right after) the previous one
+        assert previous["span"][0] < chunk["span"][0] <= previous["span"][1] + 1
+
+
+@pytest.mark.parametrize("block_size", [1, 7, 1000])
+def test_iter_chunks_matches_chunk_text(block_size):
+    """Test that chunking a text in blocks gives the same chunks as chunking it whole."""
+    chunker = DocumentChunker(chunk_size=10, overlap=2)
+    test_dir = Path(__file__).parent
+    with open(test_dir / "data" / "dracula_by_bram_stoker.txt", encoding="utf-8-sig") as f:
+        text = "\n  " + f.read()[:5000]
+    blocks = [text[i : i + block_size] for i in range(0, len(text), block_size)]
+
+    streamed = [chunk for chunks in chunker.iter_chunks(blocks, "doc1") for chunk in chunks]
+
+    assert streamed == chunker.chunk_text(text.strip(), "doc1")
+
+
+def test_iter_chunks_small_text():
+    """Test that a streamed text within one chunk comes back whole."""
+    chunker = DocumentChunker(chunk_size=100, overlap=10)
+    chunks = list(chunker.iter_chunks([" Short ", "docu", "ment "], "doc1"))
+    assert [[chunk["text"] for chunk in block] for block in chunks] == [["Short document"]]
+    assert list(chunker.iter_chunks(["  ", ""], "doc1")) == []
@@ -0,0 +1,113 @@
+"""
+Unit tests for near-duplicate chunk elimination.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+from pathlib import Path
+
+import pytest
+
+from retrieval.dedup import ChunkDeduplicator
+from retrieval.loader import DocumentChunker
+
+LICENSE = (
+    "Permission is hereby granted, free of charge, to any person obtaining a copy of this "
+    "software and associated documentation files, to deal in the Software without restriction, "
+    "including without limitation the rights to use, copy, modify, merge, publish, distribute, "
+    "sublicense, and sell copies of the Software, subject to the following conditions."
+)
+
+
+def chunk(chunk_id, text, filename):
+    """Make a chunk dict."""
+    return {"id": chunk_id, "text": text, "metadata": {"filename": filename}}
+
+
+def test_exact_duplicates():
+    """Test that chunks with the same words (any case or spacing) are collapsed."""
+    dedup = ChunkDeduplicator()
+    unique, duplicates = dedup.deduplicate(
+        [
+            chunk("a_0", LICENSE, "a.txt"),
+            chunk("b_0", "  " + LICENSE.upper().replace(" ", "\n"), "b.txt"),
+            chunk("c_0", "Something else entirely", "c.txt"),
+        ]
+    )
+
+    assert [c["id"] for c in unique] == ["a_0", "c_0"]
+    assert [c["id"] for c in duplicates] == ["b_0"]
+    assert dedup.sources("a_0") == ["a.txt", "b.txt"]
+    assert dedup.sources("c_0") == ["c.txt"]
+
+
+def test_near_duplicates_across_calls():
+    """Test that near duplicates are caught, even against earlier batches."""
+    dedup = ChunkDeduplicator(threshold=0.8)
+    dedup.deduplicate([chunk("a_0", LICENSE, "a.txt")])
+
+    near = LICENSE.replace("sublicense, and sell", "sublicense, and/or sell")
+    unique, duplicates = dedup.deduplicate([chunk("b_0", near, "b.txt")])
+
+    assert unique == []
+    assert dedup.sources("a_0") == ["a.txt", "b.txt"]
+
+
+def test_dissimilar_chunks_are_kept():
+    """Test that none of the overlapping chunks of a real text count as duplicates."""
+    with open(Path(__file__).parent / "data" / "dracula_by_bram_stoker.txt", encoding="utf-8") as f:
+        chunks = DocumentChunker().chunk_text(f.read()[:200000], "dracula")
+
+    unique, duplicates = ChunkDeduplicator().deduplicate(chunks)
+
+    assert duplicates == []
+    assert len(unique) == len(chunks)
+
+
+def test_forget_reports_orphaned_duplicates():
+    """Test that forgetting a canonical chunk reports the duplicates that relied on it."""
+    dedup = ChunkDeduplicator()
+    dedup.deduplicate(
+        [
+            chunk("a_0", LICENSE, "a.txt"),
+            chunk("b_0", LICENSE, "b.txt"),
+            chunk("c_0", LICENSE, "c.txt"),
+        ]
+    )
+
+    assert dedup.forget(["b_0"]) == set()
+    assert dedup.sources("a_0") == ["a.txt", "c.txt"]
+    assert dedup.forget(["a_0"]) == {"c_0"}
+    assert dedup.sources("a_0") == []
+
+    # With its canonical chunk gone, the text is new again
+    unique, _ = dedup.deduplicate([chunk("c_0", LICENSE, "c.txt")])
+    assert [c["id"] for c in unique] == ["c_0"]
+
+
+def test_stand_ins():
+    """Test finding the canonical chunks of duplicates that match filters."""
+    dedup = ChunkDeduplicator()
+    a, b, c, d = (
+        chunk("a_0", LICENSE, "a.txt"),
+        chunk("b_0", LICENSE, "b.txt"),
+        chunk("c_0", "", "c.txt"),
+        chunk("d_0", LICENSE, "d.txt"),
+    )
+    dedup.deduplicate([a, b, c, d])
+
+    assert dedup.stand_ins({"filename": "b.txt"}) == ["a_0"]
+    assert dedup.stand_ins({"filename": ["a.txt", "c.txt"]}) == []
+    assert dedup.stand_ins({"$or": [{"filename": "d.txt"}, {"id": "b_0"}]}) == ["a_0"]
+    dedup.forget(["b_0"])
+    assert dedup.stand_ins({"filename": "b.txt"}) == []
+    assert dedup.stand_ins({"filename": "d.txt"}) == ["a_0"]
+
+
+def test_bad_bands():
+    """Test that the bands must evenly split the signature."""
+    with pytest.raises(ValueError):
+        ChunkDeduplicator(num_perm=64, bands=10)
@@ -11,7 +11,12 @@ Seattle University, ARIN 5360
 import numpy as np
 import pytest
 
-from retrieval.embeddings import DocumentEmbedder
+from retrieval.embeddings import (
+    DocumentEmbedder,
+    EmbeddingCache,
+    QueryCache,
+    embedding_parity,
+)
 
 
 @pytest.fixture
@@ -90,3 +95,215 @@ def test_custom_model_name():
     embedder = DocumentEmbedder(model_name="all-MiniLM-L6-v2")
 
     assert embedder.model_name == "all-MiniLM-L6-v2"
+
+
+def test_max_tokens(embedder):
+    """Test the number of text tokens the model sees (256 less [CLS] and [SEP])."""
+    assert embedder.max_tokens == 254
+    assert len(embedder.tokenizer("Hello world", add_special_tokens=False)["input_ids"]) == 2
+
+
+def test_cache_only_embeds_misses(tmp_path, monkeypatch):
+    """Test that cached texts aren't sent to the model again."""
+    embedder = DocumentEmbedder(cache_dir=str(tmp_path))
+    first = embedder.embed_documents(["alpha", "beta"])
+
+    encoded = []
+    encode = embedder.model.encode
+    monkeypatch.setattr(
+        embedder.model, "encode", lambda texts, **kw: encoded.append(texts) or encode(texts, **kw)
+    )
+    second = embedder.embed_documents(["beta", "gamma", "alpha", "gamma"])
+
+    assert encoded == [["gamma"]]
+    np.testing.assert_array_equal(second[0], first[1])
+    np.testing.assert_array_equal(second[2], first[0])
+    np.testing.assert_array_equal(second[1], second[3])
+    np.testing.assert_allclose(second[1], encode(["gamma"])[0], rtol=1e-6)
+
+
+def test_cache_persists(tmp_path):
+    """Test that the cache is reloaded from disk, separately for each model."""
+    embedder = DocumentEmbedder(cache_dir=str(tmp_path))
+    expected = embedder.embed_documents(["alpha", "beta"])
+
+    cache = EmbeddingCache(tmp_path, "all-MiniLM-L6-v2")
+    found, cached = cache.get([cache.key("beta"), cache.key("delta"), cache.key("alpha")])
+    assert len(cache) == 2
+    assert found == [0, 2]
+    np.testing.assert_array_equal(cached, expected[[1, 0]])
+    assert len(EmbeddingCache(tmp_path, "other-model")) == 0
+
+
+def test_cache_ignores_partial_row(tmp_path):
+    """Test that a row cut short by an interrupted write is dropped."""
+    cache = EmbeddingCache(tmp_path, "model")
+    cache.put([cache.key("a"), cache.key("b")], np.ones((2, 4), dtype=np.float32))
+    with open(cache.directory / "vectors.f32", "r+b") as f:
+        f.truncate(4 * 4 + 6)
+
+    cache = EmbeddingCache(tmp_path, "model")
+    assert len(cache) == 1
+    cache.put([cache.key("b")], np.full((1, 4), 2, dtype=np.float32))
+    found, cached = cache.get([cache.key("a"), cache.key("b")])
+    assert found == [0, 1]
+    np.testing.assert_array_equal(cached, [[1] * 4, [2] * 4])
+
+
+def test_caches_sharing_a_directory(tmp_path):
+    """Test that caches writing to one directory number their rows from the files."""
+    a = EmbeddingCache(tmp_path, "model")
+    b = EmbeddingCache(tmp_path, "model")
+    a.put([a.key("a1"), a.key("a2")], np.ones((2, 4), dtype=np.float32))
+    b.put([b.key("b1")], np.full((1, 4), 2, dtype=np.float32))
+
+    for cache in (a, b):
+        found, cached = cache.get([cache.key(t) for t in ("a1", "a2", "b1")])
+        assert found == [0, 1, 2]
+        np.testing.assert_array_equal(cached, [[1] * 4, [1] * 4, [2] * 4])
+    assert len(EmbeddingCache(tmp_path, "model")) == 3
+
+    with pytest.raises(ValueError):
+        a.put([a.key("c")], np.ones((1, 3), dtype=np.float32))
+
+
+def test_query_cache_skips_model(embedder, monkeypatch):
+    """Test that repeated queries are answered without running the model."""
+    embedder.query_cache.clear()
+    first = embedder.embed_query("cached query")
+
+    monkeypatch.setattr(embedder.model, "encode", lambda *a, **kw: pytest.fail("model was run"))
+    second = embedder.embed_query("cached query")
+    both = embedder.embed_query(["cached query", "cached query"])
+
+    np.testing.assert_array_equal(first, second)
+    np.testing.assert_array_equal(both, [first, first])
+    assert embedder.cache_info() == {"hits": 2, "misses": 1, "size": 1, "max_size": 1024}
+
+
+def test_query_cache_evicts_least_recently_used():
+    """Test that the cache stays bounded, evicting the least recently used."""
+    cache = QueryCache(max_size=2)
+    cache.put("a", np.zeros(2))
+    cache.put("b", np.zeros(2))
+    assert cache.get("a") is not None
+    cache.put("c", np.zeros(2))
+
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_query_cache_expires(monkeypatch):
+    """Test that entries older than the time to live are misses."""
+    now = [100.0]
+    monkeypatch.setattr("retrieval.embeddings.time.monotonic", lambda: now[0])
+    cache = QueryCache(ttl=10)
+    cache.put("a", np.zeros(2))
+
+    now[0] += 5
+    assert cache.get("a") is not None
+    now[0] += 10
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_batches_respect_token_budget(embedder, monkeypatch):
+    """Test that texts are grouped by length under the batch limits."""
+    monkeypatch.setattr(embedder, "batch_size", 3)
+    monkeypatch.setattr(embedder, "max_batch_tokens", 20)
+    texts = ["a b", "a b c d e f g h", "a", "a b c d e f g h i j", "a b c", "a b"]
+
+    batches = embedder._batches(texts)
+
+    # Lengths (with [CLS] and [SEP]) are 4, 10, 3, 12, 5, 4
+    lengths = [len(embedder.tokenizer(text)["input_ids"]) for text in texts]
+    assert batches == [[3], [1, 4], [0, 5, 2]]
+    for batch in batches:
+        assert len(batch) <= 3
+        assert len(batch) * max(lengths[i] for i in batch) <= 20
+
+
+def test_batched_embeddings_keep_order(embedder, monkeypatch):
+    """Test that batching doesn't change the embeddings or their order."""
+    texts = ["short", "a much longer text about Python programming", "medium length text"] * 5
+    expected = embedder.model.encode(texts)
+    monkeypatch.setattr(embedder, "batch_size", 4)
+
+    np.testing.assert_allclose(embedder.embed_documents(texts), expected, rtol=1e-5, atol=1e-6)
+
+
+def test_normalize():
+    """Test that embeddings can be scaled to unit length."""
+    embedder = DocumentEmbedder(normalize=True)
+    embeddings = embedder.embed_documents(["Python programming", "eating pizza"])
+
+    np.testing.assert_allclose(np.linalg.norm(embeddings, axis=1), 1.0, rtol=1e-5)
+
+
+def test_normalize_cached_apart(tmp_path, monkeypatch):
+    """Test that normalized embeddings aren't served from the cache of raw ones."""
+    raw_embedder = DocumentEmbedder(cache_dir=str(tmp_path))
+    encode = raw_embedder.model.encode
+    # Like most models, make the raw embeddings longer than unit length
+    monkeypatch.setattr(raw_embedder.model, "encode", lambda *a, **kw: 2 * encode(*a, **kw))
+    raw = raw_embedder.embed_documents(["Python programming"])
+
+    normalized = DocumentEmbedder(cache_dir=str(tmp_path), normalize=True).embed_documents(
+        ["Python programming"]
+    )
+
+    assert np.linalg.norm(raw) > 1.5
+    np.testing.assert_allclose(np.linalg.norm(normalized, axis=1), 1.0, rtol=1e-5)
+
+
+def test_unknown_backend():
+    """Test that an unknown backend or a quantized torch model is rejected."""
+    with pytest.raises(ValueError):
+        DocumentEmbedder(backend="tensorflow")
+    with pytest.raises(ValueError):
+        DocumentEmbedder(quantized=True)
+
+
+def test_parity_with_itself(embedder):
+    """Test that an embedder has perfect parity with itself."""
+    texts = ["Python programming", "coding in Python", "eating pizza", "pizza toppings"]
+
+    parity = embedding_parity(embedder, embedder, texts)
+
+    assert parity["min_cosine"] == pytest.approx(1.0)
+    assert parity["mean_cosine"] == pytest.approx(1.0)
+    assert parity["neighbor_agreement"] == 1.0
+
+
+@pytest.mark.parametrize("quantized", [False, True])
+def test_onnx_parity(embedder, quantized):
+    """Test that the ONNX model's embeddings match the PyTorch model's."""
+    pytest.importorskip("onnxruntime")
+    onnx_embedder = DocumentEmbedder(backend="onnx", quantized=quantized)
+    texts = [
+        "Python is a programming language",
+        "Coding in Python is fun",
+        "Pizza is an Italian dish",
+        "I like eating pizza with friends",
+        "The stock market fell today",
+        "Shares dropped sharply on Wall Street",
+    ]
+
+    parity = embedding_parity(embedder, onnx_embedder, texts)
+
+    assert parity["min_cosine"] > (0.95 if quantized else 0.999)
+    assert parity["neighbor_agreement"] == 1.0
+
+
+def test_bulk_mode(embedder):
+    """Test that embedding with a pool of workers gives the same results, in order."""
+    texts = ["short", "a much longer text about Python programming", "medium length text"] * 5
+    expected = embedder.embed_documents(texts)
+
+    with embedder.bulk(processes=2):
+        assert embedder.pool_size == 2
+        embeddings = embedder.embed_documents(texts)
+
+    assert embedder.pool_size == 0
+    np.testing.assert_allclose(embeddings, expected, rtol=1e-5, atol=1e-6)
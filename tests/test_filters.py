@@ -0,0 +1,130 @@
+"""
+Unit tests of metadata filters.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import numpy as np
+import pytest
+
+from retrieval.filters import MetadataIndex, build_where, matches, validate
+
+
+def test_build_where():
+    """Test translating filters into ChromaDB where clauses."""
+    assert build_where(None) is None
+    assert build_where({}) is None
+    assert build_where({"type": "pdf"}) == {"type": {"$eq": "pdf"}}
+    assert build_where({"type": "pdf", "filename": ["a.pdf", "b.pdf"]}) == {
+        "$and": [{"type": {"$eq": "pdf"}}, {"filename": {"$in": ["a.pdf", "b.pdf"]}}]
+    }
+    assert build_where({"$or": [{"type": "pdf"}, {"doc_id": "a", "chunk": 0}]}) == {
+        "$or": [
+            {"type": {"$eq": "pdf"}},
+            {"$and": [{"doc_id": {"$eq": "a"}}, {"chunk": {"$eq": 0}}]},
+        ]
+    }
+    assert build_where({"type": "pdf", "$or": [{"doc_id": "a"}]}) == {
+        "$and": [{"type": {"$eq": "pdf"}}, {"doc_id": {"$eq": "a"}}]
+    }
+    with pytest.raises(ValueError):
+        build_where({"id": "a_0"})
+
+
+def test_matches():
+    """Test matching metadata against filters."""
+    metadata = {"type": "txt", "filename": "a.txt", "doc_id": "a", "chunk": 0}
+    assert matches(metadata, None)
+    assert matches(metadata, {"type": "txt", "filename": ["a.txt", "b.txt"]})
+    assert not matches(metadata, {"type": "pdf"})
+    assert not matches(metadata, {"filename": ["b.txt"]})
+    assert not matches(metadata, {"num_pages": 1})
+    assert matches(metadata, {"$or": [{"type": "pdf"}, {"doc_id": "a", "chunk": 0}]})
+    assert not matches(metadata, {"type": "txt", "$or": [{"type": "pdf"}, {"doc_id": "b"}]})
+    assert matches(metadata, {"id": ["a_0", "b_0"]}, "a_0")
+    assert matches(metadata, {"$or": [{"type": "pdf"}, {"id": "a_0"}]}, "a_0")
+    assert not matches(metadata, {"id": "a_0"})
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        {"type": []},
+        {"type": {"$eq": "pdf"}},
+        {"type": [None]},
+        {"$or": []},
+        {"$or": [{}]},
+        {"$or": [{"type": []}]},
+    ],
+)
+def test_invalid_filters(filters):
+    """Test that empty or nested filter values, and malformed alternatives, are rejected."""
+    with pytest.raises(ValueError):
+        validate(filters)
+
+
+def test_metadata_index():
+    """Test that the index finds the same rows as matching each row's metadata."""
+    metadatas = [
+        {"type": "pdf", "doc_id": "a", "page": 1},
+        {"type": "txt", "doc_id": "b"},
+        {"type": "pdf", "doc_id": "c", "page": 2, "tags": ["x"]},
+        {"type": "pdf", "doc_id": "a", "page": 2},
+    ]
+    queries = [
+        {"type": "pdf"},
+        {"type": "pdf", "page": [2, 3]},
+        {"doc_id": "a", "missing": 1},
+        {"type": "docx"},
+        {"tags": "x"},
+        {"$or": [{"doc_id": "b"}, {"page": 1}]},
+        {"type": "pdf", "$or": [{"doc_id": "c"}, {"page": 1}]},
+    ]
+
+    def check(index, rows):
+        assert len(index) == len(rows)
+        for filters in queries:
+            expected = [i for i, metadata in enumerate(rows) if matches(metadata, filters)]
+            assert index.rows(filters).tolist() == expected
+        assert index.rows({}).tolist() == list(range(len(rows)))
+
+    index = MetadataIndex()
+    index.append(metadatas[:2])
+    index.append(metadatas[2:])
+    check(index, metadatas)
+
+    # Move the last row over the first, as a store deleting the first does
+    index.move(3, 0)
+    index.truncate(3)
+    check(index, [metadatas[3], metadatas[1], metadatas[2]])
+
+    index.keep(np.array([2, 0]))
+    check(index, [metadatas[2], metadatas[3]])
+
+    restored = MetadataIndex(len(index), index.export_state())
+    check(restored, [metadatas[2], metadatas[3]])
+    restored.append([{"type": "txt", "doc_id": "d"}])
+    check(restored, [metadatas[2], metadatas[3], {"type": "txt", "doc_id": "d"}])
+
+
+def test_metadata_index_ids():
+    """Test that the index finds rows by chunk id, alone and with other filters."""
+    metadatas = [{"type": "pdf"}, {"type": "txt"}, {"type": "pdf"}]
+    ids = ["a_0", "b_0", "c_0"]
+    id_rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+    index = MetadataIndex()
+    index.append(metadatas)
+
+    for filters in [
+        {"id": "b_0"},
+        {"id": ["c_0", "a_0", "missing"]},
+        {"id": ["a_0", "b_0"], "type": "pdf"},
+        {"$or": [{"type": "txt"}, {"id": "c_0"}]},
+        {"type": "pdf", "$or": [{"id": "b_0"}, {"id": "c_0"}]},
+    ]:
+        expected = [i for i in range(len(ids)) if matches(metadatas[i], filters, ids[i])]
+        assert index.rows(filters, id_rows).tolist() == expected
+    assert index.rows({"id": "a_0"}).tolist() == []
@@ -0,0 +1,296 @@
+"""
+Unit tests of the compact flat vector store.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import numpy as np
+import pytest
+
+from retrieval.embeddings import DocumentEmbedder
+from retrieval.flat import FlatVectorStore
+from retrieval.snapshot import SnapshotDocuments, read_snapshot, write_snapshot
+
+
+class RandomEmbedder:
+    """Embeds each text as a fixed random vector, for measuring recall."""
+
+    def __init__(self, texts: list[str], dim: int = 384, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.vectors = dict(zip(texts, rng.standard_normal((len(texts), dim), np.float32)))
+
+    def embed_documents(self, texts):
+        return np.stack([self.vectors[text] for text in texts])
+
+    def embed_query(self, queries):
+        if isinstance(queries, str):
+            return self.vectors[queries]
+        return self.embed_documents(queries)
+
+
+@pytest.fixture
+def sample_docs():
+    """Sample documents for testing."""
+    return [
+        {"id": "1", "text": "Python programming", "metadata": {"filename": "file1.txt"}},
+        {"id": "2", "text": "Vector databases", "metadata": {"filename": "file2.txt"}},
+        {"id": "3", "text": "Semantic search", "metadata": {"filename": "file3.txt"}},
+    ]
+
+
+@pytest.mark.parametrize("precision", ["float32", "float16", "int8"])
+def test_search(sample_docs, precision):
+    """Test that the nearest document comes first, with its cosine distance."""
+    embedder = DocumentEmbedder()
+    store = FlatVectorStore(embedder, precision=precision)
+    store.add_documents(sample_docs)
+
+    results = store.search("Python programming", n_results=2)
+
+    assert store.count() == 3
+    assert [result["id"] for result in results][0] == "1"
+    assert results[0]["distance"] == pytest.approx(0, abs=1e-5)
+    assert results[0]["metadata"] == {"filename": "file1.txt"}
+    assert results[0]["distance"] <= results[1]["distance"]
+
+
+def test_unknown_precision():
+    """Test that an unknown precision, or memory mapping compact vectors, is rejected."""
+    with pytest.raises(ValueError):
+        FlatVectorStore(RandomEmbedder([]), precision="int4")
+    with pytest.raises(ValueError):
+        FlatVectorStore(RandomEmbedder([]), precision="int8", memory_map=True)
+
+
+def test_search_empty_store():
+    """Test that searching an empty store finds nothing."""
+    store = FlatVectorStore(RandomEmbedder(["query"]))
+    assert store.search("query") == []
+
+
+def test_default_precision_is_exact():
+    """Test that a store holds float32 vectors unless compact storage is asked for."""
+    texts = [f"text {i}" for i in range(100)]
+    store = FlatVectorStore(RandomEmbedder(texts))
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+
+    assert store.precision == "float32"
+    assert store.search("text 3", n_results=1)[0]["distance"] == pytest.approx(0, abs=1e-6)
+
+
+@pytest.mark.parametrize(
+    "precision, memory_map, in_file",
+    [("float32", False, False), ("float32", True, True), ("int8", False, True)],
+)
+def test_vectors_file_only_when_needed(tmp_path, precision, memory_map, in_file):
+    """Test that float32 vectors held in memory aren't also written to a file."""
+    texts = [f"text {i}" for i in range(10)]
+    store = FlatVectorStore(
+        RandomEmbedder(texts), precision, directory=str(tmp_path / "store"), memory_map=memory_map
+    )
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+
+    assert (tmp_path / "store" / "vectors.f32").exists() == in_file
+    documents, arrays = store.export_state()
+    assert len(documents) == len(arrays["unit_embeddings"]) == 10
+    assert store.search("text 3", n_results=1)[0]["id"] == "text 3"
+
+
+def test_add_stored_ids():
+    """Test that adding an id already stored, or twice, is rejected without adding anything."""
+    texts = ["one", "two", "three"]
+    store = FlatVectorStore(RandomEmbedder(texts))
+    store.add_documents([{"id": "one", "text": "one", "metadata": {}}])
+
+    with pytest.raises(ValueError):
+        store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+    with pytest.raises(ValueError):
+        store.add_documents([{"id": "two", "text": t, "metadata": {}} for t in texts[1:]])
+    assert store.count() == 1
+
+
+@pytest.mark.parametrize("precision, memory_map", [("float32", True), ("int8", False)])
+def test_search_scores_outside_lock(precision, memory_map):
+    """Test that a search overlapping a removal is scored again, and the file cut after."""
+    texts = [f"text {i}" for i in range(50)]
+    store = FlatVectorStore(RandomEmbedder(texts), precision=precision, memory_map=memory_map)
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+    best = store._best
+    calls = []
+
+    def remove_while_scoring(*args):
+        # Another thread would wait for the lock; this one holds it again
+        if not calls:
+            assert store._searches == 1
+            store.delete_documents(["text 3", "text 10"])
+        calls.append(args)
+        return best(*args)
+
+    store._best = remove_while_scoring
+    results = store.search("text 3", n_results=5)
+
+    assert len(calls) == 2  # the first pass's rows had moved
+    assert "text 3" not in [result["id"] for result in results]
+    assert store._searches == 0
+    assert store._vectors_path.stat().st_size == 48 * 384 * 4
+
+
+@pytest.mark.parametrize("precision, min_ratio", [("float16", 2), ("int8", 3.5)])
+def test_recall_and_memory(precision, min_ratio):
+    """Test that compact storage keeps recall@10 while shrinking memory."""
+    texts = [f"text {i}" for i in range(2000)]
+    embedder = RandomEmbedder(texts)
+    store = FlatVectorStore(embedder, precision=precision)
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+
+    vectors = np.stack([embedder.vectors[t] for t in texts])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    recalls = []
+    for query in texts[:50]:
+        exact = set(np.array(texts)[np.argsort(-(vectors @ embedder.vectors[query]))[:10]])
+        found = {result["id"] for result in store.search(query, n_results=10)}
+        recalls.append(len(found & exact) / 10)
+
+    assert np.mean(recalls) >= 0.99
+    assert vectors.nbytes / store.nbytes >= min_ratio
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_exact_search(memory_map):
+    """Test that float32 search returns the exact nearest neighbors in order."""
+    texts = [f"text {i}" for i in range(500)]
+    embedder = RandomEmbedder(texts)
+    store = FlatVectorStore(embedder, precision="float32", memory_map=memory_map)
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts[:300]])
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts[300:]])
+
+    vectors = np.stack([embedder.vectors[t] for t in texts])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    query = embedder.vectors["text 7"] / np.linalg.norm(embedder.vectors["text 7"])
+    similarities = vectors @ query
+    expected = np.argsort(-similarities)[:10]
+
+    results = store.search("text 7", n_results=10)
+    assert [result["id"] for result in results] == [texts[i] for i in expected]
+    distances = [result["distance"] for result in results]
+    np.testing.assert_allclose(distances, 1 - similarities[expected], atol=1e-5)
+    assert store.nbytes == (0 if memory_map else vectors.nbytes)
+
+
+@pytest.mark.parametrize("precision", ["float32", "int8"])
+def test_delete_and_replace_documents(precision):
+    """Test that deleted documents are gone, and stored ids are replaced once deleted."""
+    texts = [f"text {i}" for i in range(10)] + ["new"]
+    embedder = RandomEmbedder(texts)
+    store = FlatVectorStore(embedder, precision=precision)
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts[:10]])
+
+    store.delete_documents(["text 2", "text 9", "unknown", "text 0"])
+    with pytest.raises(ValueError):
+        store.add_documents([{"id": "text 5", "text": "new", "metadata": {"new": True}}])
+    store.delete_documents(["text 5"])
+    store.add_documents([{"id": "text 5", "text": "new", "metadata": {"new": True}}])
+
+    assert store.count() == 7
+    results = store.search("new", n_results=20)
+    assert {result["id"] for result in results} == {f"text {i}" for i in (1, 3, 4, 5, 6, 7, 8)}
+    assert results[0] == {
+        "id": "text 5",
+        "text": "new",
+        "distance": pytest.approx(0, abs=1e-5),
+        "metadata": {"new": True},
+    }
+    for text in ("text 1", "text 8"):
+        assert store.search(text, n_results=1)[0]["id"] == text
+
+
+@pytest.mark.parametrize("precision", ["float32", "int8"])
+def test_search_many(precision, monkeypatch):
+    """Test that a batch of queries gets the same results as searching one by one."""
+    texts = [f"text {i}" for i in range(300)]
+    embedder = RandomEmbedder(texts)
+    store = FlatVectorStore(embedder, precision=precision)
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+    queries = texts[:20]
+    expected = [store.search(query, n_results=5) for query in queries]
+
+    calls = []
+    embed_query = embedder.embed_query
+    monkeypatch.setattr(embedder, "embed_query", lambda q: calls.append(q) or embed_query(q))
+    results = store.search_many(queries, n_results=5)
+
+    assert calls == [queries]
+    assert [[r["id"] for r in rs] for rs in results] == [[r["id"] for r in rs] for rs in expected]
+    assert store.search_many([]) == []
+
+
+@pytest.mark.parametrize("precision", ["float32", "int8"])
+def test_search_with_filters(precision):
+    """Test that only documents matching the filters are scored."""
+    texts = [f"text {i}" for i in range(100)]
+    embedder = RandomEmbedder(texts)
+    store = FlatVectorStore(embedder, precision=precision)
+    store.add_documents(
+        [{"id": t, "text": t, "metadata": {"odd": i % 2}} for i, t in enumerate(texts)]
+    )
+
+    results = store.search("text 4", n_results=5, filters={"odd": 1})
+
+    assert len(results) == 5
+    assert all(result["metadata"]["odd"] == 1 for result in results)
+    assert store.search("text 4", filters={"odd": 2}) == []
+
+
+@pytest.mark.parametrize("precision", ["float32", "int8"])
+def test_upsert_and_delete_document(precision, make_chunks):
+    """Test that upserting a shorter document leaves none of its old chunks behind."""
+    store = FlatVectorStore(RandomEmbedder(["one", "two", "three", "four", "uno"]), precision)
+
+    store.add_documents(make_chunks("a", "one two three") + make_chunks("b", "four"))
+    store.upsert_documents(make_chunks("a", "uno"))
+
+    assert store.count() == 2
+    assert store.search("uno", n_results=1)[0]["id"] == "a_0"
+    assert {result["id"] for result in store.search("one", n_results=5)} == {"a_0", "b_0"}
+
+    store.delete_document("a")
+    assert [result["id"] for result in store.search("four")] == ["b_0"]
+
+
+@pytest.mark.parametrize("memory_map", [False, True])
+def test_import_snapshot(tmp_path, memory_map):
+    """Test that a memory-mapped store searches a snapshot's vectors where they are."""
+    texts = [f"text {i}" for i in range(20)] + ["new"]
+    embedder = RandomEmbedder(texts)
+    store = FlatVectorStore(embedder, precision="float32", memory_map=True)
+    store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts[:20]])
+    documents, arrays = store.export_state()
+    arrays.update(SnapshotDocuments.pack(documents))
+    write_snapshot(tmp_path / "snapshot.bin", {}, arrays)
+    snapshot_bytes = (tmp_path / "snapshot.bin").read_bytes()
+    _, arrays = read_snapshot(tmp_path / "snapshot.bin")
+
+    replica = FlatVectorStore(embedder, precision="float32", memory_map=memory_map)
+    replica.import_state(SnapshotDocuments.unpack(arrays), arrays)
+    adopted = np.shares_memory(replica._full_vectors(), arrays["unit_embeddings"])
+    assert adopted == memory_map
+    assert isinstance(replica._texts, list) != memory_map  # read from the snapshot
+    assert replica.search("text 3", 5) == store.search("text 3", 5)
+
+    # Deleting the last row still leaves the snapshot's vectors in use
+    replica.delete_documents(["text 19"])
+    assert np.shares_memory(replica._full_vectors(), arrays["unit_embeddings"]) == adopted
+
+    # Other changes are made to the store's own copy, not the snapshot
+    replica.delete_documents(["text 0", "text 5"])
+    replica.add_documents([{"id": "text 5", "text": "new", "metadata": {}}])
+    assert not np.shares_memory(replica._full_vectors(), arrays["unit_embeddings"])
+    assert isinstance(replica._texts, list)
+    assert replica.count() == 18
+    assert replica.search("new", 1)[0]["id"] == "text 5"
+    for text in ("text 1", "text 18"):
+        assert replica.search(text, 1)[0]["id"] == text
+    assert (tmp_path / "snapshot.bin").read_bytes() == snapshot_bytes
@@ -6,9 +6,12 @@ Seattle University, ARIN 5360
 @version: 4.0.0+w26
 """
 
+import numpy as np
 import pytest
+from rank_bm25 import BM25Okapi
 
 from retrieval.hybrid import BM25Searcher, HybridSearcher
+from retrieval.snapshot import SnapshotDocuments
 
 
 def test_bm25_searcher_initialization():
@@ -101,3 +104,166 @@ def test_hybrid_search_without_bm25():
     # Should just return semantic results
     assert len(results) == 2
     assert results[0]["id"] == "doc1"
+
+
+def test_bm25_add_documents():
+    """Test adding documents in batches matches indexing them all at once."""
+    documents = [
+        {"id": "doc1", "text": "Machine learning and artificial intelligence"},
+        {"id": "doc2", "text": "Python is a programming language"},
+        {"id": "doc3", "text": "Machine learning uses algorithms"},
+    ]
+    all_at_once = BM25Searcher()
+    all_at_once.index_documents(documents)
+
+    batched = BM25Searcher()
+    batched.add_documents(documents[:2])
+    batched.add_documents(documents[2:])
+
+    assert batched.doc_ids == ["doc1", "doc2", "doc3"]
+    assert batched.search("machine learning") == all_at_once.search("machine learning")
+
+    # Ids already indexed are skipped rather than counted twice
+    batched.add_documents(documents[1:])
+    assert batched.doc_ids == ["doc1", "doc2", "doc3"]
+    assert batched.search("machine learning") == all_at_once.search("machine learning")
+
+
+def test_bm25_remove_documents():
+    """Test that removed documents no longer come back from a search."""
+    searcher = BM25Searcher()
+    searcher.index_documents(
+        [
+            {"id": "doc1", "text": "Machine learning and artificial intelligence"},
+            {"id": "doc2", "text": "Python is a programming language"},
+            {"id": "doc3", "text": "Machine learning uses algorithms"},
+            {"id": "doc4", "text": "Vector databases store embeddings"},
+        ]
+    )
+
+    searcher.remove_documents(["doc1", "missing"])
+
+    assert searcher.doc_ids == ["doc2", "doc3", "doc4"]
+    assert [doc["id"] for doc in searcher.search("machine learning")] == ["doc3"]
+
+
+def test_bm25_search_with_filters():
+    """Test that BM25 only scores documents matching the filters."""
+    searcher = BM25Searcher()
+    searcher.index_documents(
+        [
+            {"id": "doc1", "text": "Python programming", "metadata": {"type": "txt"}},
+            {"id": "doc2", "text": "Python snakes", "metadata": {"type": "pdf"}},
+            {"id": "doc3", "text": "Machine learning", "metadata": {"type": "txt"}},
+            {"id": "doc4", "text": "Vector databases", "metadata": {"type": "pdf"}},
+            {"id": "doc5", "text": "Semantic search", "metadata": {"type": "txt"}},
+        ]
+    )
+
+    results = searcher.search("Python", filters={"type": "pdf"})
+
+    assert [result["id"] for result in results] == ["doc2"]
+
+
+def test_bm25_top_results_match_full_sort():
+    """Test that the top results are the best scores, ties in document order."""
+    words = ["alpha", "beta", "gamma", "delta"]
+    documents = [
+        {
+            "id": f"doc{i}",
+            "text": " ".join(words[j] for j in range(4) if (i >> j) & 1 or j == i % 4),
+            "metadata": {"odd": i % 2},
+        }
+        for i in range(40)
+    ]
+    searcher = BM25Searcher()
+    searcher.index_documents(documents)
+    scores = searcher.bm25.get_scores(["alpha", "gamma"])
+
+    for n_results, filters in ((5, None), (12, None), (100, None), (5, {"odd": 1})):
+        rows = [i for i in range(40) if filters is None or i % 2]
+        expected = sorted(rows, key=lambda i: scores[i], reverse=True)[:n_results]
+        expected = [f"doc{i}" for i in expected if scores[i] > 0]
+        results = searcher.search("alpha gamma", n_results=n_results, filters=filters)
+        assert [result["id"] for result in results] == expected
+        assert [result["score"] for result in results] == [
+            pytest.approx(scores[int(result["id"][3:])]) for result in results
+        ]
+    assert searcher.search("alpha", n_results=0) == []
+
+
+def test_bm25_upsert_and_delete_document(make_chunks):
+    """Test that upserting a shorter document leaves none of its old chunks behind."""
+    searcher = BM25Searcher()
+    searcher.index_documents(
+        make_chunks("a", "machine learning")
+        + make_chunks("b", "python")
+        + make_chunks("c", "vector")
+    )
+
+    searcher.upsert_documents(make_chunks("a", "semantic"))
+
+    assert sorted(searcher.doc_ids) == ["a_0", "b_0", "c_0"]
+    assert searcher.search("learning") == []
+    assert [doc["id"] for doc in searcher.search("semantic")] == ["a_0"]
+
+    searcher.delete_document("a")
+    assert sorted(searcher.doc_ids) == ["b_0", "c_0"]
+
+
+def test_bm25_export_and_import_state():
+    """Test that imported BM25 statistics score like the ones they were exported from."""
+    documents = [
+        {"id": "doc1", "text": "Machine learning and artificial intelligence"},
+        {"id": "doc2", "text": "Python is a programming language"},
+        {"id": "doc3", "text": "Machine learning uses algorithms"},
+    ]
+    searcher = BM25Searcher()
+    searcher.index_documents(documents)
+    snapshot = [{**doc, "metadata": {}} for doc in documents[::-1]]
+    arrays = SnapshotDocuments.pack(snapshot)
+    arrays.update(searcher.export_state([doc["id"] for doc in snapshot]))
+    assert searcher.export_state(["doc1", "doc2"]) is None
+
+    imported = BM25Searcher()
+    imported.import_state(SnapshotDocuments.unpack(arrays), arrays)
+
+    assert imported.doc_ids == ["doc3", "doc2", "doc1"]
+    for query in ("machine learning", "python"):
+        expected = [{**result, "metadata": {}} for result in searcher.search(query)]
+        assert imported.search(query) == expected
+    imported.add_documents([{"id": "doc4", "text": "Deep learning", "metadata": {}}])
+    imported.remove_documents(["doc1"])
+    assert {result["id"] for result in imported.search("learning")} == {"doc3", "doc4"}
+
+
+def test_bm25_updates_match_recounting():
+    """Test that statistics kept up to date per document match counting from scratch."""
+    texts = [
+        "Machine learning and artificial intelligence",
+        "Python is a programming language",
+        "Machine learning uses algorithms",
+        "Vector databases store embeddings",
+        "Python machine learning libraries",
+    ]
+    documents = [
+        {"id": f"doc{i}", "text": text, "metadata": {"doc_id": f"doc{i}"}}
+        for i, text in enumerate(texts)
+    ]
+    searcher = BM25Searcher()
+    searcher.index_documents(documents[:3])
+    searcher.add_documents(documents[3:])
+    searcher.remove_documents(["doc1"])
+    searcher.upsert_documents(
+        [{"id": "doc2", "text": "Deep learning", "metadata": {"doc_id": "doc2"}}]
+    )
+    searcher.rebuild()
+
+    remaining = [texts[0], texts[3], texts[4], "Deep learning"]
+    expected = BM25Okapi([text.lower().split() for text in remaining])
+    assert searcher.doc_ids == ["doc0", "doc3", "doc4", "doc2"]
+    assert searcher.bm25.avgdl == expected.avgdl
+    assert searcher.bm25.idf == pytest.approx(expected.idf)
+    for query in ("machine learning", "python", "deep learning algorithms"):
+        tokens = query.split()
+        np.testing.assert_allclose(searcher.bm25.get_scores(tokens), expected.get_scores(tokens))
@@ -10,7 +10,9 @@ Seattle University, ARIN 5360
 import pytest
 from fastapi.testclient import TestClient
 
+from retrieval import config, main
 from retrieval.main import app
+from retrieval.snapshot import SnapshotDocuments, read_snapshot, write_snapshot
 
 
 @pytest.fixture
@@ -65,3 +67,33 @@ def test_search_invalid_n_results(client):
     """Test search with invalid n_results returns 400."""
     response = client.post("/search", json={"query": "test", "n_results": 100})
     assert response.status_code == 400
+
+
+def test_search_with_filters(client):
+    """Test that the search endpoint only returns chunks matching the filters."""
+    response = client.post(
+        "/search", json={"query": "test", "n_results": 5, "filters": {"type": "pdf"}}
+    )
+
+    assert response.status_code == 200
+    assert all(result["metadata"]["type"] == "pdf" for result in response.json()["results"])
+
+    response = client.post("/search", json={"query": "test", "filters": {"type": []}})
+    assert response.status_code == 400
+
+
+def test_rejected_snapshot_is_replaced(tmp_path, monkeypatch):
+    """Test that a snapshot from other settings is written again after indexing."""
+    snapshot = tmp_path / "snapshot.bin"
+    write_snapshot(snapshot, {"fingerprint": {}, "manifest": {}}, {})
+    monkeypatch.setattr(config, "INDEX_SNAPSHOT", str(snapshot))
+
+    with TestClient(app, raise_server_exceptions=False):
+        header, arrays = read_snapshot(snapshot)
+        assert header["fingerprint"] == main.retriever.fingerprint
+        assert len(SnapshotDocuments.unpack(arrays)) == main.retriever.document_count > 0
+
+        # Unchanged documents leave the new snapshot as it is
+        modified = snapshot.stat().st_mtime_ns
+    with TestClient(app, raise_server_exceptions=False):
+        assert snapshot.stat().st_mtime_ns == modified
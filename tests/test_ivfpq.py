@@ -0,0 +1,249 @@
+"""
+Unit tests of the IVF-PQ vector store.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import threading
+
+import numpy as np
+import pytest
+
+from retrieval import ivfpq
+from retrieval.ivfpq import IVFPQVectorStore
+
+
+class ClusteredEmbedder:
+    """Embeds each text as a fixed random vector near one of a few centers."""
+
+    def __init__(self, texts: list[str], dim: int = 64, clusters: int = 40, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        centers = rng.standard_normal((clusters, dim), np.float32)
+        vectors = centers[rng.integers(clusters, size=len(texts))]
+        vectors += 0.5 * rng.standard_normal((len(texts), dim), np.float32)
+        self.vectors = dict(zip(texts, vectors))
+
+    def embed_documents(self, texts):
+        return np.stack([self.vectors[text] for text in texts])
+
+    def embed_query(self, queries):
+        if isinstance(queries, str):
+            return self.vectors[queries]
+        return self.embed_documents(queries)
+
+
+def make_store(n: int = 4000, **kwargs):
+    """Create a store with n clustered documents, trained once the first 2000 are added."""
+    texts = [f"text {i}" for i in range(n)]
+    embedder = ClusteredEmbedder(texts)
+    options = {"n_lists": 32, "n_subvectors": 16, "nprobe": 8, "train_size": 2000}
+    store = IVFPQVectorStore(embedder, **(options | kwargs))
+    for start in range(0, n, 1000):
+        store.add_documents(
+            [{"id": t, "text": t, "metadata": {"odd": i % 2}} for i, t in enumerate(texts)][
+                start : start + 1000
+            ]
+        )
+    return store, embedder, texts
+
+
+def exact_neighbors(embedder, texts, query, k=10):
+    vectors = np.stack([embedder.vectors[t] for t in texts])
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return set(np.array(texts)[np.argsort(-(vectors @ embedder.vectors[query]))[:k]])
+
+
+def test_exact_until_trained():
+    """Test that searches are exact before there is enough data to train on."""
+    store, embedder, texts = make_store(n=1000)
+
+    assert not store.trained
+    assert store.nbytes == 0
+    results = store.search("text 3", n_results=10)
+    assert {r["id"] for r in results} == exact_neighbors(embedder, texts, "text 3")
+    assert results[0]["distance"] == pytest.approx(0, abs=1e-5)
+
+
+def test_recall_and_memory():
+    """Test recall@10 against exact search, and the memory per vector."""
+    store, embedder, texts = make_store()
+
+    assert store.trained
+    recalls = []
+    for query in texts[::40]:
+        found = {r["id"] for r in store.search(query, n_results=10)}
+        recalls.append(len(found & exact_neighbors(embedder, texts, query)) / 10)
+    assert np.mean(recalls) >= 0.95
+
+    float32_bytes = store._full_vectors().nbytes
+    assert float32_bytes == 4000 * 64 * 4
+    fixed = (32 * 64 + 16 * 256 * 4) * 4  # coarse centroids and codebooks
+    assert store.nbytes == 4000 * (16 + 8) + fixed
+    assert store.nbytes - fixed < float32_bytes / 10
+
+
+def test_nprobe_trades_recall():
+    """Test that probing more clusters doesn't lose recall."""
+    store, embedder, texts = make_store()
+    queries = texts[::80]
+
+    def recall():
+        return np.mean(
+            [
+                len({r["id"] for r in store.search(q, 10)} & exact_neighbors(embedder, texts, q))
+                for q in queries
+            ]
+        )
+
+    store.set_search_params(nprobe=1)
+    low = recall()
+    store.set_search_params(nprobe=32)
+    assert recall() >= low
+    assert recall() == 10  # every cluster probed and the shortlist rescored
+
+
+def test_delete_upsert_and_filters():
+    """Test that the codes follow deletes and replacements after training."""
+    store, embedder, texts = make_store()
+
+    store.delete_documents(["text 0", "text 1", "text 3"])
+    embedder.vectors["new"] = embedder.vectors["text 2"]
+    store.add_documents([{"id": "text 3", "text": "new", "metadata": {"odd": 1}}])
+
+    assert store.count() == 3998
+    ids = [r["id"] for r in store.search("text 2", n_results=2)]
+    assert set(ids) == {"text 2", "text 3"}
+    assert "text 0" not in {r["id"] for r in store.search("text 0", n_results=10)}
+    for query in ("text 3998", "text 3999"):  # moved into the deleted rows
+        best = store.search(query, n_results=1)[0]
+        assert best["id"] == best["text"] == query
+    assert {r["text"] for r in store.search("text 2", n_results=2)} == {"text 2", "new"}
+
+    results = store.search("text 4", n_results=5, filters={"odd": 1})
+    assert len(results) == 5
+    assert all(r["metadata"]["odd"] == 1 for r in results)
+
+
+def test_selective_filters():
+    """Test that a filter matching few chunks widens the probe rather than missing them."""
+    store, embedder, texts = make_store(nprobe=1)
+    rare = ["text 10", "text 2000", "text 3999"]
+    store.delete_documents(rare)
+    store.add_documents([{"id": t, "text": t, "metadata": {"odd": 2}} for t in rare])
+
+    results = store.search("text 5", n_results=5, filters={"odd": 2})
+    assert sorted(r["id"] for r in results) == sorted(rare)
+    assert store.search("text 5", filters={"odd": 3}) == []
+
+
+def test_text_file_compaction(monkeypatch, tmp_path):
+    """Test that the text file reclaims the bytes of replaced and removed texts."""
+    monkeypatch.setattr(ivfpq, "_COMPACT_MIN_BYTES", 100)
+    texts = ivfpq._TextFile(tmp_path / "texts.utf8")
+    for i in range(10):
+        texts.append(f"text {i}")
+    for _ in range(20):
+        for i in range(0, 10, 2):
+            texts[i] = f"längere Text {i}"
+    del texts[8:]
+
+    assert list(texts) == [f"längere Text {i}" if i % 2 == 0 else f"text {i}" for i in range(8)]
+    size = (tmp_path / "texts.utf8").stat().st_size
+    assert size <= 2 * sum(len(text.encode("utf-8")) for text in texts) + 100
+
+
+def test_training_doesnt_block(monkeypatch):
+    """Test that searches and updates go on while the index trains, and are kept."""
+    store, embedder, texts = make_store(n=1000)
+    embedder.vectors["copy"] = embedder.vectors["text 7"]
+    kmeans = ivfpq._kmeans
+    updated = []
+
+    def update():
+        assert store.search("text 5", n_results=1)[0]["id"] == "text 5"
+        store.delete_documents(["text 0"])
+        store.add_documents([{"id": "copy", "text": "copy", "metadata": {"odd": 1}}])
+        updated.append(True)
+
+    def kmeans_with_updates(*args, **kwargs):
+        if not updated:
+            thread = threading.Thread(target=update)
+            thread.start()
+            thread.join(timeout=10)
+            assert updated
+        return kmeans(*args, **kwargs)
+
+    monkeypatch.setattr(ivfpq, "_kmeans", kmeans_with_updates)
+    store.train()
+
+    assert store.trained
+    assert store.count() == 1000
+    assert {r["id"] for r in store.search("text 7", n_results=2)} == {"text 7", "copy"}
+    assert "text 0" not in {r["id"] for r in store.search("text 0", n_results=10)}
+    for query in texts[1:40]:
+        assert store.search(query, n_results=1)[0]["id"] == query
+
+
+def test_search_scores_outside_lock():
+    """Test that a trained search overlapping a removal is scored again."""
+    store, _, _ = make_store(n=2000)
+    probe = store._probe
+    calls = []
+
+    def remove_while_scoring(*args):
+        # Another thread would wait for the lock; this one holds it again
+        if not calls:
+            assert store._searches == 1
+            store.delete_documents(["text 3", "text 10"])
+        calls.append(args)
+        return probe(*args)
+
+    store._probe = remove_while_scoring
+    results = store.search("text 3", n_results=5)
+
+    assert len(calls) == 2  # the first pass's rows had moved
+    assert "text 3" not in [result["id"] for result in results]
+    assert store._searches == 0
+    assert store._vectors_path.stat().st_size == 1998 * 64 * 4
+
+
+def test_train_needs_enough_vectors():
+    """Test that training on too few vectors is rejected."""
+    store, _, _ = make_store(n=100)
+    with pytest.raises(ValueError):
+        store.train()
+
+
+def test_invalid_settings():
+    """Test that settings that can't be trained are rejected before adding anything."""
+    store, embedder, texts = make_store(n=100)
+    with pytest.raises(ValueError):
+        IVFPQVectorStore(embedder, n_lists=32, train_size=100)
+    with pytest.raises(ValueError):
+        IVFPQVectorStore(embedder, n_lists=1024, train_size=1000)
+
+    store = IVFPQVectorStore(embedder, n_lists=32, n_subvectors=7, train_size=2000)
+    with pytest.raises(ValueError):
+        store.add_documents([{"id": t, "text": t, "metadata": {}} for t in texts])
+    assert store.count() == 0
+
+
+def test_export_and_import_state(monkeypatch):
+    """Test that an imported store reuses the exported index instead of training."""
+    store, embedder, texts = make_store()
+    documents, arrays = store.export_state()
+
+    imported = IVFPQVectorStore(embedder, n_lists=32, n_subvectors=16, nprobe=8, train_size=2000)
+    monkeypatch.setattr(imported, "_train", lambda: pytest.fail())
+    imported.import_state(documents, arrays)
+
+    assert imported.trained
+    assert imported.count() == 4000
+    assert imported.export_state()[0] == documents
+    for query in texts[:20]:
+        results, expected = imported.search(query, 10), store.search(query, 10)
+        assert [r["id"] for r in results] == [r["id"] for r in expected]
+        assert [r["distance"] for r in results] == pytest.approx([r["distance"] for r in expected])
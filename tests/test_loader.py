@@ -8,9 +8,19 @@ Seattle University, ARIN 5360
 @version: 2.0.0+w26
 """
 
+from pathlib import Path
+
+import pypdf
 import pytest
+from pypdf.generic import (
+    ArrayObject,
+    DecodedStreamObject,
+    DictionaryObject,
+    NameObject,
+    NumberObject,
+)
 
-from retrieval.loader import DocumentLoader
+from retrieval.loader import DocumentChunker, DocumentLoader
 
 
 def test_loader_loads_documents(tmp_path):
@@ -44,3 +54,157 @@ def test_loader_skips_nonexistent_directory():
     loader = DocumentLoader()
     with pytest.raises(ValueError, match="Directory 'garbage' does not exist."):
         loader.load_documents("garbage")
+
+
+def test_loader_sorted_order(tmp_path):
+    """Test that text files come back in sorted order."""
+    for name in ["c.txt", "a.txt", "b.txt"]:
+        (tmp_path / name).write_text(f"Contents of {name}")
+    loader = DocumentLoader()
+    documents = loader.load_documents(str(tmp_path))
+    assert [doc["metadata"]["filename"] for doc in documents] == ["a.txt", "b.txt", "c.txt"]
+
+
+def test_loader_ids_unique_per_file(tmp_path):
+    """Test that files differing only in their extension get distinct chunk ids, but one doc_id."""
+    sample = Path(__file__).parent / "data" / "MSAI-courses.pdf"
+    (tmp_path / "courses.pdf").write_bytes(sample.read_bytes())
+    (tmp_path / "courses.txt").write_text("A list of courses.")
+    documents = DocumentLoader(chunker=DocumentChunker()).load_documents(str(tmp_path))
+
+    ids = [doc["id"] for doc in documents]
+    assert "courses.txt_0" in ids and "courses.pdf_0" in ids
+    assert len(set(ids)) == len(ids)
+    assert {doc["metadata"]["doc_id"] for doc in documents} == {"courses"}
+
+
+def test_loader_worker_pool_matches_sequential():
+    """Test that loading with a worker pool gives the same chunks in the same order."""
+    sample_dir = str(Path(__file__).parent / "data")
+    sequential = DocumentLoader(chunker=DocumentChunker()).load_documents(sample_dir)
+    parallel = DocumentLoader(chunker=DocumentChunker(), max_workers=4).load_documents(sample_dir)
+
+    assert len(sequential) > 0
+    assert parallel == sequential
+    assert {doc["metadata"]["type"] for doc in parallel} == {"txt", "pdf"}
+
+
+def test_loader_worker_pool_skips_bad_files(tmp_path):
+    """Test that a file failing in a worker doesn't stop the others from loading."""
+    (tmp_path / "good.txt").write_text("This is a test file.")
+    (tmp_path / "bad.pdf").write_text("This is not really a PDF.")
+    loader = DocumentLoader(max_workers=2)
+    documents = loader.load_documents(str(tmp_path))
+    assert len(documents) == 1
+    assert documents[0]["metadata"]["filename"] == "good.txt"
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_loader_streams_large_files(max_workers):
+    """Test that streaming text files gives the same chunks as reading them whole."""
+    sample_dir = str(Path(__file__).parent / "data")
+    whole = DocumentLoader(chunker=DocumentChunker()).load_documents(sample_dir)
+    loader = DocumentLoader(chunker=DocumentChunker(), max_workers=max_workers, stream_threshold=0)
+
+    streamed = loader.load_documents(sample_dir)
+
+    assert streamed == whole
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_loader_skips_files_that_vanish(tmp_path, max_workers):
+    """Test that a text file that can't be stat'ed is skipped rather than ending the load."""
+    (tmp_path / "good.txt").write_text("This is a test file.")
+    (tmp_path / "gone.txt").symlink_to(tmp_path / "missing.txt")
+    loader = DocumentLoader(chunker=DocumentChunker(), max_workers=max_workers, stream_threshold=0)
+
+    documents = loader.load_documents(str(tmp_path))
+
+    assert [doc["metadata"]["filename"] for doc in documents] == ["good.txt"]
+
+
+@pytest.fixture
+def pdf_directory(tmp_path):
+    """Create a directory holding a copy of the sample PDF."""
+    directory = tmp_path / "docs"
+    directory.mkdir()
+    sample = Path(__file__).parent / "data" / "MSAI-courses.pdf"
+    (directory / "courses.pdf").write_bytes(sample.read_bytes())
+    return directory
+
+
+def test_pdf_cache_skips_unchanged_files(pdf_directory, tmp_path, monkeypatch):
+    """Test that an unchanged PDF is loaded from the cache without parsing it."""
+    loader = DocumentLoader(chunker=DocumentChunker(), pdf_cache_dir=str(tmp_path / "cache"))
+    first = loader.load_documents(str(pdf_directory))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("PDF should not be parsed")
+
+    monkeypatch.setattr(pypdf, "PdfReader", fail)
+    assert loader.load_documents(str(pdf_directory)) == first
+    assert first[0]["metadata"]["num_pages"] == 31
+
+
+def test_pdf_cache_reextracts_only_changed_pages(pdf_directory, tmp_path, monkeypatch):
+    """Test that a modified PDF only has its changed pages extracted again."""
+    loader = DocumentLoader(chunker=DocumentChunker(), pdf_cache_dir=str(tmp_path / "cache"))
+    first = loader.load_documents(str(pdf_directory))
+
+    # Change the file's bytes, but none of its pages
+    with open(pdf_directory / "courses.pdf", "ab") as f:
+        f.write(b"\n% appended comment\n")
+    extracted = []
+    extract_text = pypdf.PageObject.extract_text
+    monkeypatch.setattr(
+        pypdf.PageObject,
+        "extract_text",
+        lambda page, *args, **kwargs: extracted.append(page) or extract_text(page, *args, **kwargs),
+    )
+
+    assert loader.load_documents(str(pdf_directory)) == first
+    assert extracted == []
+
+
+def _write_form_pdf(path: Path, text: str):
+    """Write a one-page PDF whose text is drawn by a form (Form XObject)."""
+    writer = pypdf.PdfWriter()
+    page = writer.add_blank_page(612, 792)
+    font = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Font"),
+            NameObject("/Subtype"): NameObject("/Type1"),
+            NameObject("/BaseFont"): NameObject("/Helvetica"),
+        }
+    )
+    form = DecodedStreamObject()
+    form.set_data(f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode())
+    form.update(
+        {
+            NameObject("/Type"): NameObject("/XObject"),
+            NameObject("/Subtype"): NameObject("/Form"),
+            NameObject("/BBox"): ArrayObject([NumberObject(n) for n in (0, 0, 612, 792)]),
+            NameObject("/Resources"): DictionaryObject(
+                {NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})}
+            ),
+        }
+    )
+    page[NameObject("/Resources")] = DictionaryObject(
+        {NameObject("/XObject"): DictionaryObject({NameObject("/Fm1"): writer._add_object(form)})}
+    )
+    contents = DecodedStreamObject()
+    contents.set_data(b"/Fm1 Do")
+    page[NameObject("/Contents")] = writer._add_object(contents)
+    writer.write(path)
+
+
+def test_pdf_cache_reextracts_changed_forms(tmp_path):
+    """Test that a page is extracted again when only a form it draws has changed."""
+    directory = tmp_path / "docs"
+    directory.mkdir()
+    loader = DocumentLoader(pdf_cache_dir=str(tmp_path / "cache"))
+    _write_form_pdf(directory / "form.pdf", "Hello form")
+    assert loader.load_documents(str(directory))[0]["text"] == "Hello form"
+
+    _write_form_pdf(directory / "form.pdf", "Changed form")
+    assert loader.load_documents(str(directory))[0]["text"] == "Changed form"
@@ -0,0 +1,151 @@
+"""
+Unit tests for the index manifest.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import os
+
+from retrieval.manifest import IndexManifest
+
+
+def record_all(manifest, directory, changes):
+    """Record every added and modified file as one chunk named after it."""
+    for filepath in changes.added + changes.modified:
+        stats = changes.stats[str(filepath.resolve())]
+        manifest.record(filepath, stats, [f"{filepath.stem}_0"])
+
+
+def test_scan_new_directory(tmp_path):
+    """Test that everything is new to an empty manifest."""
+    (tmp_path / "a.txt").write_text("Alpha")
+    (tmp_path / "b.txt").write_text("Beta")
+    files = sorted(tmp_path.glob("*.txt"))
+
+    changes = IndexManifest().scan(str(tmp_path), files)
+
+    assert changes.added == files
+    assert changes.modified == []
+    assert changes.removed == []
+    assert changes
+
+
+def test_scan_detects_changes(tmp_path):
+    """Test that modified and removed files are detected and unchanged ones are not."""
+    for name in ["a.txt", "b.txt", "c.txt"]:
+        (tmp_path / name).write_text(f"Contents of {name}")
+    manifest = IndexManifest()
+    files = sorted(tmp_path.glob("*.txt"))
+    record_all(manifest, tmp_path, manifest.scan(str(tmp_path), files))
+    assert not manifest.scan(str(tmp_path), files)
+
+    (tmp_path / "b.txt").write_text("New contents of b.txt")
+    (tmp_path / "c.txt").unlink()
+    (tmp_path / "d.txt").write_text("Delta")
+    changes = manifest.scan(str(tmp_path), sorted(tmp_path.glob("*.txt")))
+
+    assert [fp.name for fp in changes.added] == ["d.txt"]
+    assert [fp.name for fp in changes.modified] == ["b.txt"]
+    assert changes.removed == [str((tmp_path / "c.txt").resolve())]
+    assert manifest.forget(changes.removed[0]) == ["c_0"]
+
+
+def test_scan_treats_vanished_files_as_removed(tmp_path):
+    """Test that a file deleted after being listed is removed rather than failing the scan."""
+    for name in ["a.txt", "b.txt"]:
+        (tmp_path / name).write_text(f"Contents of {name}")
+    manifest = IndexManifest()
+    files = sorted(tmp_path.glob("*.txt"))
+    record_all(manifest, tmp_path, manifest.scan(str(tmp_path), files))
+
+    (tmp_path / "a.txt").unlink()
+    (tmp_path / "c.txt").write_text("Gamma")
+    (tmp_path / "c.txt").unlink()
+    changes = manifest.scan(str(tmp_path), files + [tmp_path / "c.txt"])
+
+    assert not changes.added and not changes.modified
+    assert changes.removed == [str((tmp_path / "a.txt").resolve())]
+
+
+def test_scan_ignores_touched_files(tmp_path):
+    """Test that a new mtime without new contents isn't a modification."""
+    filepath = tmp_path / "a.txt"
+    filepath.write_text("Alpha")
+    manifest = IndexManifest()
+    record_all(manifest, tmp_path, manifest.scan(str(tmp_path), [filepath]))
+
+    st = filepath.stat()
+    os.utime(filepath, (st.st_atime, st.st_mtime + 10))
+
+    assert not manifest.scan(str(tmp_path), [filepath])
+
+
+def test_scan_only_removes_from_its_directory(tmp_path):
+    """Test that files indexed from another directory aren't reported as removed."""
+    (tmp_path / "one").mkdir()
+    (tmp_path / "two").mkdir()
+    (tmp_path / "one" / "a.txt").write_text("Alpha")
+    manifest = IndexManifest()
+    files = [tmp_path / "one" / "a.txt"]
+    record_all(manifest, tmp_path, manifest.scan(str(tmp_path / "one"), files))
+
+    assert not manifest.scan(str(tmp_path / "two"), [])
+
+
+def test_save_and_reload(tmp_path):
+    """Test that the manifest round-trips through its file."""
+    (tmp_path / "a.txt").write_text("Alpha")
+    path = tmp_path / "index" / "manifest.json"
+    manifest = IndexManifest(path)
+    files = [tmp_path / "a.txt"]
+    record_all(manifest, tmp_path, manifest.scan(str(tmp_path), files))
+    manifest.save()
+
+    reloaded = IndexManifest(path)
+    assert reloaded.files == manifest.files
+    assert reloaded.chunk_count == 1
+    assert not reloaded.scan(str(tmp_path), files)
+
+
+def test_unreadable_manifest_is_ignored(tmp_path):
+    """Test that a corrupt manifest file just means starting from scratch."""
+    path = tmp_path / "manifest.json"
+    path.write_text("{not json")
+    assert IndexManifest(path).files == {}
+
+
+def test_find_and_forget_duplicates(tmp_path):
+    """Test finding files by any of their chunks, including duplicates."""
+    (tmp_path / "a.txt").write_text("Alpha")
+    manifest = IndexManifest()
+    filepath = tmp_path / "a.txt"
+    changes = manifest.scan(str(tmp_path), [filepath])
+    manifest.record(filepath, changes.stats[str(filepath.resolve())], ["a_0"], ["a_1"])
+    key = str(filepath.resolve())
+
+    assert manifest.find({"a_1", "b_0"}) == [key]
+    assert manifest.find({"b_0"}) == []
+    assert manifest.chunk_count == 1
+    assert manifest.stats(key) == changes.stats[key]
+    assert manifest.forget(key) == ["a_0", "a_1"]
+
+
+def test_export_and_import_elsewhere(tmp_path):
+    """Test that an exported manifest describes the same files in another directory."""
+    first, second = tmp_path / "first", tmp_path / "second"
+    for directory in (first, second):
+        directory.mkdir()
+        (directory / "a.txt").write_text("Alpha")
+    manifest = IndexManifest()
+    record_all(manifest, first, manifest.scan(str(first), [first / "a.txt"]))
+    os.utime(second / "a.txt", (0, 0))  # copied, so touched
+
+    replica = IndexManifest()
+    replica.import_state(str(second), manifest.export_state())
+
+    assert list(manifest.export_state()) == ["a.txt"]
+    assert list(replica.files) == [str((second / "a.txt").resolve())]
+    assert not replica.scan(str(second), [second / "a.txt"])
@@ -8,6 +8,7 @@ Seattle University, ARIN 5360
 @version: 3.0.0+w26
 """
 
+import shutil
 from pathlib import Path
 
 import pytest
@@ -157,3 +158,366 @@ def test_with_chunks(retriever):
 
     assert len(results) > 0
     assert "5 credits" in results[0]["text"]
+
+
+def test_index_documents_in_small_batches(retriever, sample_directory):
+    """Test that streaming the chunks through in tiny batches indexes all of them."""
+    assert retriever.index_documents(sample_directory, batch_size=1) == 3
+    assert retriever.document_count == 3
+    assert len(retriever.bm25_searcher.documents) == 3
+
+
+def test_index_nonexistent_directory(retriever):
+    """Test that a bad directory still raises from the streaming pipeline."""
+    with pytest.raises(ValueError, match="does not exist"):
+        retriever.index_documents("garbage")
+
+
+def test_reindex_unchanged_directory(retriever, sample_directory):
+    """Test that re-indexing an unchanged directory doesn't touch the store."""
+    retriever.index_documents(sample_directory)
+    assert retriever.index_documents(sample_directory) == 0
+    assert retriever.document_count == 3
+
+
+def test_reindex_only_changes(retriever, sample_directory):
+    """Test that re-indexing picks up new, modified, and removed files."""
+    retriever.index_documents(sample_directory)
+    directory = Path(sample_directory)
+    (directory / "doc1.txt").unlink()
+    (directory / "doc2.txt").write_text("Deep learning trains large neural networks")
+    (directory / "doc4.txt").write_text("Garlic keeps vampires away")
+
+    assert retriever.index_documents(sample_directory) == 0
+    assert retriever.document_count == 3
+    ids = {doc["id"] for doc in retriever.bm25_searcher.documents}
+    assert ids == {"doc2.txt_0", "doc3.txt_0", "doc4.txt_0"}
+    results = retriever.search("Deep learning", n_results=3, use_reranking=False)
+    assert any("Deep learning" in result["text"] for result in results)
+
+
+def test_stale_manifest_reindexes_everything(sample_directory, tmp_path):
+    """Test that a saved manifest which doesn't match a fresh store is ignored."""
+    manifest_path = str(tmp_path / "manifest.json")
+    first = DocumentRetriever(enable_reranking=False, manifest_path=manifest_path)
+    first.index_documents(sample_directory)
+
+    second = DocumentRetriever(enable_reranking=False, manifest_path=manifest_path)
+    assert second.index_documents(sample_directory) == 3
+
+
+def test_chunk_by_tokens():
+    """Test that token-based chunks all fit within the embedding model's limit."""
+    retriever = DocumentRetriever(chunk_by_tokens=True, enable_reranking=False)
+    chunker = retriever.loader.chunker
+    assert chunker.chunk_size == retriever.embedder.max_tokens
+
+    test_dir = Path(__file__).parent
+    with open(test_dir / "data" / "dracula_by_bram_stoker.txt", encoding="utf-8-sig") as f:
+        chunks = chunker.chunk_text(f.read(), "dracula")
+
+    tokenizer = retriever.embedder.tokenizer
+    lengths = [len(tokenizer(c["text"], add_special_tokens=False)["input_ids"]) for c in chunks]
+    assert max(lengths) <= retriever.embedder.max_tokens
+
+
+def test_deduplicate(tmp_path):
+    """Test that duplicate files are indexed once, and re-indexed when the original goes."""
+    retriever = DocumentRetriever(enable_reranking=False, deduplicate=True)
+    (tmp_path / "doc1.txt").write_text("Garlic and crucifixes keep vampires away")
+    (tmp_path / "doc2.txt").write_text("Garlic and crucifixes keep  vampires away")
+    (tmp_path / "doc3.txt").write_text("Vector databases store embeddings")
+
+    retriever.index_documents(str(tmp_path))
+    assert retriever.document_count == 2
+    results = retriever.search("vampires", n_results=1)
+    assert results[0]["sources"] == ["doc1.txt", "doc2.txt"]
+
+    (tmp_path / "doc1.txt").unlink()
+    retriever.index_documents(str(tmp_path))
+    assert retriever.document_count == 2
+    results = retriever.search("vampires", n_results=1)
+    assert results[0]["id"] == "doc2.txt_0"
+    assert results[0]["sources"] == ["doc2.txt"]
+
+
+@pytest.mark.parametrize("vector_backend", ["chroma", "flat"])
+def test_deduplicate_with_filters(tmp_path, vector_backend):
+    """Test that a deduplicated chunk matches filters on any file it appears in."""
+    retriever = DocumentRetriever(
+        enable_reranking=False, deduplicate=True, vector_backend=vector_backend
+    )
+    (tmp_path / "doc1.txt").write_text("Garlic and crucifixes keep vampires away")
+    (tmp_path / "doc2.txt").write_text("Garlic and crucifixes keep  vampires away")
+    (tmp_path / "doc3.txt").write_text("Vector databases store embeddings")
+    retriever.index_documents(str(tmp_path))
+
+    for filters in ({"filename": "doc2.txt"}, {"doc_id": ["doc2", "doc3"]}):
+        results = retriever.search("vampires", n_results=2, filters=filters)
+        assert results[0]["id"] == "doc1.txt_0"
+        assert results[0]["sources"] == ["doc1.txt", "doc2.txt"]
+    results = retriever.search("vampires", n_results=2, filters={"filename": "doc3.txt"})
+    assert [result["id"] for result in results] == ["doc3.txt_0"]
+    results = retriever.search("vampires", n_results=2, use_hybrid=False, filters={"type": "pdf"})
+    assert results == []
+
+
+@pytest.mark.parametrize("vector_backend", ["flat", "ivfpq"])
+def test_doc_id_filters_in_index(tmp_path, vector_backend):
+    """Test that the in-index backends filter on the doc_ids the loader gives, whatever they are."""
+    retriever = DocumentRetriever(
+        enable_reranking=False, deduplicate=True, vector_backend=vector_backend
+    )
+    (tmp_path / "doc1.txt").write_text("Garlic and crucifixes keep vampires away")
+    (tmp_path / "doc2.txt").write_text("Garlic and crucifixes keep  vampires away")
+    (tmp_path / "doc3.txt").write_text("Vector databases store embeddings")
+    (tmp_path / "doc4.txt").write_text("Python is a programming language")
+    retriever.index_documents(str(tmp_path))
+    chunks = {
+        chunk["metadata"]["filename"]: chunk
+        for chunk in retriever.loader.load_documents(str(tmp_path))
+    }
+    doc_ids = {filename: chunk["metadata"]["doc_id"] for filename, chunk in chunks.items()}
+
+    for use_hybrid in (False, True):
+        results = retriever.search(
+            "vampires", n_results=3, use_hybrid=use_hybrid, filters={"doc_id": doc_ids["doc4.txt"]}
+        )
+        assert [result["id"] for result in results] == [chunks["doc4.txt"]["id"]]
+
+        # The duplicate's stand-in matches its doc_id too
+        filters = {"doc_id": [doc_ids["doc2.txt"], doc_ids["doc3.txt"]]}
+        results = retriever.search("vampires", n_results=3, use_hybrid=use_hybrid, filters=filters)
+        assert results[0]["id"] == chunks["doc1.txt"]["id"]
+        assert results[0]["sources"] == ["doc1.txt", "doc2.txt"]
+        assert {result["id"] for result in results} == {
+            chunks["doc1.txt"]["id"],
+            chunks["doc3.txt"]["id"],
+        }
+
+
+def test_bulk_indexing_uses_worker_pool(sample_directory, monkeypatch):
+    """Test that a corpus over the threshold is embedded in bulk mode."""
+    retriever = DocumentRetriever(
+        enable_reranking=False, bulk_threshold_bytes=1, embedding_processes=2
+    )
+    pools = []
+    bulk = retriever.embedder.bulk
+    monkeypatch.setattr(
+        retriever.embedder, "bulk", lambda processes: pools.append(processes) or bulk(processes)
+    )
+
+    assert retriever.index_documents(sample_directory) == 3
+    assert pools == [2]
+    assert retriever.embedder.pool_size == 0
+
+    # Re-indexing a small change stays in-process
+    (Path(sample_directory) / "doc4.txt").write_text("Garlic")
+    retriever.bulk_threshold_bytes = 100
+    retriever.index_documents(sample_directory)
+    assert pools == [2]
+
+
+def test_compact_embedding_storage(sample_directory):
+    """Test indexing and searching with int8 embeddings."""
+    retriever = DocumentRetriever(
+        enable_reranking=False, vector_backend="flat", embedding_storage="int8"
+    )
+    assert retriever.index_documents(sample_directory) == 3
+
+    results = retriever.search("Python programming", n_results=2, use_hybrid=False)
+    assert len(results) == 2
+    assert results[0]["metadata"]["filename"] == "doc1.txt"
+
+
+@pytest.mark.parametrize("vector_backend", ["chroma", "ivfpq"])
+def test_compact_embedding_storage_needs_flat_backend(vector_backend):
+    """Test that compact embeddings with a backend that can't keep them are refused."""
+    with pytest.raises(ValueError, match="flat vector backend"):
+        DocumentRetriever(
+            enable_reranking=False, vector_backend=vector_backend, embedding_storage="int8"
+        )
+
+
+def test_warm_start(sample_directory, tmp_path, monkeypatch):
+    """Test that a persisted index is reopened without re-embedding anything."""
+    index_dir = str(tmp_path / "index")
+    first = DocumentRetriever(enable_reranking=False, index_dir=index_dir)
+    assert first.index_documents(sample_directory) == 3
+    del first
+
+    second = DocumentRetriever(enable_reranking=False, index_dir=index_dir)
+    assert second.store.reopened
+    monkeypatch.setattr(second.embedder, "embed_documents", lambda texts: pytest.fail())
+    assert second.index_documents(sample_directory) == 0
+    assert second.document_count == 3
+    assert len(second.bm25_searcher.documents) == 3
+    results = second.search("Python programming", n_results=1, use_hybrid=False)
+    assert results[0]["metadata"]["filename"] == "doc1.txt"
+
+
+def test_warm_start_with_other_settings(sample_directory, tmp_path):
+    """Test that a persisted index built with other chunking settings is rebuilt."""
+    index_dir = str(tmp_path / "index")
+    DocumentRetriever(enable_reranking=False, index_dir=index_dir).index_documents(sample_directory)
+
+    retriever = DocumentRetriever(enable_reranking=False, index_dir=index_dir, chunk_size=100)
+    assert not retriever.store.reopened
+    assert retriever.document_count == 0
+    assert retriever.index_documents(sample_directory) == 3
+
+
+def test_warm_start_without_manifest(sample_directory, tmp_path):
+    """Test that a persisted store without its manifest is re-indexed from scratch."""
+    index_dir = tmp_path / "index"
+    DocumentRetriever(enable_reranking=False, index_dir=str(index_dir)).index_documents(
+        sample_directory
+    )
+    (index_dir / "manifest.json").unlink()
+    (Path(sample_directory) / "doc1.txt").write_text("Garlic keeps vampires away")
+
+    retriever = DocumentRetriever(enable_reranking=False, index_dir=str(index_dir))
+    assert retriever.index_documents(sample_directory) == 3
+    assert retriever.document_count == 3
+    texts = {doc["text"] for doc in retriever.store.get_documents()}
+    assert "Garlic keeps vampires away" in texts
+
+
+def test_warm_start_deduplicated(tmp_path):
+    """Test that files with duplicate chunks are deduplicated again after a restart."""
+    index_dir = str(tmp_path / "index")
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    (docs / "doc1.txt").write_text("Garlic and crucifixes keep vampires away")
+    (docs / "doc2.txt").write_text("Garlic and crucifixes keep  vampires away")
+    DocumentRetriever(
+        enable_reranking=False, deduplicate=True, index_dir=index_dir
+    ).index_documents(str(docs))
+
+    retriever = DocumentRetriever(enable_reranking=False, deduplicate=True, index_dir=index_dir)
+    retriever.index_documents(str(docs))
+    assert retriever.document_count == 1
+    results = retriever.search("vampires", n_results=1)
+    assert results[0]["sources"] == ["doc1.txt", "doc2.txt"]
+
+
+def test_flat_vector_backend(sample_directory):
+    """Test indexing and searching with the exact NumPy backend."""
+    retriever = DocumentRetriever(
+        enable_reranking=False, vector_backend="flat", memory_map_vectors=True
+    )
+    assert retriever.index_documents(sample_directory) == 3
+
+    results = retriever.search("Python programming", n_results=3, use_hybrid=False)
+    assert len(results) == 3
+    assert results[0]["metadata"]["filename"] == "doc1.txt"
+
+
+def test_ivfpq_vector_backend(sample_directory):
+    """Test indexing and searching with the IVF-PQ backend (exact until trained)."""
+    retriever = DocumentRetriever(
+        enable_reranking=False, vector_backend="ivfpq", ivfpq_options={"nprobe": 4}
+    )
+    assert retriever.index_documents(sample_directory) == 3
+    assert retriever.store.nprobe == 4
+
+    results = retriever.search("Python programming", n_results=3, use_hybrid=False)
+    assert len(results) == 3
+    assert results[0]["metadata"]["filename"] == "doc1.txt"
+
+
+def test_search_many(retriever, sample_directory):
+    """Test that searching a batch of queries matches searching them one by one."""
+    retriever.index_documents(sample_directory)
+    queries = ["Python programming", "neural networks", "embeddings"]
+
+    results = retriever.search_many(queries, n_results=2)
+
+    assert len(results) == 3
+    for query, query_results in zip(queries, results):
+        expected = retriever.search(query, n_results=2)
+        assert [r["id"] for r in query_results] == [r["id"] for r in expected]
+
+
+def test_search_many_before_indexing_raises_error(retriever):
+    """Test that a batch search before indexing raises like a single one."""
+    with pytest.raises(ValueError):
+        retriever.search_many(["test"])
+
+
+def test_search_with_filters(sample_directory):
+    """Test that filters restrict both the semantic and the keyword results."""
+    retriever = DocumentRetriever(enable_reranking=False)
+    retriever.index_documents(sample_directory)
+
+    results = retriever.search(
+        "Python programming", n_results=3, filters={"filename": ["doc2.txt", "doc3.txt"]}
+    )
+
+    assert results
+    assert {result["metadata"]["filename"] for result in results} <= {"doc2.txt", "doc3.txt"}
+    with pytest.raises(ValueError):
+        retriever.search("Python", filters={"filename": []})
+
+
+@pytest.mark.parametrize("vector_backend", ["chroma", "flat", "ivfpq"])
+def test_snapshot(sample_directory, tmp_path, monkeypatch, vector_backend):
+    """Test that a replica starts from a snapshot without loading, embedding, or tokenizing."""
+    snapshot = str(tmp_path / "snapshot.bin")
+    first = DocumentRetriever(enable_reranking=False, vector_backend=vector_backend)
+    first.index_documents(sample_directory)
+    first.export_snapshot(snapshot)
+    expected = first.search("Python programming", n_results=3)
+
+    replica = DocumentRetriever(enable_reranking=False, vector_backend=vector_backend)
+    monkeypatch.setattr(replica.embedder, "embed_documents", lambda texts: pytest.fail())
+    for method in ("index_documents", "add_documents"):
+        monkeypatch.setattr(replica.bm25_searcher, method, lambda documents: pytest.fail())
+    assert replica.import_snapshot(snapshot, sample_directory) == 3
+    assert replica.index_documents(sample_directory) == 0
+
+    results = replica.search("Python programming", n_results=3)
+    assert [r["id"] for r in results] == [r["id"] for r in expected]
+    assert [r["rrf_score"] for r in results] == pytest.approx([r["rrf_score"] for r in expected])
+
+
+@pytest.mark.parametrize("vector_backend", ["chroma", "flat"])
+def test_snapshot_elsewhere(sample_directory, tmp_path, monkeypatch, vector_backend):
+    """Test that a replica whose documents are at another path doesn't index them again."""
+    snapshot = str(tmp_path / "snapshot.bin")
+    first = DocumentRetriever(enable_reranking=False, vector_backend=vector_backend)
+    first.index_documents(sample_directory)
+    first.export_snapshot(snapshot)
+
+    copy = tmp_path / "replica"
+    copy.mkdir()
+    for filepath in Path(sample_directory).glob("*.txt"):
+        shutil.copy2(filepath, copy)
+    replica = DocumentRetriever(enable_reranking=False, vector_backend=vector_backend)
+    monkeypatch.setattr(replica.embedder, "embed_documents", lambda texts: pytest.fail())
+    replica.import_snapshot(snapshot, str(copy))
+
+    for _ in range(2):
+        assert replica.index_documents(str(copy)) == 0
+        assert replica.document_count == replica.manifest.chunk_count == 3
+        assert sorted(replica.bm25_searcher.doc_ids) == sorted(first.bm25_searcher.doc_ids)
+
+    # Changes at the new path are still picked up
+    monkeypatch.undo()
+    (copy / "doc1.txt").unlink()
+    replica.index_documents(str(copy))
+    assert replica.document_count == 2
+    assert "doc1.txt_0" not in replica.bm25_searcher.doc_ids
+
+
+def test_snapshot_with_other_settings(sample_directory, tmp_path):
+    """Test that a snapshot made with other chunking settings is rejected."""
+    snapshot = str(tmp_path / "snapshot.bin")
+    first = DocumentRetriever(enable_reranking=False)
+    first.index_documents(sample_directory)
+    first.export_snapshot(snapshot)
+
+    with pytest.raises(ValueError):
+        DocumentRetriever(enable_reranking=False, chunk_size=100).import_snapshot(
+            snapshot, sample_directory
+        )
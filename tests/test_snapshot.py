@@ -0,0 +1,80 @@
+"""
+Unit tests of index snapshot files.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import struct
+
+import numpy as np
+import pytest
+
+from retrieval.snapshot import (
+    SNAPSHOT_VERSION,
+    SnapshotDocuments,
+    read_snapshot,
+    write_snapshot,
+)
+
+
+def test_round_trip(tmp_path):
+    """Test that the header and arrays come back, with the arrays memory-mapped."""
+    path = tmp_path / "snapshot.bin"
+    embeddings = np.random.default_rng(0).standard_normal((5, 7), np.float32)
+    codes = np.arange(15, dtype=np.uint8).reshape(5, 3)
+    header = {"documents": [{"id": "1", "text": "Ünïcode", "metadata": {"page": 2}}]}
+
+    write_snapshot(path, header, {"codes": codes, "embeddings": embeddings, "empty": codes[:0]})
+    read_header, arrays = read_snapshot(path)
+
+    assert read_header == header
+    assert isinstance(arrays["embeddings"], np.memmap)
+    assert arrays["embeddings"].offset % 64 == 0
+    np.testing.assert_array_equal(arrays["embeddings"], embeddings)
+    np.testing.assert_array_equal(arrays["codes"], codes)
+    assert arrays["empty"].shape == (0, 3)
+    assert not (tmp_path / "snapshot.bin.tmp").exists()
+
+
+def test_not_a_snapshot(tmp_path):
+    """Test that other files, and snapshots in another format version, are rejected."""
+    path = tmp_path / "snapshot.bin"
+    path.write_bytes(b"not a snapshot")
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+    write_snapshot(path, {}, {})
+    data = bytearray(path.read_bytes())
+    struct.pack_into("<I", data, 8, SNAPSHOT_VERSION + 1)
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError, match="version"):
+        read_snapshot(path)
+
+
+def test_packed_documents(tmp_path):
+    """Test that documents packed into arrays are read back one at a time from the file."""
+    path = tmp_path / "snapshot.bin"
+    documents = [
+        {"id": "a_0", "text": "Ünïcode", "metadata": {"page": 2}},
+        {"id": "b_0", "text": "", "metadata": {}},
+        {"id": "c_0", "text": "last", "metadata": {"tags": ["x", "y"]}},
+    ]
+    write_snapshot(path, {}, SnapshotDocuments.pack(documents))
+    _, arrays = read_snapshot(path)
+
+    packed = SnapshotDocuments.unpack(arrays)
+    assert isinstance(packed.texts.data, np.memmap)
+    assert list(packed) == documents
+    assert packed[-1] == documents[-1]
+    assert list(packed[1:]) == documents[1:]
+    assert list(packed.ids[:0]) == []
+    assert packed[::2] == documents[::2]
+    with pytest.raises(IndexError):
+        packed[3]
+    index = packed.metadata_index()
+    assert index.rows({"page": 2}).tolist() == [0]
+    assert index.rows({"tags": "x"}).tolist() == []
+    assert list(SnapshotDocuments.unpack(SnapshotDocuments.pack([]))) == []
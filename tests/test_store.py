@@ -9,6 +9,7 @@ Seattle University, ARIN 5360
 
 import warnings
 
+import numpy as np
 import pytest
 
 from retrieval.embeddings import DocumentEmbedder
@@ -85,3 +86,129 @@ def test_search_with_n_results(vector_store, sample_docs):
     vector_store.add_documents(sample_docs)
     results = vector_store.search("some query", n_results=2)
     assert len(results) <= 2
+
+
+def test_delete_documents(vector_store, sample_docs):
+    """Test deleting documents by id, ignoring unknown ids."""
+    vector_store.add_documents(sample_docs)
+    vector_store.delete_documents(["2", "missing"])
+    assert vector_store.count() == 2
+    results = vector_store.search("Vector databases", n_results=3)
+    assert "2" not in {result["id"] for result in results}
+
+
+def test_add_precomputed_embeddings(vector_store, document_embedder, sample_docs, monkeypatch):
+    """Test adding documents with their embeddings, without running the embedder."""
+    embeddings = document_embedder.embed_documents([doc["text"] for doc in sample_docs])
+    monkeypatch.setattr(document_embedder, "embed_documents", lambda texts: pytest.fail())
+
+    vector_store.add_documents(sample_docs, embeddings=embeddings)
+
+    assert vector_store.count() == 3
+    stored = vector_store.collection.get(ids=["2"], include=["embeddings"])["embeddings"]
+    np.testing.assert_allclose(stored[0], embeddings[1], rtol=1e-6)
+
+
+def test_add_mismatched_embeddings(vector_store, sample_docs):
+    """Test that a wrong number of embeddings is rejected."""
+    with pytest.raises(ValueError):
+        vector_store.add_documents(sample_docs, embeddings=np.zeros((2, 384)))
+
+
+def test_add_splits_into_max_batches(vector_store, sample_docs, monkeypatch):
+    """Test that inserts are split to fit ChromaDB's maximum batch size."""
+    monkeypatch.setattr(vector_store.client, "get_max_batch_size", lambda: 2)
+    batches = []
+    add = vector_store.collection.add
+    monkeypatch.setattr(
+        vector_store.collection, "add", lambda ids, **kw: batches.append(ids) or add(ids, **kw)
+    )
+
+    vector_store.add_documents(sample_docs)
+
+    assert batches == [["1", "2"], ["3"]]
+    assert vector_store.count() == 3
+
+
+def test_hnsw_settings(document_embedder, sample_docs):
+    """Test that the HNSW index is built with the given settings and cosine by default."""
+    store = VectorStore(document_embedder, hnsw_m=8, ef_construction=50, ef_search=20)
+    hnsw = store.collection.configuration["hnsw"]
+    assert (hnsw["space"], hnsw["max_neighbors"], hnsw["ef_construction"]) == ("cosine", 8, 50)
+
+    store.add_documents(sample_docs)
+    store.set_search_params(ef_search=200)
+    assert store.collection.configuration["hnsw"]["ef_search"] == 200
+    results = store.search("Python programming", n_results=1)
+    assert results[0]["distance"] == pytest.approx(0, abs=1e-4)
+
+
+def test_reopen_with_other_hnsw_settings(document_embedder, sample_docs, tmp_path):
+    """Test that a persisted index is rebuilt for new graph settings but not for ef_search."""
+    VectorStore(document_embedder, persist_directory=str(tmp_path)).add_documents(sample_docs)
+
+    store = VectorStore(document_embedder, persist_directory=str(tmp_path), ef_search=50)
+    assert store.reopened
+    assert store.collection.configuration["hnsw"]["ef_search"] == 50
+
+    store = VectorStore(document_embedder, persist_directory=str(tmp_path), hnsw_m=32)
+    assert not store.reopened
+    assert store.count() == 0
+
+
+def test_search_many(vector_store, document_embedder, sample_docs, monkeypatch):
+    """Test that a batch of queries is embedded and looked up at once."""
+    vector_store.add_documents(sample_docs)
+    queries = ["Python programming", "Vector databases", "Semantic search"]
+    expected = [vector_store.search(query, n_results=2) for query in queries]
+
+    calls = []
+    embed_query = document_embedder.embed_query
+    monkeypatch.setattr(
+        document_embedder, "embed_query", lambda q: calls.append(q) or embed_query(q)
+    )
+    results = vector_store.search_many(queries, n_results=2)
+
+    assert calls == [queries]
+    assert [[r["id"] for r in rs] for rs in results] == [[r["id"] for r in rs] for rs in expected]
+    assert results[1][0]["id"] == "2"
+
+
+def test_search_with_filters(vector_store, sample_docs):
+    """Test that filters are applied inside the index."""
+    vector_store.add_documents(sample_docs)
+
+    results = vector_store.search(
+        "Python programming", n_results=3, filters={"filename": ["file2.txt", "file3.txt"]}
+    )
+
+    assert {result["id"] for result in results} == {"2", "3"}
+    assert vector_store.search("Python", filters={"filename": "missing.txt"}) == []
+
+
+def test_search_with_id_filters(vector_store, sample_docs):
+    """Test that filters on chunk ids are combined with those on metadata."""
+    vector_store.add_documents(sample_docs)
+
+    results = vector_store.search(
+        "Python programming", n_results=3, filters={"$or": [{"filename": "file2.txt"}, {"id": "3"}]}
+    )
+    assert {result["id"] for result in results} == {"2", "3"}
+    assert [r["distance"] for r in results] == sorted(r["distance"] for r in results)
+
+    results = vector_store.search("Python", filters={"id": ["1", "2"], "filename": "file2.txt"})
+    assert [result["id"] for result in results] == ["2"]
+
+
+def test_upsert_and_delete_document(vector_store, make_chunks):
+    """Test that upserting a shorter document leaves none of its old chunks behind."""
+    vector_store.add_documents(make_chunks("a", "one two three") + make_chunks("b", "four"))
+
+    vector_store.upsert_documents(make_chunks("a", "uno"))
+
+    stored = {doc["id"]: doc["text"] for doc in vector_store.get_documents()}
+    assert stored == {"a_0": "uno", "b_0": "four"}
+
+    vector_store.delete_document("a")
+    vector_store.delete_document("unknown")
+    assert [doc["id"] for doc in vector_store.get_documents()] == ["b_0"]
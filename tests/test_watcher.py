@@ -0,0 +1,88 @@
+"""
+Unit tests for the directory watcher.
+
+Seattle University, ARIN 5360
+@see: https://catalog.seattleu.edu/preview_course_nopop.php?catoid=55&coid
+=190380
+@version: 1.0.0+w26
+"""
+
+import time
+
+import pytest
+
+from retrieval.retriever import DocumentRetriever
+from retrieval.watcher import DirectoryWatcher
+
+
+@pytest.fixture
+def retriever():
+    """Create a DocumentRetriever for testing."""
+    return DocumentRetriever(enable_reranking=False)
+
+
+@pytest.fixture
+def sample_directory(tmp_path):
+    """Create a temporary directory with sample text files."""
+    (tmp_path / "doc1.txt").write_text("Python is a programming language")
+    (tmp_path / "doc2.txt").write_text("Machine learning uses neural networks")
+    return tmp_path
+
+
+@pytest.fixture
+def watcher(retriever, sample_directory):
+    """Create a watcher for an already indexed directory, without debouncing."""
+    retriever.index_documents(str(sample_directory))
+    return DirectoryWatcher(retriever, str(sample_directory), interval=0.05, debounce=0.0)
+
+
+def ids_in(retriever):
+    """Return the ids of the chunks in the retriever's BM25 index."""
+    return sorted(doc["id"] for doc in retriever.bm25_searcher.documents)
+
+
+def test_poll_without_changes(watcher):
+    """Test that nothing happens while the directory is unchanged."""
+    assert watcher.poll() is False
+    assert watcher.poll() is False
+
+
+def test_poll_indexes_settled_changes(watcher, retriever, sample_directory):
+    """Test that created, modified, and deleted files are indexed once they settle."""
+    (sample_directory / "doc1.txt").unlink()
+    (sample_directory / "doc2.txt").write_text("Deep learning trains large neural networks")
+    (sample_directory / "doc3.txt").write_text("Vector databases store embeddings")
+
+    assert watcher.poll() is False  # first sighting of the change
+    assert watcher.poll() is True  # still the same, so index it
+    assert watcher.poll() is False
+
+    assert ids_in(retriever) == ["doc2.txt_0", "doc3.txt_0"]
+    results = retriever.search("Deep learning", n_results=2)
+    assert any("Deep learning" in result["text"] for result in results)
+
+
+def test_poll_waits_for_debounce(retriever, sample_directory):
+    """Test that a change isn't indexed until it has held still long enough."""
+    retriever.index_documents(str(sample_directory))
+    watcher = DirectoryWatcher(retriever, str(sample_directory), debounce=60.0)
+    (sample_directory / "doc3.txt").write_text("Vector databases store embeddings")
+
+    assert watcher.poll() is False
+    assert watcher.poll() is False
+    assert retriever.document_count == 2
+
+
+def test_background_thread_picks_up_new_files(watcher, retriever, sample_directory):
+    """Test that a started watcher makes new files searchable within seconds."""
+    watcher.start()
+    try:
+        (sample_directory / "doc3.txt").write_text("Vector databases store embeddings")
+        deadline = time.monotonic() + 10
+        while retriever.document_count < 3 and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        watcher.stop()
+
+    assert retriever.document_count == 3
+    assert "doc3.txt_0" in ids_in(retriever)